@@ -59,6 +59,15 @@ def insert_frame0(init_pos, movement, agent_name):
     }
 
 
+# 补全快进或加大步长时跳过的step（期间所有Agent保持不动）
+def insert_idle_frames(movement, start_step, end_step):
+    for step in range(start_step, end_step):
+        for i in range(frames_per_step):
+            step_key = "%d" % ((step-1) * frames_per_step + 1 + i)
+            if step_key not in movement.keys():
+                movement[step_key] = dict()
+
+
 # 从所有存档文件中提取数据（用于回放）
 def generate_movement(checkpoints_folder, compressed_folder, compressed_file):
     movement_file = os.path.join(compressed_folder, compressed_file)
@@ -92,6 +101,7 @@ def generate_movement(checkpoints_folder, compressed_folder, compressed_file):
     }
 
     last_location = dict()
+    last_step = 0
 
     # 加载地图数据，用于计算Agent移动路径
     json_path = "frontend/static/assets/village/maze.json"
@@ -106,6 +116,10 @@ def generate_movement(checkpoints_folder, compressed_folder, compressed_file):
             step = json_data["step"]
             agents = json_data["agents"]
 
+            if last_step > 0 and step > last_step + 1:
+                insert_idle_frames(all_movement, last_step + 1, step)
+            last_step = step
+
             # 保存回放的起始时间
             if len(result["start_datetime"]) < 1:
                 t = datetime.strptime(json_data["time"], "%Y%m%d-%H:%M")
@@ -1,13 +1,17 @@
 """generative_agents.agent"""
 
 import os
+import copy
 import math
 import random
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from modules import memory, prompt, utils
+from modules.model.cassette import get_cassette
 from modules.model.llm_model import create_llm_model
 from modules.memory.associate import Concept
+from modules.prompt.scratch import estimate_tokens
 
 
 class Agent:
@@ -17,6 +21,10 @@ class Agent:
         self.conversation = conversation
         self._llm = None
         self.logger = logger
+        self._prefetch, self._prefetch_llm = None, None
+        # 后台预取次日日程的线程，随Agent关闭
+        self._prefetch_executor = None
+        self._chat_request = None
 
         # agent config
         self.percept_config = config["percept"]
@@ -26,13 +34,16 @@ class Agent:
         # memory
         self.spatial = memory.Spatial(**config["spatial"])
         self.schedule = memory.Schedule(**config["schedule"])
+        self.decision = memory.DecisionCache(**config.get("decision", {}))
         self.associate = memory.Associate(
             os.path.join(config["storage_root"], "associate"), **config["associate"]
         )
         self.concepts, self.chats = [], config.get("chats", [])
 
         # prompt
-        self.scratch = prompt.Scratch(self.name, config["currently"], config["scratch"])
+        self.scratch = prompt.Scratch(
+            self.name, config["currently"], config["scratch"], self.think_config.get("budget")
+        )
 
         # status
         status = {"poignancy": 0}
@@ -70,12 +81,15 @@ class Agent:
             "concepts": {c.node_id: c.abstract() for c in self.concepts},
             "chats": self.chats,
             "action": self.action.abstract(),
+            "decision": self.decision.abstract(),
             "associate": self.associate.abstract(),
         }
         if self.schedule.scheduled():
             des["schedule"] = self.schedule.abstract()
         if self.llm_available():
             des["llm"] = self._llm.get_summary()
+            if self._prefetch_llm:
+                des["prefetch_llm"] = self._prefetch_llm.get_summary()
         # if self.plan.get("path"):
         #     des["path"] = "-".join(
         #         ["{},{}".format(c[0], c[1]) for c in self.plan["path"]]
@@ -89,17 +103,33 @@ class Agent:
         if not self._llm:
             self._llm = create_llm_model(self.think_config["llm"])
 
+    def close(self):
+        """Drop the prefetched schedule and stop the prefetch thread"""
+
+        if self._prefetch:
+            self._prefetch[2].cancel()
+            self._prefetch = None
+        if self._prefetch_executor:
+            self._prefetch_executor.shutdown(wait=False, cancel_futures=True)
+            self._prefetch_executor = None
+
     def completion(self, func_hint, *args, **kwargs):
+        return self._completion(self.scratch, func_hint, *args, **kwargs)
+
+    def _completion(self, scratch, func_hint, *args, llm=None, **kwargs):
         assert hasattr(
-            self.scratch, "prompt_" + func_hint
+            scratch, "prompt_" + func_hint
         ), "Can not find func prompt_{} from scratch".format(func_hint)
-        func = getattr(self.scratch, "prompt_" + func_hint)
+        func = getattr(scratch, "prompt_" + func_hint)
         prompt = func(*args, **kwargs)
         title, msg = "{}.{}".format(self.name, func_hint), {}
         if self.llm_available():
-            self.logger.info("{} -> {}".format(self.name, func_hint))
-            output = self._llm.completion(**prompt, caller=func_hint)
-            responses = self._llm.meta_responses
+            tokens = estimate_tokens(prompt["prompt"])
+            self.logger.info("{} -> {} (~{} tokens)".format(self.name, func_hint, tokens))
+            llm = llm or self._llm
+            with utils.trace_span("completion." + func_hint, "llm", agent=self.name, tokens=tokens):
+                output = llm.completion(**prompt, caller=func_hint)
+            responses = llm.meta_responses
             msg = {"<PROMPT>": "\n" + prompt["prompt"] + "\n"}
             msg.update(
                 {
@@ -138,11 +168,31 @@ class Agent:
         if self.is_awake():
             self.percept()
             self.make_plan(agents)
+            if self._chat_request:
+                # 对话在所有Agent思考结束后依次进行，反思及后续规划在对话之后完成
+                self._chat_request["events"] = events
+                return None
             self.reflect()
         else:
             if self.action.finished():
                 self.action = self._determine_action()
+            self._prefetch_schedule()
+        return self._update_plan(events, agents)
+
+    def resume_think(self, agents, chatted):
+        """Finish the think deferred by a chat request, chatted tells if the agent took part in a chat
+
+        When the request is dropped (the other agent chatted with someone else),
+        the agent falls back to waiting for the other agent or its planned action.
+        """
 
+        request, self._chat_request = self._chat_request, None
+        if not chatted and not self._wait_other(request["other"], request["focus"]):
+            self._plan_action()
+        self.reflect()
+        return self._update_plan(request["events"], agents)
+
+    def _update_plan(self, events, agents):
         emojis = {}
         if self.action:
             emojis[self.name] = {"emoji": self.get_event().emoji, "coord": self.coord}
@@ -157,6 +207,15 @@ class Agent:
         }
         return self.plan
 
+    def replan(self, agents):
+        """Update the path and emoji of the plan after the action is revised by a chat"""
+
+        if self.action:
+            self.plan["emojis"][self.name] = {"emoji": self.get_event().emoji, "coord": self.coord}
+        self.plan["path"] = self.find_path(agents)
+        return self.plan
+
+    @utils.traced()
     def move(self, coord, path=None):
         events = {}
 
@@ -164,20 +223,19 @@ class Agent:
             tile = self.maze.tile_at(coord)
             if not self.action:
                 return {}
-            if not tile.update_events(self.get_event()):
-                tile.add_event(self.get_event())
+            self.maze.put_event(coord, self.get_event(), owner=self.name)
             obj_event = self.get_event(False)
             if obj_event:
-                self.maze.update_obj(coord, obj_event)
+                self.maze.update_obj(coord, obj_event, owner=self.name)
             return {e: coord for e in tile.get_events()}
 
         if self.coord and self.coord != coord:
             tile = self.get_tile()
-            tile.remove_events(subject=self.name)
+            self.maze.remove_events(self.coord, subject=self.name, owner=self.name)
             if tile.has_address("game_object"):
                 addr = tile.get_address("game_object")
                 self.maze.update_obj(
-                    self.coord, memory.Event(addr[-1], address=addr)
+                    self.coord, memory.Event(addr[-1], address=addr), owner=self.name
                 )
             events.update({e: self.coord for e in tile.get_events()})
         if not path:
@@ -187,68 +245,14 @@ class Agent:
 
         return events
 
+    @utils.traced()
     def make_schedule(self):
         if not self.schedule.scheduled():
             self.logger.info("{} is making schedule...".format(self.name))
-            # update currently
-            if self.associate.index.nodes_num > 0:
-                self.associate.cleanup_index()
-                focus = [
-                    f"{self.name} 在 {utils.get_timer().daily_format_cn()} 的计划。",
-                    f"在 {self.name} 的生活中，重要的近期事件。",
-                ]
-                retrieved = self.associate.retrieve_focus(focus)
-                self.logger.info(
-                    "{} retrieved {} concepts".format(self.name, len(retrieved))
-                )
-                if retrieved:
-                    plan = self.completion("retrieve_plan", retrieved)
-                    thought = self.completion("retrieve_thought", retrieved)
-                    self.scratch.currently = self.completion(
-                        "retrieve_currently", plan, thought
-                    )
-            # make init schedule
-            self.schedule.create = utils.get_timer().get_date()
-            wake_up = self.completion("wake_up")
-            init_schedule = self.completion("schedule_init", wake_up)
-            # make daily schedule
-            hours = [f"{i}:00" for i in range(24)]
-            # seed = [(h, "sleeping") for h in hours[:wake_up]]
-            seed = [(h, "睡觉") for h in hours[:wake_up]]
-            seed += [(h, "") for h in hours[wake_up:]]
-            schedule = {}
-            for _ in range(self.schedule.max_try):
-                schedule = {h: s for h, s in seed[:wake_up]}
-                schedule.update(
-                    self.completion("schedule_daily", wake_up, init_schedule)
-                )
-                if len(set(schedule.values())) >= self.schedule.diversity:
-                    break
-
-            def _to_duration(date_str):
-                return utils.daily_duration(utils.to_date(date_str, "%H:%M"))
-
-            schedule = {_to_duration(k): v for k, v in schedule.items()}
-            starts = list(sorted(schedule.keys()))
-            for idx, start in enumerate(starts):
-                end = starts[idx + 1] if idx + 1 < len(starts) else 24 * 60
-                self.schedule.add_plan(schedule[start], end - start)
-            schedule_time = utils.get_timer().time_format_cn(self.schedule.create)
-            thought = "这是 {} 在 {} 的计划：{}".format(
-                self.name, schedule_time, "；".join(init_schedule)
-            )
-            event = memory.Event(
-                self.name,
-                "计划",
-                schedule_time,
-                describe=thought,
-                address=self.get_tile().get_address(),
-            )
-            self._add_concept(
-                "thought",
-                event,
-                expire=self.schedule.create + datetime.timedelta(days=30),
-            )
+            draft = self._take_prefetched_schedule()
+            if not draft:
+                draft = self._draft_schedule(self._retrieve_schedule_focus())
+            self._commit_schedule(draft)
         # decompose current plan
         plan, _ = self.schedule.current_plan()
         if self.schedule.decompose(plan):
@@ -277,6 +281,7 @@ class Agent:
                 "schedule_revise", self.action, self.schedule
             )
 
+    @utils.traced()
     def percept(self):
         scope = self.maze.get_scope(self.coord, self.percept_config)
         # add spatial memory
@@ -294,31 +299,40 @@ class Agent:
                     events[event] = dist
         events = list(sorted(events.keys(), key=lambda k: events[k]))
         # get concepts
-        self.concepts, valid_num = [], 0
+        recent_nodes = (
+            self.associate.retrieve_events() + self.associate.retrieve_chats()
+        )
+        recent_nodes = set(n.describe for n in recent_nodes)
+        self.concepts, pending = [], []
         for idx, event in enumerate(events[: self.percept_config["att_bandwidth"]]):
-            recent_nodes = (
-                self.associate.retrieve_events() + self.associate.retrieve_chats()
-            )
-            recent_nodes = set(n.describe for n in recent_nodes)
-            if event.get_describe() not in recent_nodes:
-                if event.object == "idle" or event.object == "空闲":
-                    node = Concept.from_event(
-                        "idle_" + str(idx), "event", event, poignancy=1
-                    )
-                else:
-                    valid_num += 1
-                    node_type = "chat" if event.fit(self.name, "对话") else "event"
-                    node = self._add_concept(node_type, event)
-                    self.status["poignancy"] += node.poignancy
-                self.concepts.append(node)
+            if event.get_describe() in recent_nodes:
+                continue
+            if event.object == "idle" or event.object == "空闲":
+                self.concepts.append(
+                    Concept.from_event("idle_" + str(idx), "event", event, poignancy=1)
+                )
+            else:
+                recent_nodes.add(event.get_describe())
+                node_type = "chat" if event.fit(self.name, "对话") else "event"
+                pending.append((len(self.concepts), node_type, event))
+                self.concepts.append(None)
+        scores = self._score_poignancy([(t, e) for _, t, e in pending])
+        for (pos, node_type, event), score in zip(pending, scores):
+            node = self._add_concept(node_type, event, poignancy=score)
+            self.status["poignancy"] += node.poignancy
+            self.concepts[pos] = node
         self.concepts = [c for c in self.concepts if c.event.subject != self.name]
         self.logger.info(
-            "{} percept {}/{} concepts".format(self.name, valid_num, len(self.concepts))
+            "{} percept {}/{} concepts".format(self.name, len(pending), len(self.concepts))
         )
 
+    @utils.traced()
     def make_plan(self, agents):
         if self._reaction(agents):
             return
+        self._plan_action()
+
+    def _plan_action(self):
         if self.path:
             return
         if self.action.finished():
@@ -341,6 +355,7 @@ class Agent:
         )
         return event
 
+    @utils.traced()
     def reflect(self):
         def _add_thought(thought, evidence=None):
             # event = self.completion(
@@ -392,6 +407,7 @@ class Agent:
         self.status["poignancy"] = 0
         self.chats = []
 
+    @utils.traced()
     def find_path(self, agents):
         address = self.get_event().address
         if self.path:
@@ -430,6 +446,9 @@ class Agent:
         plan, de_plan = self.schedule.current_plan()
         describes = [plan["describe"], de_plan["describe"]]
         address = self.spatial.find_address(describes[0], as_list=True)
+        if not address:
+            # 重复的活动直接使用之前决定的地点
+            address = self.decision.lookup(describes, self.spatial, self.associate.index.embed)
         if not address:
             tile = self.get_tile()
             kwargs = {
@@ -451,6 +470,8 @@ class Agent:
             elif len(objs) > 1:
                 kwargs["address"].append(self.completion("determine_object", **kwargs))
             address = kwargs["address"]
+            if self.spatial.has_address(address):
+                self.decision.add(describes, address)
 
         event = self.make_event(self.name, describes[-1], address)
         obj_describe = self.completion("describe_object", address[-1], describes[-1])
@@ -532,74 +553,9 @@ class Agent:
         if not self.completion("decide_chat", self, other, focus, chats):
             return False
 
-        self.logger.info("{} decides chat with {}".format(self.name, other.name))
-        start, chats = utils.get_timer().get_date(), []
-        relations = [
-            self.completion("summarize_relation", self, other.name),
-            other.completion("summarize_relation", other, self.name),
-        ]
-
-        for i in range(self.chat_iter):
-            text = self.completion(
-                "generate_chat", self, other, relations[0], chats
-            )
-
-            if i > 0:
-                # 对于发起对话的Agent，从第2轮对话开始，检查是否出现“复读”现象
-                end = self.completion(
-                    "generate_chat_check_repeat", self, chats, text
-                )
-                if end:
-                    break
-
-                # 对于发起对话的Agent，从第2轮对话开始，检查话题是否结束
-                chats.append((self.name, text))
-                end = self.completion(
-                    "decide_chat_terminate", self, other, chats
-                )
-                if end:
-                    break
-            else :
-                chats.append((self.name, text))
-
-            text = other.completion(
-                "generate_chat", other, self, relations[1], chats
-            )
-            if i > 0:
-                # 对于响应对话的Agent，从第2轮开始，检查是否出现“复读”现象
-                end = self.completion(
-                    "generate_chat_check_repeat", other, chats, text
-                )
-                if end:
-                    break
-
-            chats.append((other.name, text))
-
-            # 对于响应对话的Agent，从第1轮开始，检查话题是否结束
-            end = other.completion(
-                "decide_chat_terminate", other, self, chats
-            )
-            if end:
-                break
-
-        key = utils.get_timer().get_date("%Y%m%d-%H:%M")
-        if key not in self.conversation.keys():
-            self.conversation[key] = []
-        self.conversation[key].append({f"{self.name} -> {other.name} @ {'，'.join(self.get_event().address)}": chats})
-
-        self.logger.info(
-            "{} and {} has chats\n  {}".format(
-                self.name,
-                other.name,
-                "\n  ".join(["{}: {}".format(n, c) for n, c in chats]),
-            )
-        )
-        chat_summary = self.completion("summarize_chats", chats)
-        duration = int(sum([len(c[1]) for c in chats]) / 240)
-        self.schedule_chat(
-            chats, chat_summary, start, duration, other
-        )
-        other.schedule_chat(chats, chat_summary, start, duration, self)
+        # 对话会同时修改双方的状态，先记录请求，在所有Agent思考结束后统一进行
+        other.request_chat(self)
+        self._chat_request = {"other": other, "focus": focus}
         return True
 
     def _wait_other(self, other, focus):
@@ -645,15 +601,14 @@ class Agent:
         create=None,
         expire=None,
         filling=None,
+        poignancy=None,
     ):
         if event.fit(None, "is", "idle"):
             poignancy = 1
         elif event.fit(None, "此时", "空闲"):
             poignancy = 1
-        elif e_type == "chat":
-            poignancy = self.completion("poignancy_chat", event)
-        else:
-            poignancy = self.completion("poignancy_event", event)
+        elif poignancy is None:
+            poignancy = self._score_poignancy([(e_type, event)])[0]
         self.logger.debug("{} add associate {}".format(self.name, event))
         return self.associate.add_node(
             e_type,
@@ -664,6 +619,161 @@ class Agent:
             filling=filling,
         )
 
+    def _retrieve_schedule_focus(self, read_only=False):
+        if self.associate.index.nodes_num == 0:
+            return []
+        if not read_only:
+            self.associate.cleanup_index()
+        focus = [
+            f"{self.name} 在 {utils.get_timer().daily_format_cn()} 的计划。",
+            f"在 {self.name} 的生活中，重要的近期事件。",
+        ]
+        retrieved = self.associate.retrieve_focus(focus, read_only=read_only)
+        self.logger.info("{} retrieved {} concepts".format(self.name, len(retrieved)))
+        return retrieved
+
+    def _draft_schedule(self, retrieved, llm=None):
+        """Draft the schedule of the day, the agent is only updated when the draft is committed"""
+
+        scratch = copy.copy(self.scratch)
+        # update currently
+        if retrieved:
+            plan = self._completion(scratch, "retrieve_plan", retrieved, llm=llm)
+            thought = self._completion(scratch, "retrieve_thought", retrieved, llm=llm)
+            scratch.currently = self._completion(
+                scratch, "retrieve_currently", plan, thought, llm=llm
+            )
+        # make init schedule
+        create = utils.get_timer().get_date()
+        wake_up = self._completion(scratch, "wake_up", llm=llm)
+        init_schedule = self._completion(scratch, "schedule_init", wake_up, llm=llm)
+        # make daily schedule
+        hours = [f"{i}:00" for i in range(24)]
+        # seed = [(h, "sleeping") for h in hours[:wake_up]]
+        seed = [(h, "睡觉") for h in hours[:wake_up]]
+        seed += [(h, "") for h in hours[wake_up:]]
+        schedule = {}
+        for _ in range(self.schedule.max_try):
+            schedule = {h: s for h, s in seed[:wake_up]}
+            schedule.update(
+                self._completion(scratch, "schedule_daily", wake_up, init_schedule, llm=llm)
+            )
+            if len(set(schedule.values())) >= self.schedule.diversity:
+                break
+        return {
+            "create": create,
+            "currently": scratch.currently,
+            "init_schedule": init_schedule,
+            "schedule": schedule,
+        }
+
+    def _commit_schedule(self, draft):
+        self.scratch.currently = draft["currently"]
+        self.schedule.create = draft["create"]
+
+        def _to_duration(date_str):
+            return utils.daily_duration(utils.to_date(date_str, "%H:%M"))
+
+        schedule = {_to_duration(k): v for k, v in draft["schedule"].items()}
+        starts = list(sorted(schedule.keys()))
+        for idx, start in enumerate(starts):
+            end = starts[idx + 1] if idx + 1 < len(starts) else 24 * 60
+            self.schedule.add_plan(schedule[start], end - start)
+        schedule_time = utils.get_timer().time_format_cn(self.schedule.create)
+        thought = "这是 {} 在 {} 的计划：{}".format(
+            self.name, schedule_time, "；".join(draft["init_schedule"])
+        )
+        event = memory.Event(
+            self.name,
+            "计划",
+            schedule_time,
+            describe=thought,
+            address=self.get_tile().get_address(),
+        )
+        self._add_concept(
+            "thought",
+            event,
+            expire=self.schedule.create + datetime.timedelta(days=30),
+        )
+
+    def _prefetch_schedule(self):
+        """Draft the schedule of the next day in background while the agent sleeps through the midnight"""
+
+        config = self.think_config.get("prefetch", {})
+        if not config.get("enable") or self._prefetch or not self.schedule.scheduled():
+            return
+        # 使用cassette时后台调用的顺序不确定，不进行预取
+        if get_cassette():
+            return
+        plan, _ = self.schedule.current_plan()
+        if plan["idx"] != len(self.schedule.daily_schedule) - 1:
+            return
+        midnight = utils.get_timer().daily_time(24 * 60)
+        timer = utils.Timer(midnight.strftime("%Y%m%d-%H:%M"))
+        self.logger.info("{} is prefetching schedule of {}...".format(self.name, midnight.date()))
+        # 在当前线程中只读地检索记忆作为快照，后台线程只调用LLM，不访问Agent的记忆
+        with utils.use_timer(timer):
+            retrieved = self._retrieve_schedule_focus(read_only=True)
+        snapshot = set(n for nodes in self.associate.memory.values() for n in nodes)
+        # 后台线程使用单独的模型实例，避免与当前线程的调用共用meta_responses及统计
+        if self.llm_available() and not self._prefetch_llm:
+            self._prefetch_llm = create_llm_model(self.think_config["llm"])
+
+        def _draft():
+            with utils.use_timer(timer):
+                return self._draft_schedule(retrieved, self._prefetch_llm)
+
+        if not self._prefetch_executor:
+            self._prefetch_executor = ThreadPoolExecutor(max_workers=1)
+        self._prefetch = (midnight, snapshot, self._prefetch_executor.submit(_draft))
+
+    def _take_prefetched_schedule(self):
+        if not self._prefetch:
+            return None
+        (midnight, snapshot, future), self._prefetch = self._prefetch, None
+        if midnight.date() != utils.get_timer().get_date().date():
+            future.cancel()
+            return None
+        try:
+            draft = future.result()
+        except Exception as e:  # pylint: disable=broad-except
+            self.logger.warning("{} failed to prefetch schedule: {}".format(self.name, e))
+            return None
+        # 预取后有重要的新记忆时，重新生成日程
+        min_poignancy = self.think_config.get("prefetch", {}).get("min_poignancy", 5)
+        for n_type, nodes in self.associate.memory.items():
+            for node_id in nodes:
+                if node_id in snapshot:
+                    continue
+                if self.associate.find_concept(node_id).poignancy >= min_poignancy:
+                    self.logger.info("{} drops prefetched schedule for new memories".format(self.name))
+                    return None
+        self.logger.info("{} uses prefetched schedule".format(self.name))
+        return draft
+
+    def _score_poignancy(self, events):
+        """Score the poignancy of [(e_type, event)], the events similar to the memory are estimated locally"""
+
+        estimates = [
+            self.associate.estimate_poignancy(e_type, event.get_describe())
+            for e_type, event in events
+        ]
+        scores = [e if kind == "hit" else None for e, kind in estimates]
+        novel = [i for i, s in enumerate(scores) if s is None]
+        # 启用poignancy_batch时新的事件通过一次调用统一评分，解析失败时退回到逐个评分
+        if len(novel) > 1 and self.think_config.get("poignancy_batch"):
+            batch = self.completion("poignancy_batch", [events[i] for i in novel])
+            for i, score in zip(novel, batch or []):
+                scores[i] = score
+        for i in novel:
+            e_type, event = events[i]
+            if scores[i] is None:
+                hint = "poignancy_chat" if e_type == "chat" else "poignancy_event"
+                scores[i] = self.completion(hint, event)
+            if self.llm_available():
+                self.associate.observe_poignancy(*estimates[i], scores[i])
+        return scores
+
     def get_tile(self):
         return self.maze.tile_at(self.coord)
 
@@ -679,6 +789,39 @@ class Agent:
             return False
         return True
 
+    def next_due(self):
+        """The time when the sleeping agent needs to think again, None for now"""
+
+        if self.is_awake():
+            return None
+        return self._action_due()
+
+    def idle_until(self, agents):
+        """The time until which nothing is likely to happen to the agent, None for now"""
+
+        address = self.get_event().address
+        if address and address[0] in ("<waiting>", "<persona>"):
+            return None
+        if self.is_awake():
+            # 视野内有其他醒着的Agent时，可能发生对话或反应
+            vision_r = self.percept_config["vision_r"]
+            for name, other in agents.items():
+                if name == self.name or not other.is_awake():
+                    continue
+                if all(abs(c - o_c) <= vision_r for c, o_c in zip(self.coord, other.coord)):
+                    return None
+        return self._action_due()
+
+    def _action_due(self):
+        if self.action.finished() or not self.schedule.scheduled():
+            return None
+        plan, _ = self.schedule.current_plan()
+        # 行动结束或日程切换（包括跨天）时需要重新思考
+        due = min(self.action.end, utils.get_timer().daily_time(plan["start"] + plan["duration"]))
+        if due <= utils.get_timer().get_date():
+            return None
+        return due
+
     def llm_available(self):
         if not self._llm:
             return False
@@ -688,6 +831,7 @@ class Agent:
         info = {
             "status": self.status,
             "schedule": self.schedule.to_dict(),
+            "decision": self.decision.to_dict(),
             "associate": self.associate.to_dict(),
             "chats": self.chats,
             "currently": self.scratch.currently,
@@ -695,3 +839,134 @@ class Agent:
         if with_action:
             info.update({"action": self.action.to_dict()})
         return info
+
+
+def agent_state(agent):
+    """The state of agent read by the other agents and shards"""
+
+    return {
+        "coord": agent.coord,
+        "path": agent.path,
+        "action": agent.action.to_dict(),
+        "schedule": agent.schedule.to_dict(),
+        "think_config": agent.think_config,
+        "percept_config": agent.percept_config,
+        "chat_iter": agent.chat_iter,
+    }
+
+
+class AgentView:
+    """Read-only copy of an agent, seen by the other agents during a step"""
+
+    def __init__(self, name, maze):
+        self.name = name
+        self.maze = maze
+        # 其他Agent发起的对话请求，在所有Agent思考结束后依次进行
+        self.requests = []
+        self.coord, self.path = None, []
+        self.action, self.schedule = None, None
+        self.think_config, self.chat_iter = {}, 0
+
+    @classmethod
+    def snapshot(cls, agent):
+        view = cls(agent.name, agent.maze)
+        view.update(agent_state(agent))
+        return view
+
+    def update(self, state):
+        state = copy.deepcopy(state)
+        self.coord, self.path = state["coord"], state["path"]
+        self.action = memory.Action.from_dict(state["action"])
+        self.schedule = memory.Schedule(**state["schedule"])
+        self.think_config, self.chat_iter = state["think_config"], state["chat_iter"]
+
+    def request_chat(self, agent):
+        self.requests.append((agent.name, self.name, agent.chat_iter))
+
+    get_tile = Agent.get_tile
+    get_event = Agent.get_event
+    is_awake = Agent.is_awake
+    next_due = Agent.next_due
+    _action_due = Agent._action_due
+
+
+def run_chat(agent, other, chat_iter, conversation, logger):
+    """Run the conversation between agent and other, agents can be shard handles"""
+
+    logger.info("{} decides chat with {}".format(agent.name, other.name))
+    start, chats = utils.get_timer().get_date(), []
+    relations = [
+        agent.completion("summarize_relation", agent, other.name),
+        other.completion("summarize_relation", other, agent.name),
+    ]
+
+    for i in range(chat_iter):
+        # 对于发起对话的Agent，从第2轮对话开始，检查是否出现“复读”现象以及话题是否结束
+        text, repeat, end = _chat_turn(agent, other, relations[0], chats, i > 0, i > 0)
+        if repeat:
+            break
+        chats.append((agent.name, text))
+        if end:
+            break
+
+        # 对于响应对话的Agent，从第2轮开始检查是否出现“复读”现象，从第1轮开始检查话题是否结束
+        text, repeat, end = _chat_turn(other, agent, relations[1], chats, i > 0, True, checker=agent)
+        if repeat:
+            break
+        chats.append((other.name, text))
+        if end:
+            break
+
+    key = utils.get_timer().get_date("%Y%m%d-%H:%M")
+    conversation.setdefault(key, []).append({f"{agent.name} -> {other.name} @ {'，'.join(agent.get_event().address)}": chats})
+
+    logger.info(
+        "{} and {} has chats\n  {}".format(
+            agent.name,
+            other.name,
+            "\n  ".join(["{}: {}".format(n, c) for n, c in chats]),
+        )
+    )
+    chat_summary = agent.completion("summarize_chats", chats)
+    duration = int(sum([len(c[1]) for c in chats]) / 240)
+    agent.schedule_chat(
+        chats, chat_summary, start, duration, other
+    )
+    other.schedule_chat(chats, chat_summary, start, duration, agent)
+    return chats
+
+
+def run_chats(requests, agents, conversation, logger):
+    """Run the requested chats one by one, agents chat at most once in a step
+
+    The requests involving an agent that has chatted are dropped, their
+    initiators fall back to waiting or the planned action in resume_think.
+    """
+
+    # 按发起者排序，保证对话的顺序与Agent的思考顺序无关
+    chatted = set()
+    for a_name, o_name, chat_iter in sorted(requests):
+        if a_name in chatted or o_name in chatted:
+            continue
+        run_chat(agents[a_name], agents[o_name], chat_iter, conversation, logger)
+        chatted.update([a_name, o_name])
+    return chatted
+
+
+def _chat_turn(speaker, listener, relation, chats, check_repeat, check_end, checker=None):
+    """Generate the words of speaker, return the words, whether they repeat and whether the chat ends after them"""
+
+    if speaker.think_config.get("fused_chat"):
+        # 一次调用同时生成对话内容并判断是否“复读”及话题是否结束，解析失败时退回到逐个调用
+        turn = speaker.completion("generate_chat_turn", speaker, listener, relation, chats)
+        if turn:
+            text, repeat, end = turn
+            return text, check_repeat and repeat, check_end and end
+
+    text = speaker.completion("generate_chat", speaker, listener, relation, chats)
+    if check_repeat and (checker or speaker).completion("generate_chat_check_repeat", speaker, chats, text):
+        return text, True, False
+    if check_end:
+        end = speaker.completion("decide_chat_terminate", speaker, listener, chats + [(speaker.name, text)])
+        return text, False, end
+    return text, False, False
@@ -5,8 +5,10 @@ import copy
 
 from modules.utils import GenerativeAgentsMap, GenerativeAgentsKey
 from modules import utils
+from modules.model.cassette import get_cassette
+from modules.storage.batcher import flush_embedding_batchers
 from .maze import Maze
-from .agent import Agent
+from .agent import Agent, AgentView, run_chats
 
 
 class Game:
@@ -39,9 +41,62 @@ class Game:
     def get_agent(self, name):
         return self.agents[name]
 
-    def agent_think(self, name, status):
+    def agents_think(self, status, pool=None):
+        """Think for all agents, concurrently when a worker pool is given"""
+
+        if get_cassette():
+            get_cassette().seed_random(utils.get_timer().get_date("%Y%m%d-%H:%M"))
+        views = self.begin_step()
+        try:
+            if pool:
+                futures = {n: pool.submit(self.agent_think, n, s, views) for n, s in status.items()}
+                plans = {n: f.result() for n, f in futures.items()}
+            else:
+                plans = {n: self.agent_think(n, s, views) for n, s in status.items()}
+            # 对话会同时修改双方的状态，在所有Agent思考结束后依次进行
+            chatted = run_chats(self.pop_chat_requests(views), self.agents, self.conversation, self.logger)
+            resumed = [n for n, p in plans.items() if p is None]
+            if pool:
+                futures = {n: pool.submit(self.agent_resume, n, views, n in chatted) for n in resumed}
+                plans.update({n: f.result() for n, f in futures.items()})
+            else:
+                plans.update({n: self.agent_resume(n, views, n in chatted) for n in resumed})
+            for name in chatted:
+                if name in plans and name not in resumed:
+                    plans[name] = self.get_agent(name).replan(views)
+        finally:
+            self.maze.commit()
+        # step结束时发送所有agent尚未计算的embedding
+        flush_embedding_batchers()
+        return {n: self.agent_result(n, p) for n, p in plans.items()}
+
+    def begin_step(self):
+        """Freeze the maze and the agents, the step is independent of the order in which agents think"""
+
+        # 思考期间其他Agent只能读到step开始时的状态，移动及物体事件在commit阶段按owner顺序生效
+        self.maze.begin_step()
+        return {
+            n: a if isinstance(a, AgentView) else AgentView.snapshot(a)
+            for n, a in self.agents.items()
+        }
+
+    def agent_think(self, name, status, agents):
+        with utils.trace_span("agent_think", agent=name):
+            return self.get_agent(name).think(status, agents)
+
+    def agent_resume(self, name, agents, chatted):
+        with utils.trace_span("agent_resume", agent=name):
+            return self.get_agent(name).resume_think(agents, chatted)
+
+    def pop_chat_requests(self, views):
+        requests = []
+        for view in views.values():
+            requests.extend(view.requests)
+            view.requests = []
+        return requests
+
+    def agent_result(self, name, plan):
         agent = self.get_agent(name)
-        plan = agent.think(status, self.agents)
         info = {
             "currently": agent.scratch.currently,
             "associate": agent.associate.abstract(),
@@ -78,6 +133,10 @@ class Game:
             title = "{}.reset".format(a_name)
             self.logger.info("\n{}\n{}\n".format(utils.split_line(title), agent))
 
+    def close(self):
+        for agent in self.agents.values():
+            agent.close()
+
 
 def create_game(name, static_root, config, conversation, logger=None):
     """Create the game"""
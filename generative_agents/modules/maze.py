@@ -131,6 +131,8 @@ class Maze:
                     self.address_tiles.setdefault(add, set()).add((j, i))
 
         self.logger = logger
+        # 两阶段更新：begin_step之后对Tile事件的修改先按Agent缓存，commit时统一生效
+        self._pending = None
 
     def find_path(self, src_coord, dst_coord):
         map = [[0 for _ in range(self.maze_width)] for _ in range(self.maze_height)]
@@ -163,7 +165,54 @@ class Maze:
     def tile_at(self, coord):
         return self.tiles[coord[1]][coord[0]]
 
-    def update_obj(self, coord, obj_event):
+    def begin_step(self):
+        """Buffer the event updates, agents perceive a frozen maze until commit"""
+
+        self._pending = {}
+
+    def pending(self):
+        """Get the buffered updates, grouped by owner"""
+
+        return dict(self._pending or {})
+
+    def commit(self, pending=None):
+        """Apply the buffered updates (or the given ones) in a deterministic order"""
+
+        if pending is None:
+            pending = self._pending or {}
+        self._pending = None
+        ops = [op for owner in sorted(pending, key=str) for op in pending[owner]]
+        for op in ops:
+            self._apply(*op)
+        return ops
+
+    def _record(self, owner, op):
+        if self._pending is None:
+            self._apply(*op)
+        else:
+            # 每个Agent只写入自己的队列，无需加锁
+            self._pending.setdefault(owner, []).append(op)
+
+    def _apply(self, method, coord, *args):
+        if method == "put_event":
+            tile = self.tile_at(coord)
+            if not tile.update_events(args[0]):
+                tile.add_event(args[0])
+        elif method == "remove_events":
+            self.tile_at(coord).remove_events(subject=args[0])
+        elif method == "update_obj":
+            self._update_obj(coord, args[0])
+
+    def put_event(self, coord, event, owner=None):
+        self._record(owner, ("put_event", coord, event))
+
+    def remove_events(self, coord, subject, owner=None):
+        self._record(owner, ("remove_events", coord, subject))
+
+    def update_obj(self, coord, obj_event, owner=None):
+        self._record(owner, ("update_obj", coord, obj_event))
+
+    def _update_obj(self, coord, obj_event):
         tile = self.tile_at(coord)
         if not tile.has_address("game_object"):
             return
@@ -2,6 +2,7 @@
 
 from .action import *
 from .associate import *
+from .decision import *
 from .event import *
 from .schedule import *
 from .spatial import *
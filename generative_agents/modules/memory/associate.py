@@ -1,9 +1,9 @@
 """generative_agents.memory.associate"""
 
+import random
 import datetime
-from llama_index.core.retrievers import BaseRetriever
+import numpy as np
 from llama_index.core.vector_stores import MetadataFilters, ExactMatchFilter
-from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
 
 from modules.storage.index import LlamaIndex
 from modules import utils
@@ -73,51 +73,77 @@ class Concept:
         )
 
 
-class AssociateRetriever(BaseRetriever):
-    def __init__(self, config, *args, **kwargs) -> None:
-        self._config = config
-        self._vector_retriever = VectorIndexRetriever(*args, **kwargs)
-        super().__init__()
+def _normalize(data, factor=1, t_min=0, t_max=1):
+    """Normalize the vector, or each column of the matrix, into [t_min, t_max] * factor"""
 
-    def _retrieve(self, query_bundle):
-        """Retrieve nodes given query."""
+    min_val, max_val = data.min(axis=0), data.max(axis=0)
+    diff = max_val - min_val
+    scaled = (data - min_val) * (t_max - t_min) * factor / np.where(diff == 0, 1, diff) + t_min
+    return np.where(diff == 0, (t_max - t_min) * factor / 2, scaled)
 
-        nodes = self._vector_retriever.retrieve(query_bundle)
-        if not nodes:
-            return []
-        nodes = sorted(
-            nodes, key=lambda n: utils.to_date(n.metadata["access"]), reverse=True
-        )
-        # get scores
-        fac = self._config["recency_decay"]
-        recency_scores = self._normalize(
-            [fac**i for i in range(1, len(nodes) + 1)], self._config["recency_weight"]
-        )
-        relevance_scores = self._normalize(
-            [n.score for n in nodes], self._config["relevance_weight"]
-        )
-        importance_scores = self._normalize(
-            [n.metadata["poignancy"] for n in nodes], self._config["importance_weight"]
-        )
-        final_scores = {
-            n.id_: r1 + r2 + i
-            for n, r1, r2, i in zip(
-                nodes, recency_scores, relevance_scores, importance_scores
-            )
-        }
-        # re-rank nodes
-        nodes = sorted(nodes, key=lambda n: final_scores[n.id_], reverse=True)
-        nodes = nodes[: self._config["retrieve_max"]]
-        for n in nodes:
-            n.metadata["access"] = utils.get_timer().get_date("%Y%m%d-%H:%M:%S")
-        return nodes
 
-    def _normalize(self, data, factor=1, t_min=0, t_max=1):
-        min_val, max_val = min(data), max(data)
-        diff = max_val - min_val
-        if diff == 0:
-            return [(t_max - t_min) * factor / 2 for _ in data]
-        return [(d - min_val) * (t_max - t_min) * factor / diff + t_min for d in data]
+class PoignancyEstimator:
+    """Estimate the poignancy of an event from the similar nodes in the memory
+
+    The estimate is the similarity-weighted poignancy of the neighbors above
+    min_similarity. It is confident when there are at least min_neighbors such
+    neighbors and their poignancy differs by at most max_spread. A ratio of the
+    confident estimates is audited by the llm to measure the estimator error.
+    """
+
+    def __init__(
+        self,
+        enable=True,
+        top_k=5,
+        min_similarity=0.9,
+        min_neighbors=2,
+        max_spread=2,
+        audit=0.1,
+    ):
+        self.enable = enable
+        self.top_k, self._min_similarity = top_k, min_similarity
+        self._min_neighbors, self._max_spread = min_neighbors, max_spread
+        self._audit = audit
+        # hit: 直接使用估计值；audit: 可信但交给LLM评分以统计误差；novel: 交给LLM评分
+        self._summary = {"hit": 0, "audit": 0, "novel": 0}
+        self._errors = {"audit": [0, 0], "novel": [0, 0]}
+
+    def estimate(self, nodes):
+        """Return the estimate and its kind among hit, audit and novel"""
+
+        close = [n for n in nodes if n.score is not None and n.score >= self._min_similarity]
+        if not close:
+            kind, estimate = "novel", None
+        else:
+            weights = sum(n.score for n in close)
+            estimate = round(sum(n.metadata["poignancy"] * n.score for n in close) / weights)
+            scores = [n.metadata["poignancy"] for n in close]
+            if len(close) < self._min_neighbors or max(scores) - min(scores) > self._max_spread:
+                kind = "novel"
+            elif random.random() < self._audit:
+                kind = "audit"
+            else:
+                kind = "hit"
+        self._summary[kind] += 1
+        return estimate, kind
+
+    def observe(self, estimate, kind, score):
+        """Record the error of the estimate against the score from the llm"""
+
+        if estimate is None or kind not in self._errors:
+            return
+        self._errors[kind][0] += abs(estimate - score)
+        self._errors[kind][1] += 1
+
+    def get_summary(self):
+        total = sum(self._summary.values())
+        des = {
+            "hit": "{}/{}".format(self._summary["hit"], total),
+            "hit_rate": round(self._summary["hit"] / total, 3) if total else 0,
+        }
+        for kind, (error, count) in self._errors.items():
+            des[kind + "_error"] = round(error / count, 3) if count else None
+        return des
 
 
 class Associate:
@@ -133,8 +159,10 @@ class Associate:
         relevance_weight=3,
         importance_weight=2,
         memory=None,
+        estimator=None,
     ):
         self._index = LlamaIndex(embedding, path)
+        self._estimator = PoignancyEstimator(**(estimator or {"enable": False}))
         self.memory = memory or {"event": [], "thought": [], "chat": []}
         self.cleanup_index()
         self.retention = retention
@@ -151,6 +179,12 @@ class Associate:
         des = {"nodes": self._index.nodes_num}
         for t in ["event", "chat", "thought"]:
             des[t] = [self.find_concept(c).describe for c in self.memory[t]]
+        if self._estimator.enable:
+            des["poignancy"] = self._estimator.get_summary()
+        if self._index.embedding_summary:
+            des["embedding_cache"] = self._index.embedding_summary
+        if self._index.batch_summary:
+            des["embedding_batch"] = self._index.batch_summary
         return des
 
     def __str__(self):
@@ -221,24 +255,46 @@ class Associate:
         text = ("对话 " + name) if name else None
         return self._retrieve_nodes("chat", text)
 
-    def retrieve_focus(self, focus, retrieve_max=30, reduce_all=True):
-        def _create_retriever(*args, **kwargs):
-            self._retrieve_config["retrieve_max"] = retrieve_max
-            return AssociateRetriever(self._retrieve_config, *args, **kwargs)
+    def retrieve_focus(self, focus, retrieve_max=30, reduce_all=True, read_only=False):
+        """Retrieve the nodes for each focus, ranked by recency, relevance and importance
+
+        With read_only, the access time of the nodes is kept and the nodes out of
+        their lifetime are skipped instead of removed by cleanup_index.
+        """
 
-        retrieved = {}
         node_ids = self.memory["event"] + self.memory["thought"]
-        for text in focus:
-            nodes = self._index.retrieve(
-                text,
-                similarity_top_k=len(node_ids),
-                node_ids=node_ids,
-                retriever_creator=_create_retriever,
+        if read_only:
+            expired = set(self._index.expired_ids())
+            node_ids = [n for n in node_ids if n not in expired]
+        # 所有focus一次完成embedding，并通过一次矩阵运算与所有节点计算相似度
+        ids, relevance, metadata = self._index.similarities(focus, node_ids)
+        retrieved = {} if reduce_all else {text: [] for text in focus}
+        if ids:
+            config = self._retrieve_config
+            access = np.array([utils.to_date(m["access"]).timestamp() for m in metadata])
+            importance = _normalize(
+                np.array([m["poignancy"] for m in metadata], dtype=float), config["importance_weight"]
             )
-            if reduce_all:
-                retrieved.update({n.id_: n for n in nodes})
-            else:
-                retrieved[text] = nodes
+            recency = _normalize(
+                config["recency_decay"] ** np.arange(1, len(ids) + 1), config["recency_weight"]
+            )
+            relevance_scores = _normalize(relevance, config["relevance_weight"])
+            access_date = utils.get_timer().get_date("%Y%m%d-%H:%M:%S")
+            for col, text in enumerate(focus):
+                # 按访问时间排序（相同时按相关度）后计算近因得分
+                order = np.lexsort((-relevance[:, col], -access))
+                scores = recency + relevance_scores[order, col] + importance[order]
+                top = order[np.argsort(-scores, kind="stable")[:retrieve_max]]
+                nodes = []
+                for idx in top:
+                    node = self._index.find_node(ids[idx])
+                    if not read_only:
+                        node.metadata["access"] = access_date
+                    nodes.append(node)
+                if reduce_all:
+                    retrieved.update({n.id_: n for n in nodes})
+                else:
+                    retrieved[text] = nodes
         if reduce_all:
             return [self.to_concept(v) for v in retrieved.values()]
         return {
@@ -246,6 +302,25 @@ class Associate:
             for text, nodes, in retrieved.items()
         }
 
+    def estimate_poignancy(self, node_type, text):
+        """Estimate the poignancy from the memory of node_type, return the estimate and its kind"""
+
+        if not self._estimator.enable or not self.memory[node_type]:
+            return None, "novel"
+        filters = MetadataFilters(
+            filters=[ExactMatchFilter(key="node_type", value=node_type)]
+        )
+        nodes = self._index.retrieve(
+            text,
+            similarity_top_k=self._estimator.top_k,
+            filters=filters,
+            node_ids=self.memory[node_type],
+        )
+        return self._estimator.estimate(nodes)
+
+    def observe_poignancy(self, estimate, kind, score):
+        self._estimator.observe(estimate, kind, score)
+
     def get_relation(self, node):
         return {
             "node": node,
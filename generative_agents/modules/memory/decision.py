@@ -0,0 +1,104 @@
+"""generative_agents.memory.decision"""
+
+import httpx
+import numpy as np
+import ollama
+import openai
+
+
+# 查找相近活动时可以忽略的错误：embedding服务不可用或返回错误，以及embedding维度不一致
+EMBEDDING_ERRORS = (OSError, ValueError, httpx.HTTPError, ollama.ResponseError, openai.OpenAIError)
+
+
+class DecisionCache:
+    """Cache of the addresses decided for the activities
+
+    An activity is looked up by its exact describe first, then by the nearest
+    describe in embedding whose similarity is at least min_similarity. Cached
+    addresses that are not in the spatial tree any more are dropped.
+    """
+
+    def __init__(self, decisions=None, enable=False, min_similarity=0.9, max_entries=200):
+        self.enable = enable
+        self.min_similarity = min_similarity
+        self.max_entries = max_entries
+        self.decisions = decisions or {}
+        # embedding不保存到检查点，恢复后在首次查找时重新计算
+        self._embeddings = {}
+        # 归一化的embedding矩阵，条目变化时重建
+        self._matrix, self._matrix_keys = None, []
+        self._summary = {"exact": 0, "nearest": 0, "miss": 0}
+
+    def abstract(self):
+        total = sum(self._summary.values())
+        return {
+            "entries": len(self.decisions),
+            "hit": "E:{},N:{}/{}".format(self._summary["exact"], self._summary["nearest"], total),
+        }
+
+    def __str__(self):
+        return str(self.abstract())
+
+    @staticmethod
+    def make_key(describes):
+        return "：".join(dict.fromkeys(describes))
+
+    def lookup(self, describes, spatial, embed=None):
+        """Find the address of the activity, embed is the function computing the embedding of a text"""
+
+        if not self.enable:
+            return []
+        for key in [k for k, a in self.decisions.items() if not spatial.has_address(a)]:
+            self._remove(key)
+        key = self.make_key(describes)
+        if key in self.decisions:
+            self._summary["exact"] += 1
+            return list(self.decisions[key])
+        if embed and self.decisions:
+            try:
+                similarity, nearest = self._nearest(key, embed)
+            except EMBEDDING_ERRORS as e:
+                print(f"DecisionCache.lookup() caused an error: {e}")
+                similarity, nearest = 0, None
+            if similarity >= self.min_similarity:
+                self._summary["nearest"] += 1
+                return list(self.decisions[nearest])
+        self._summary["miss"] += 1
+        return []
+
+    def add(self, describes, address):
+        if not self.enable:
+            return
+        key = self.make_key(describes)
+        self.decisions.pop(key, None)
+        self.decisions[key] = list(address)
+        self._matrix = None
+        # 超出容量时淘汰最早加入的条目
+        while len(self.decisions) > self.max_entries > 0:
+            self._remove(next(iter(self.decisions)))
+
+    def _remove(self, key):
+        self.decisions.pop(key, None)
+        self._embeddings.pop(key, None)
+        self._matrix = None
+
+    def _embed(self, key, embed):
+        if key not in self._embeddings:
+            embedding = np.asarray(embed(key), dtype=np.float32)
+            norm = np.linalg.norm(embedding)
+            self._embeddings[key] = embedding / norm if norm > 0 else embedding
+        return self._embeddings[key]
+
+    def _nearest(self, key, embed):
+        """Find the nearest describe of the key, return the cosine similarity and the describe"""
+
+        query = self._embed(key, embed)
+        if self._matrix is None:
+            self._matrix_keys = list(self.decisions)
+            self._matrix = np.stack([self._embed(k, embed) for k in self._matrix_keys])
+        scores = self._matrix @ query
+        idx = int(np.argmax(scores))
+        return float(scores[idx]), self._matrix_keys[idx]
+
+    def to_dict(self):
+        return {"decisions": self.decisions}
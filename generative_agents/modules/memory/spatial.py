@@ -49,6 +49,11 @@ class Spatial:
 
         return _get_tree(address, self.tree)
 
+    def has_address(self, address):
+        if not address:
+            return False
+        return all(address[i] in self.get_leaves(address[:i]) for i in range(len(address)))
+
     def random_address(self):
         address, tree = [], self.tree
         while isinstance(tree, dict):
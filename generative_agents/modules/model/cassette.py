@@ -0,0 +1,113 @@
+"""generative_agents.model.cassette"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+import threading
+
+import numpy as np
+
+from modules.utils.namespace import GenerativeAgentsMap, GenerativeAgentsKey
+
+
+class CassetteMiss(KeyError):
+    """The call is not recorded in the cassette"""
+
+
+class Cassette:
+    """Record/replay store of the llm and embedding calls
+
+    Each call is keyed by the hash of its kind and parameters. The responses are
+    appended to a jsonl file, and the same request made several times is served
+    with the recorded responses in the order of recording. random and numpy are
+    seeded from seed in both modes, so a replay makes the same calls.
+    """
+
+    def __init__(self, path, mode="record", latency=0, seed=0):
+        assert mode in ("record", "replay"), "Unknown cassette mode " + str(mode)
+        self._path = path
+        self._mode = mode
+        self._latency = latency
+        self._seed = seed
+        self._lock = threading.Lock()
+        self._records, self._played = {}, {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._records.setdefault(record["key"], []).append(record["response"])
+        elif mode == "replay":
+            raise FileNotFoundError("Cassette {} doesn't exist".format(path))
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def seed_random(self, salt=""):
+        """Seed random and numpy, salt (e.g. the step time) keeps the draws of each step independent"""
+
+        seed = hashlib.sha1("{}|{}".format(self._seed, salt).encode("utf-8")).digest()
+        random.seed(seed)
+        np.random.seed(int.from_bytes(seed[:4], "little"))
+
+    @staticmethod
+    def make_key(kind, params):
+        params = json.dumps([kind, params], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(params.encode("utf-8")).hexdigest()
+
+    def play(self, kind, params, request):
+        """Serve the call from the cassette, or run the request and record it"""
+
+        key, response = self._lookup(kind, params)
+        if self._mode == "replay":
+            if self._latency > 0:
+                time.sleep(self._latency)
+            return response
+        return self._record(key, request())
+
+    async def aplay(self, kind, params, request):
+        """Async version of play, request is a coroutine function"""
+
+        key, response = self._lookup(kind, params)
+        if self._mode == "replay":
+            if self._latency > 0:
+                await asyncio.sleep(self._latency)
+            return response
+        return self._record(key, await request())
+
+    def _lookup(self, kind, params):
+        key = self.make_key(kind, params)
+        with self._lock:
+            idx = self._played.get(key, 0)
+            self._played[key] = idx + 1
+            responses = self._records.get(key, [])
+        if self._mode != "replay":
+            return key, None
+        if not responses:
+            raise CassetteMiss("{} call {} is not recorded in {}".format(kind, key, self._path))
+        return key, responses[idx % len(responses)]
+
+    def _record(self, key, response):
+        line = json.dumps({"key": key, "response": response}, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._records.setdefault(key, []).append(response)
+            # 单次追加写入，多个分片进程可以共用同一个文件
+            with open(self._path, "a", encoding="utf-8") as f:
+                f.write(line)
+        return response
+
+    @property
+    def config(self):
+        return {"path": self._path, "mode": self._mode, "latency": self._latency, "seed": self._seed}
+
+
+def set_cassette(cassette):
+    cassette.seed_random()
+    GenerativeAgentsMap.set(GenerativeAgentsKey.CASSETTE, cassette)
+    return cassette
+
+
+def get_cassette():
+    return GenerativeAgentsMap.get(GenerativeAgentsKey.CASSETTE)
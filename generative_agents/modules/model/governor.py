@@ -0,0 +1,135 @@
+"""generative_agents.model.governor"""
+
+import time
+import asyncio
+import threading
+import contextlib
+
+
+class Governor:
+    """AIMD governor limiting the concurrent requests to a backend
+
+    The limit grows by 1 every limit successful requests, and is multiplied by
+    decrease when a request fails or its latency is above tolerance times the
+    average latency of its caller, so short and long generations are compared
+    with their own kind. At most one decrease happens within an average latency.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=32, decrease=0.5, tolerance=2.0):
+        self._min_limit, self._max_limit = min_limit, max_limit
+        self._decrease, self._tolerance = decrease, tolerance
+        self._limit = float(max(min(initial, max_limit), min_limit))
+        self._cond = threading.Condition()
+        self._inflight, self._waiting = 0, 0
+        self._latency, self._last_decrease = {}, 0
+        # 等待中的异步请求：事件循环 -> [asyncio.Condition, 等待数]
+        self._async_waiters = {}
+
+    def acquire(self):
+        with self._cond:
+            self._waiting += 1
+            while self._inflight >= int(self._limit):
+                self._cond.wait()
+            self._waiting -= 1
+            self._inflight += 1
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            self._waiting += 1
+            waiter = self._async_waiters.setdefault(loop, [asyncio.Condition(), 0])
+            waiter[1] += 1
+        try:
+            # 与同步请求共用计数，release时唤醒该事件循环中等待的请求
+            async with waiter[0]:
+                while True:
+                    with self._cond:
+                        if self._inflight < int(self._limit):
+                            self._inflight += 1
+                            return
+                    await waiter[0].wait()
+        finally:
+            with self._cond:
+                self._waiting -= 1
+                waiter[1] -= 1
+                if not waiter[1]:
+                    self._async_waiters.pop(loop, None)
+
+    @staticmethod
+    async def _anotify(cond):
+        async with cond:
+            cond.notify_all()
+
+    def release(self, latency=None, error=False, caller=None):
+        with self._cond:
+            self._inflight -= 1
+            self._cond.notify_all()
+            for loop, (cond, _) in self._async_waiters.items():
+                if not loop.is_closed():
+                    asyncio.run_coroutine_threadsafe(self._anotify(cond), loop)
+            if latency is None:
+                return
+            now, baseline = time.time(), self._latency.get(caller)
+            congested = error or (baseline is not None and latency > self._tolerance * baseline)
+            if congested:
+                if now - self._last_decrease > (baseline or 0):
+                    self._limit = max(self._limit * self._decrease, self._min_limit)
+                    self._last_decrease = now
+            else:
+                self._limit = min(self._limit + 1 / self._limit, self._max_limit)
+            if not error:
+                self._latency[caller] = latency if baseline is None else 0.8 * baseline + 0.2 * latency
+
+    @contextlib.contextmanager
+    def slot(self, caller=None):
+        self.acquire()
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.release(time.time() - start, error=True, caller=caller)
+            raise
+        except BaseException:
+            self.release()
+            raise
+        self.release(time.time() - start, caller=caller)
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, caller=None):
+        await self.aacquire()
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.release(time.time() - start, error=True, caller=caller)
+            raise
+        except BaseException:
+            self.release()
+            raise
+        self.release(time.time() - start, caller=caller)
+
+    def get_summary(self):
+        with self._cond:
+            return {
+                "limit": int(self._limit),
+                "inflight": self._inflight,
+                "queue": self._waiting,
+                "latency": {c: round(v, 3) for c, v in self._latency.items()},
+            }
+
+
+_governors, _governors_lock = {}, threading.Lock()
+
+
+def get_governor(backend, config=None):
+    """Get the governor shared by all the models of the backend"""
+
+    with _governors_lock:
+        if backend not in _governors:
+            config = config or {}
+            _governors[backend] = Governor(
+                initial=config.get("initial", 4),
+                min_limit=config.get("min", 1),
+                max_limit=config.get("max", 32),
+            )
+        return _governors[backend]
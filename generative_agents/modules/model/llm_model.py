@@ -2,17 +2,93 @@
 
 import time
 import re
-import requests
+import json
+import weakref
+import asyncio
+import fnmatch
+import threading
+import contextlib
+
+import httpx
+
+from modules.storage.cache import get_sqlite_cache
+from .cassette import CassetteMiss, get_cassette
+from .governor import get_governor
+from .resilience import backoff_delay, get_breaker, get_hedger
+from .pool import get_endpoint_pool
+
+
+_http_clients, _http_lock = {}, threading.Lock()
+# 每个事件循环的async client，事件循环被回收后自动移除
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_http_client(timeout):
+    """Get the shared keep-alive http client"""
+
+    with _http_lock:
+        if timeout not in _http_clients:
+            _http_clients[timeout] = httpx.Client(timeout=httpx.Timeout(timeout[1], connect=timeout[0]))
+        return _http_clients[timeout]
+
+
+async def _close_on_shutdown(entry):
+    try:
+        yield
+    finally:
+        for client in entry["clients"].values():
+            await client.aclose()
+        entry["clients"].clear()
+        # generator引用了事件循环，移除后事件循环才能被回收
+        entry.pop("guard", None)
+
+
+async def aget_http_client(timeout):
+    """Get the keep-alive async http client of the running loop, closed when the loop shuts down"""
+
+    loop = asyncio.get_running_loop()
+    with _http_lock:
+        entry = _async_clients.get(loop)
+        started = entry is not None
+        if not started:
+            entry = _async_clients[loop] = {"clients": {}}
+        if timeout not in entry["clients"]:
+            entry["clients"][timeout] = httpx.AsyncClient(timeout=httpx.Timeout(timeout[1], connect=timeout[0]))
+        client = entry["clients"][timeout]
+    if not started:
+        # 事件循环结束时（如asyncio.run退出前）会关闭其中的async generator，借此关闭client
+        entry["guard"] = _close_on_shutdown(entry)
+        await entry["guard"].__anext__()
+    return client
 
 
 class LLMModel:
     def __init__(self, config):
         self._api_key = config["api_key"]
-        self._base_url = config["base_url"]
         self._model = config["model"]
+        # 连接及读取的超时时间（秒）
+        timeout = config.get("timeout", {})
+        self._timeout = (timeout.get("connect", 10), timeout.get("read", 600))
         self._meta_responses = []
         self._summary = {"total": [0, 0, 0]}
 
+        # 持久化的响应缓存，include/exclude用于按caller启用或禁用缓存
+        cache = config.get("cache", {})
+        self._cache, self._cache_summary = None, {"total": [0, 0]}
+        # 使用cassette时不使用缓存，所有调用都经过cassette录制或回放
+        if cache.get("path") and not get_cassette():
+            self._cache = get_sqlite_cache(cache["path"], cache.get("max_entries", 100000))
+        self._cache_include = cache.get("include", [])
+        self._cache_exclude = cache.get("exclude", [])
+
+        # 请求分配到endpoints中的多个服务，同一组服务的所有模型共用并发控制、熔断及对冲请求
+        self._pool = get_endpoint_pool(config)
+        backend = ",".join(self._pool.base_urls)
+        self._governor = get_governor(backend, config.get("concurrency"))
+        self._breaker = get_breaker(backend, config.get("breaker"))
+        self._hedger = get_hedger(backend, config.get("hedge"))
+        self._retry = config.get("retry", {})
+
         self._handle = self.setup(config)
         self._enabled = True
 
@@ -28,37 +104,168 @@ class LLMModel:
         callback=None,
         failsafe=None,
         caller="llm_normal",
+        stop_pattern=None,
         **kwargs
     ):
-        response, self._meta_responses = None, []
         self._summary.setdefault(caller, [0, 0, 0])
-        for _ in range(retry):
+        key, meta_response, response = self._cache_lookup(prompt, callback, caller, kwargs)
+        self._meta_responses = [meta_response] if response is not None else []
+        errors = 0
+        for _ in range(retry if response is None else 0):
+            # 服务不可用时直接使用failsafe
+            if not self._breaker.allow():
+                break
             try:
-                meta_response = self._completion(prompt, **kwargs).strip()
-                self._meta_responses.append(meta_response)
-                self._summary["total"][0] += 1
-                self._summary[caller][0] += 1
-                if callback:
-                    response = callback(meta_response)
-                else:
-                    response = meta_response
+                meta_response = self._request(prompt, stop_pattern, caller, **kwargs).strip()
+            except CassetteMiss:
+                # 回放时缺少记录说明模拟已经偏离录制时的过程，重试无意义
+                raise
             except Exception as e:
                 print(f"LLMModel.completion() caused an error: {e}")
-                time.sleep(5)
-                response = None
+                time.sleep(self._backoff(errors))
+                errors += 1
                 continue
+            self._meta_responses.append(meta_response)
+            self._summary["total"][0] += 1
+            self._summary[caller][0] += 1
+            response = self._parse(meta_response, callback)
             if response is not None:
+                self._cache_save(key, meta_response)
                 break
         pos = 2 if response is None else 1
         self._summary["total"][pos] += 1
         self._summary[caller][pos] += 1
         return response or failsafe
 
-    def _completion(self, prompt, **kwargs):
+    async def acompletion(
+        self,
+        prompt,
+        retry=10,
+        callback=None,
+        failsafe=None,
+        caller="llm_normal",
+        stop_pattern=None,
+        **kwargs
+    ):
+        self._summary.setdefault(caller, [0, 0, 0])
+        key, meta_response, response = self._cache_lookup(prompt, callback, caller, kwargs)
+        meta_responses = [meta_response] if response is not None else []
+        errors = 0
+        for _ in range(retry if response is None else 0):
+            if not self._breaker.allow():
+                break
+            try:
+                meta_response = (await self._arequest(prompt, stop_pattern, caller, **kwargs)).strip()
+            except CassetteMiss:
+                raise
+            except Exception as e:
+                print(f"LLMModel.acompletion() caused an error: {e}")
+                await asyncio.sleep(self._backoff(errors))
+                errors += 1
+                continue
+            meta_responses.append(meta_response)
+            self._summary["total"][0] += 1
+            self._summary[caller][0] += 1
+            response = self._parse(meta_response, callback)
+            if response is not None:
+                self._cache_save(key, meta_response)
+                break
+        self._meta_responses = meta_responses
+        pos = 2 if response is None else 1
+        self._summary["total"][pos] += 1
+        self._summary[caller][pos] += 1
+        return response or failsafe
+
+    def _backoff(self, errors):
+        return backoff_delay(errors, self._retry.get("backoff", 1), self._retry.get("max_backoff", 30))
+
+    def _parse(self, meta_response, callback):
+        # 解析失败时立即重试，不需要等待
+        if not callback:
+            return meta_response
+        try:
+            return callback(meta_response)
+        except Exception as e:  # pylint: disable=broad-except
+            print(f"LLMModel failed to parse the response: {e}")
+            return None
+
+    def _cache_lookup(self, prompt, callback, caller, kwargs):
+        """Look up the response cache, return the key, the cached and the parsed response"""
+
+        if self._cache is None:
+            return None, None, None
+        if caller in self._cache_exclude or (self._cache_include and caller not in self._cache_include):
+            return None, None, None
+        key = self._cache.make_key(self._model, prompt, kwargs, caller)
+        meta_response, response = self._cache.get(key), None
+        if meta_response is not None:
+            response = self._parse(meta_response, callback)
+        pos = 0 if response is not None else 1
+        self._cache_summary["total"][pos] += 1
+        self._cache_summary.setdefault(caller, [0, 0])[pos] += 1
+        return key, meta_response, response
+
+    def _cache_save(self, key, meta_response):
+        if key:
+            self._cache.set(key, meta_response)
+
+    def _request(self, prompt, stop_pattern=None, caller=None, **kwargs):
+        def _completion():
+            with self._governor.slot(caller), self._breaker.watch(), self._pool.use() as base_url:
+                return self._completion(prompt, base_url, stop_pattern=stop_pattern, **kwargs)
+
+        cassette = get_cassette()
+        if not cassette:
+            return self._hedger.run(_completion)
+        params = {"model": self._model, "prompt": prompt, "kwargs": kwargs}
+        return cassette.play("llm", params, lambda: self._hedger.run(_completion))
+
+    async def _arequest(self, prompt, stop_pattern=None, caller=None, **kwargs):
+        async def _acompletion():
+            async with self._governor.aslot(caller):
+                with self._breaker.watch(), self._pool.use() as base_url:
+                    return await self._acompletion(prompt, base_url, stop_pattern=stop_pattern, **kwargs)
+
+        cassette = get_cassette()
+        if not cassette:
+            return await self._hedger.arun(_acompletion)
+        params = {"model": self._model, "prompt": prompt, "kwargs": kwargs}
+        return await cassette.aplay("llm", params, lambda: self._hedger.arun(_acompletion))
+
+    def _completion(self, prompt, base_url, **kwargs):
         raise NotImplementedError(
             "_completion is not support for " + str(self.__class__)
         )
 
+    async def _acompletion(self, prompt, base_url, **kwargs):
+        return await asyncio.to_thread(self._completion, prompt, base_url, **kwargs)
+
+    @staticmethod
+    def _matched(text, stop_pattern):
+        # <think>标签内（包括尚未结束的标签）的文字不参与匹配
+        text = re.sub(r"<think>.*?(</think>|$)", "", text, flags=re.DOTALL)
+        return re.search(stop_pattern, text) is not None
+
+    def _stream_until(self, stream, stop_pattern):
+        """Read the streamed text until it matches stop_pattern, then close the stream"""
+
+        text = ""
+        with contextlib.closing(stream):
+            for delta in stream:
+                text += delta
+                if self._matched(text, stop_pattern):
+                    break
+        return text
+
+    async def _astream_until(self, stream, stop_pattern):
+        text = ""
+        async with contextlib.aclosing(stream):
+            async for delta in stream:
+                text += delta
+                if self._matched(text, stop_pattern):
+                    break
+        return text
+
     def is_available(self):
         return self._enabled  # and self._summary["total"][2] <= 10
 
@@ -66,7 +273,17 @@ class LLMModel:
         des = {}
         for k, v in self._summary.items():
             des[k] = "S:{},F:{}/R:{}".format(v[1], v[2], v[0])
-        return {"model": self._model, "summary": des}
+            if self._cache is not None and k in self._cache_summary:
+                hit, miss = self._cache_summary[k]
+                des[k] += " Cache(H:{},M:{})".format(hit, miss)
+        return {
+            "model": self._model,
+            "summary": des,
+            "concurrency": self._governor.get_summary(),
+            "breaker": self._breaker.state,
+            "hedged": self._hedger.hedged,
+            "endpoints": self._pool.get_summary(),
+        }
 
     def disable(self):
         self._enabled = False
@@ -80,57 +297,186 @@ class OpenAILLMModel(LLMModel):
     def setup(self, config):
         from openai import OpenAI
 
-        return OpenAI(api_key=self._api_key, base_url=self._base_url)
+        return {
+            base_url: OpenAI(
+                api_key=self._api_key,
+                base_url=base_url,
+                timeout=httpx.Timeout(self._timeout[1], connect=self._timeout[0]),
+            )
+            for base_url in self._pool.base_urls
+        }
 
-    def _completion(self, prompt, temperature=0.5):
+    def _completion(self, prompt, base_url, temperature=0.5, stop_pattern=None):
         messages = [{"role": "user", "content": prompt}]
-        response = self._handle.chat.completions.create(
+        if stop_pattern:
+            return self._stream_until(self._stream(base_url, messages, temperature), stop_pattern)
+        response = self._handle[base_url].chat.completions.create(
             model=self._model, messages=messages, temperature=temperature
         )
         if len(response.choices) > 0:
             return response.choices[0].message.content
         return ""
 
+    def _stream(self, base_url, messages, temperature):
+        stream = self._handle[base_url].chat.completions.create(
+            model=self._model, messages=messages, temperature=temperature, stream=True
+        )
+        # 提前结束时关闭stream，服务端随之停止生成
+        with contextlib.closing(stream):
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
 
 class OllamaLLMModel(LLMModel):
     def setup(self, config):
         return None
 
-    def ollama_chat(self, messages, temperature):
-        headers = {
-            "Content-Type": "application/json"
-        }
-        params = {
+    def _chat_params(self, prompt, temperature):
+        if "qwen3" in self._model and "\n/nothink" not in prompt:
+            # 针对Qwen3模型禁用think，提高推理速度
+            prompt += "\n/nothink"
+        return {
             "model": self._model,
-            "messages": messages,
+            "messages": [{"role": "user", "content": prompt}],
             "temperature": temperature,
             "stream": False,
         }
 
-        response = requests.post(
-            url=f"{self._base_url}/chat/completions",
-            headers=headers,
-            json=params,
-            stream=False
-        )
-        return response.json()
-
-    def _completion(self, prompt, temperature=0.5):
-        if "qwen3" in self._model and "\n/nothink" not in prompt:
-            # 针对Qwen3模型禁用think，提高推理速度
-            prompt += "\n/nothink"
-        messages = [{"role": "user", "content": prompt}]
-        response = self.ollama_chat(messages=messages, temperature=temperature)
+    def _parse_chat(self, response):
         if response and len(response["choices"]) > 0:
-            ret = response["choices"][0]["message"]["content"]
-            # 从输出结果中过滤掉<think>标签内的文字，以免影响后续逻辑
-            return re.sub(r"<think>.*</think>", "", ret, flags=re.DOTALL)
+            return self._strip_think(response["choices"][0]["message"]["content"])
+        return ""
+
+    @staticmethod
+    def _strip_think(text):
+        # 从输出结果中过滤掉<think>标签内的文字，以免影响后续逻辑
+        return re.sub(r"<think>.*</think>", "", text, flags=re.DOTALL)
+
+    @staticmethod
+    def _parse_stream_line(line):
+        if not line.startswith("data:") or line[5:].strip() == "[DONE]":
+            return ""
+        chunk = json.loads(line[5:])
+        if chunk.get("choices"):
+            return chunk["choices"][0]["delta"].get("content") or ""
         return ""
 
+    def ollama_chat(self, base_url, params):
+        # 复用长连接，避免每次请求重新建立TCP连接
+        client = get_http_client(self._timeout)
+        response = client.post(f"{base_url}/chat/completions", json=params)
+        return response.json()
+
+    async def aollama_chat(self, base_url, params):
+        client = await aget_http_client(self._timeout)
+        response = await client.post(f"{base_url}/chat/completions", json=params)
+        return response.json()
+
+    def ollama_stream(self, base_url, params):
+        client = get_http_client(self._timeout)
+        # 提前结束时关闭连接，Ollama随之停止生成
+        with client.stream("POST", f"{base_url}/chat/completions", json=dict(params, stream=True)) as response:
+            # 错误的响应没有SSE格式的内容，直接报错以便重试
+            response.raise_for_status()
+            for line in response.iter_lines():
+                yield self._parse_stream_line(line)
+
+    async def aollama_stream(self, base_url, params):
+        client = await aget_http_client(self._timeout)
+        url = f"{base_url}/chat/completions"
+        async with client.stream("POST", url, json=dict(params, stream=True)) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                yield self._parse_stream_line(line)
+
+    def _completion(self, prompt, base_url, temperature=0.5, stop_pattern=None):
+        params = self._chat_params(prompt, temperature)
+        if stop_pattern:
+            return self._strip_think(self._stream_until(self.ollama_stream(base_url, params), stop_pattern))
+        return self._parse_chat(self.ollama_chat(base_url, params))
+
+    async def _acompletion(self, prompt, base_url, temperature=0.5, stop_pattern=None):
+        params = self._chat_params(prompt, temperature)
+        if stop_pattern:
+            stream = self.aollama_stream(base_url, params)
+            return self._strip_think(await self._astream_until(stream, stop_pattern))
+        return self._parse_chat(await self.aollama_chat(base_url, params))
+
+
+class TieredLLMModel:
+    """LLM model routing the calls of each caller to the model of its tier
+
+    The tiers override the provider, model or endpoints of the base config. The
+    keys of routing are caller names or glob patterns such as "decide_*", an exact
+    name wins over the patterns and a longer pattern over a shorter one. The
+    callers not matched by routing go to the base model.
+    """
+
+    def __init__(self, config):
+        base = {k: v for k, v in config.items() if k not in ("tiers", "routing")}
+        self._models = {"default": create_llm_model(base)}
+        for tier, t_config in config["tiers"].items():
+            t_config = _merge_tier_config(base, t_config)
+            self._models[tier] = create_llm_model(t_config)
+        self._routing = config.get("routing", {})
+        self._patterns = sorted(
+            [k for k in self._routing if any(c in k for c in "*?[")], key=len, reverse=True
+        )
+        self._routes = {}
+        self._last = self._models["default"]
+
+    def route(self, caller):
+        if caller not in self._routes:
+            tier = self._routing.get(caller)
+            if tier is None:
+                tier = next(
+                    (self._routing[p] for p in self._patterns if fnmatch.fnmatchcase(caller, p)), "default"
+                )
+            self._routes[caller] = self._models.get(tier, self._models["default"])
+        return self._routes[caller]
+
+    def completion(self, prompt, caller="llm_normal", **kwargs):
+        self._last = self.route(caller)
+        return self._last.completion(prompt, caller=caller, **kwargs)
+
+    async def acompletion(self, prompt, caller="llm_normal", **kwargs):
+        model = self.route(caller)
+        response = await model.acompletion(prompt, caller=caller, **kwargs)
+        self._last = model
+        return response
+
+    def is_available(self):
+        return all(m.is_available() for m in self._models.values())
+
+    def get_summary(self):
+        return {
+            "model": self._models["default"].get_summary()["model"],
+            "tiers": {tier: m.get_summary() for tier, m in self._models.items()},
+        }
+
+    def disable(self):
+        for model in self._models.values():
+            model.disable()
+
+    @property
+    def meta_responses(self):
+        return self._last.meta_responses
+
+
+def _merge_tier_config(base, override):
+    config = dict(base, **override)
+    # 分级模型只配置了base_url时，不使用基础配置中的endpoints
+    if "base_url" in override and "endpoints" not in override:
+        config.pop("endpoints", None)
+    return config
+
 
 def create_llm_model(llm_config):
     """Create llm model"""
 
+    if llm_config.get("tiers"):
+        return TieredLLMModel(llm_config)
     if llm_config["provider"] == "ollama":
         return OllamaLLMModel(llm_config)
 
@@ -0,0 +1,126 @@
+"""generative_agents.model.pool"""
+
+import time
+import threading
+import contextlib
+
+import httpx
+
+
+class Endpoint:
+    def __init__(self, base_url, weight=1):
+        self.base_url = base_url
+        self.weight = weight
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected = None
+
+    def load(self):
+        return (self.outstanding + 1) / self.weight
+
+
+class EndpointPool:
+    """Pool of the endpoints serving the same model
+
+    Each request goes to the healthy endpoint with the least outstanding requests
+    relative to its weight. An endpoint is ejected after eject_after successive
+    errors, and is admitted again once its health check passes.
+    """
+
+    def __init__(self, endpoints, eject_after=3, check_interval=10):
+        self._endpoints = [Endpoint(e["base_url"], e.get("weight", 1)) for e in endpoints]
+        self._eject_after, self._check_interval = eject_after, check_interval
+        self._lock = threading.Lock()
+        self._checker = None
+
+    def acquire(self):
+        with self._lock:
+            healthy = [e for e in self._endpoints if e.ejected is None]
+            # 所有服务都被移除时，选择最早被移除的服务
+            if not healthy:
+                healthy = [min(self._endpoints, key=lambda e: e.ejected)]
+            endpoint = min(healthy, key=lambda e: e.load())
+            endpoint.outstanding += 1
+            return endpoint
+
+    def release(self, endpoint, success=True):
+        with self._lock:
+            endpoint.outstanding -= 1
+            if success:
+                endpoint.failures = 0
+                return
+            endpoint.failures += 1
+            if endpoint.failures >= self._eject_after and endpoint.ejected is None and len(self._endpoints) > 1:
+                endpoint.ejected = time.time()
+                self._start_checker()
+
+    @contextlib.contextmanager
+    def use(self):
+        """Hold an endpoint during a request, yield the base_url"""
+
+        endpoint = self.acquire()
+        try:
+            yield endpoint.base_url
+        except Exception:
+            self.release(endpoint, False)
+            raise
+        self.release(endpoint)
+
+    def _start_checker(self):
+        if self._checker and self._checker.is_alive():
+            return
+        self._checker = threading.Thread(target=self._check_ejected, daemon=True)
+        self._checker.start()
+
+    def _check_ejected(self):
+        while True:
+            time.sleep(self._check_interval)
+            with self._lock:
+                ejected = [e for e in self._endpoints if e.ejected is not None]
+            if not ejected:
+                return
+            for endpoint in ejected:
+                if self.health_check(endpoint.base_url):
+                    with self._lock:
+                        endpoint.ejected, endpoint.failures = None, 0
+
+    @staticmethod
+    def health_check(base_url):
+        try:
+            return httpx.get(base_url, timeout=5).status_code < 500
+        except httpx.HTTPError:
+            return False
+
+    @property
+    def base_urls(self):
+        return [e.base_url for e in self._endpoints]
+
+    def get_summary(self):
+        with self._lock:
+            return {
+                e.base_url: "{}:{}".format("ejected" if e.ejected else "ok", e.outstanding)
+                for e in self._endpoints
+            }
+
+
+def get_endpoints(config):
+    """Endpoints in the config, either a list of endpoints or a single base_url"""
+
+    if config.get("endpoints"):
+        return config["endpoints"]
+    return [{"base_url": config["base_url"], "weight": 1}]
+
+
+_pools, _pools_lock = {}, threading.Lock()
+
+
+def get_endpoint_pool(config):
+    """Get the endpoint pool shared by all the models using the same endpoints"""
+
+    endpoints = get_endpoints(config)
+    key = tuple((e["base_url"], e.get("weight", 1)) for e in endpoints)
+    with _pools_lock:
+        if key not in _pools:
+            pool = config.get("pool", {})
+            _pools[key] = EndpointPool(endpoints, pool.get("eject_after", 3), pool.get("check_interval", 10))
+        return _pools[key]
@@ -0,0 +1,166 @@
+"""generative_agents.model.resilience"""
+
+import time
+import random
+import asyncio
+import threading
+import contextlib
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
+
+
+def backoff_delay(attempt, base=1, max_delay=30):
+    """Exponential backoff with jitter, in second"""
+
+    delay = min(base * 2 ** attempt, max_delay)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class CircuitBreaker:
+    """Circuit breaker of a backend
+
+    The circuit opens after threshold successive transport errors, then the
+    requests are refused until cooldown passes, when one request is let through
+    to probe the backend.
+    """
+
+    def __init__(self, threshold=5, cooldown=60):
+        self._threshold, self._cooldown = threshold, cooldown
+        self._lock = threading.Lock()
+        self._failures, self._opened = 0, None
+
+    def allow(self):
+        with self._lock:
+            if self._opened is None:
+                return True
+            if time.time() - self._opened >= self._cooldown:
+                self._opened = time.time()
+                return True
+            return False
+
+    def record(self, success):
+        with self._lock:
+            if success:
+                self._failures, self._opened = 0, None
+            else:
+                self._failures += 1
+                if self._failures >= self._threshold:
+                    self._opened = time.time()
+
+    @contextlib.contextmanager
+    def watch(self):
+        # 被取消的请求（如对冲请求中较慢的一个）不计入
+        try:
+            yield
+        except Exception:
+            self.record(False)
+            raise
+        self.record(True)
+
+    @property
+    def state(self):
+        return "open" if self._opened is not None else "closed"
+
+
+class Hedger:
+    """Send a duplicate request when the first one is slower than the percentile of the latencies"""
+
+    def __init__(self, enable=False, percentile=95, min_samples=20, max_workers=32):
+        self._enable = enable
+        self._percentile, self._min_samples = percentile, min_samples
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=200)
+        self._hedged = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers) if enable else None
+
+    def threshold(self):
+        if not self._enable:
+            return None
+        with self._lock:
+            if len(self._latencies) < self._min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(int(len(latencies) * self._percentile / 100), len(latencies) - 1)]
+
+    def _timed(self, request):
+        start = time.time()
+        result = request()
+        with self._lock:
+            self._latencies.append(time.time() - start)
+        return result
+
+    async def _atimed(self, request):
+        start = time.time()
+        result = await request()
+        with self._lock:
+            self._latencies.append(time.time() - start)
+        return result
+
+    def run(self, request):
+        threshold = self.threshold()
+        if threshold is None:
+            return self._timed(request)
+        primary = self._executor.submit(self._timed, request)
+        done, _ = wait([primary], timeout=threshold)
+        if done:
+            return primary.result()
+        with self._lock:
+            self._hedged += 1
+        # 使用先成功返回的结果，较慢的请求在后台完成
+        error = None
+        for future in as_completed([primary, self._executor.submit(self._timed, request)]):
+            try:
+                return future.result()
+            except Exception as e:  # pylint: disable=broad-except
+                error = e
+        raise error
+
+    async def arun(self, request):
+        threshold = self.threshold()
+        if threshold is None:
+            return await self._atimed(request)
+        primary = asyncio.ensure_future(self._atimed(request))
+        done, _ = await asyncio.wait([primary], timeout=threshold)
+        if done:
+            return primary.result()
+        with self._lock:
+            self._hedged += 1
+        pending, error = {primary, asyncio.ensure_future(self._atimed(request))}, None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for p in pending:
+                        p.cancel()
+                    return task.result()
+                error = task.exception()
+        raise error
+
+    @property
+    def hedged(self):
+        return self._hedged
+
+
+_breakers, _hedgers, _registry_lock = {}, {}, threading.Lock()
+
+
+def get_breaker(backend, config=None):
+    """Get the circuit breaker shared by all the models of the backend"""
+
+    with _registry_lock:
+        if backend not in _breakers:
+            config = config or {}
+            _breakers[backend] = CircuitBreaker(config.get("threshold", 5), config.get("cooldown", 60))
+        return _breakers[backend]
+
+
+def get_hedger(backend, config=None):
+    """Get the hedger shared by all the models of the backend"""
+
+    with _registry_lock:
+        if backend not in _hedgers:
+            config = config or {}
+            _hedgers[backend] = Hedger(
+                config.get("enable", False), config.get("percentile", 95), config.get("min_samples", 20)
+            )
+        return _hedgers[backend]
@@ -3,32 +3,77 @@
 import random
 import datetime
 import re
-from string import Template
 
 from modules import utils
 from modules.memory import Event
 from modules.model import parse_llm_output
+from .template import get_template_registry
+
+# 只需要回答“是”或“否”的prompt，读到答案后即可停止生成
+_yes_no = "^\\s*[\"“]?(是|否|不|Yes|No|yes|no)"
+
+
+def estimate_tokens(text):
+    """Rough token count of the text, without the tokenizer of the model"""
+
+    # 中文约每个字1个token，其他字符约每4个字符1个token
+    cjk = sum(1 for c in text if "\u4e00" <= c <= "\u9fff" or "\u3000" <= c <= "\u303f" or "\uff00" <= c <= "\uffef")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _numbered(nodes):
+    return "\n".join(["{}. {}".format(idx, n.describe) for idx, n in enumerate(nodes)])
+
+
+def _chat_lines(chats):
+    return "\n".join(["{}: {}".format(n, c) for n, c in chats])
 
 
 class Scratch:
-    def __init__(self, name, currently, config):
+    def __init__(self, name, currently, config, budget=None):
         self.name = name
         self.currently = currently
         self.config = config
-        self.template_path = "data/prompts"
+        # 各调用类型的prompt长度上限（token），未指定时使用default，0表示不限制
+        self.budget = budget or {}
+        self._base_desc_cache = (None, "")
 
     def build_prompt(self, template, data):
-        with open(f"{self.template_path}/{template}.txt", "r", encoding="utf-8") as file:
-            file_content = file.read()
-
-        template = Template(file_content)
-        filled_content = template.substitute(data)
-
-        return filled_content
+        return get_template_registry().render(template, data)
+
+    def build_budget_prompt(self, template, data, sections):
+        """Build the prompt within the budget of template, return the prompt and the kept items of the sections
+
+        sections maps each key of data to (items, render, keep). The items are
+        dropped from the largest section, from the tail when keep is "head" (the
+        items are ranked) or from the head when keep is "tail" (the latest items
+        are at the tail), until the prompt fits.
+        """
+
+        budget = self.budget.get(template, self.budget.get("default", 0))
+        kept = {k: list(items) for k, (items, _, _) in sections.items()}
+
+        def _build():
+            data.update({k: render(kept[k]) for k, (_, render, _) in sections.items()})
+            return self.build_prompt(template, data)
+
+        prompt = _build()
+        while budget and estimate_tokens(prompt) > budget:
+            candidates = [k for k in kept if kept[k]]
+            if not candidates:
+                break
+            key = max(candidates, key=lambda k: estimate_tokens(data[k]))
+            kept[key] = kept[key][:-1] if sections[key][2] == "head" else kept[key][1:]
+            prompt = _build()
+        return prompt, kept
 
     def _base_desc(self):
-        return self.build_prompt(
-            "base_desc",
+        # 同一天内currently不变时，复用已生成的人物描述
+        template, date = get_template_registry().get("base_desc"), utils.get_timer().daily_format_cn()
+        key = (template, date, self.currently)
+        if self._base_desc_cache[0] == key:
+            return self._base_desc_cache[1]
+        base_desc = template.substitute(
             {
                 "name": self.name,
                 "age": self.config["age"],
@@ -36,10 +81,12 @@ class Scratch:
                 "learned": self.config["learned"],
                 "lifestyle": self.config["lifestyle"],
                 "daily_plan": self.config["daily_plan"],
-                "date": utils.get_timer().daily_format_cn(),
+                "date": date,
                 "currently": self.currently,
             }
         )
+        self._base_desc_cache = (key, base_desc)
+        return base_desc
 
     def prompt_poignancy_event(self, event):
         prompt = self.build_prompt(
@@ -62,6 +109,7 @@ class Scratch:
             "prompt": prompt,
             "callback": _callback,
             "failsafe": random.choice(list(range(10))) + 1,
+            "stop_pattern": "^\\s*(评分[:： ]*)?\\d{1,2}\\D",
         }
 
     def prompt_poignancy_chat(self, event):
@@ -85,8 +133,36 @@ class Scratch:
             "prompt": prompt,
             "callback": _callback,
             "failsafe": random.choice(list(range(10))) + 1,
+            "stop_pattern": "^\\s*(评分[:： ]*)?\\d{1,2}\\D",
         }
 
+    def prompt_poignancy_batch(self, events):
+        lines = [
+            "{}. [{}] {}".format(idx + 1, "对话" if e_type == "chat" else "事件", event.get_describe())
+            for idx, (e_type, event) in enumerate(events)
+        ]
+        prompt = self.build_prompt(
+            "poignancy_batch",
+            {
+                "base_desc": self._base_desc(),
+                "agent": self.name,
+                "count": len(events),
+                "events": "\n".join(lines),
+            }
+        )
+
+        def _callback(response):
+            scores = {}
+            for idx, score in re.findall(
+                "^\\s*(\\d+)\\s*[.、:：]\\s*(?:.*?评分[:： ]*)?(\\d{1,2})", response, re.M
+            ):
+                scores.setdefault(int(idx), int(score))
+            assert all(i + 1 in scores for i in range(len(events)))
+            return [min(max(scores[i + 1], 1), 10) for i in range(len(events))]
+
+        # 解析失败时返回None，由调用方退回到逐个调用poignancy_event及poignancy_chat
+        return {"prompt": prompt, "callback": _callback, "failsafe": None, "retry": 2}
+
     def prompt_wake_up(self):
         prompt = self.build_prompt(
             "wake_up",
@@ -108,7 +184,7 @@ class Scratch:
                 wake_up_time = 11
             return wake_up_time
 
-        return {"prompt": prompt, "callback": _callback, "failsafe": 6}
+        return {"prompt": prompt, "callback": _callback, "failsafe": 6, "stop_pattern": "\\d{1,2}:\\d{2}"}
 
     def prompt_schedule_init(self, wake_up):
         prompt = self.build_prompt(
@@ -518,7 +594,7 @@ class Scratch:
                 return False
             return True
 
-        return {"prompt": prompt, "callback": _callback, "failsafe": False}
+        return {"prompt": prompt, "callback": _callback, "failsafe": False, "stop_pattern": _yes_no}
 
     def prompt_decide_chat_terminate(self, agent, other, chats):
         conversation = "\n".join(["{}: {}".format(n, u) for n, u in chats])
@@ -540,7 +616,7 @@ class Scratch:
                 return False
             return True
 
-        return {"prompt": prompt, "callback": _callback, "failsafe": False}
+        return {"prompt": prompt, "callback": _callback, "failsafe": False, "stop_pattern": _yes_no}
 
     def prompt_decide_wait(self, agent, other, focus):
         example1 = self.build_prompt(
@@ -620,13 +696,13 @@ class Scratch:
     def prompt_summarize_relation(self, agent, other_name):
         nodes = agent.associate.retrieve_focus([other_name], 50)
 
-        prompt = self.build_prompt(
+        prompt, _ = self.build_budget_prompt(
             "summarize_relation",
             {
-                "context": "\n".join(["{}. {}".format(idx, n.describe) for idx, n in enumerate(nodes)]),
                 "agent": agent.name,
                 "another": other_name,
-            }
+            },
+            {"context": (nodes, _numbered, "head")},
         )
 
         def _callback(response):
@@ -638,12 +714,11 @@ class Scratch:
             "failsafe": agent.name + " 正在看着 " + other_name,
         }
 
-    def prompt_generate_chat(self, agent, other, relation, chats):
+    def _chat_context(self, agent, other, relation, chats):
         focus = [relation, other.get_event().get_describe()]
         if len(chats) > 4:
             focus.append("; ".join("{}: {}".format(n, t) for n, t in chats[-4:]))
         nodes = agent.associate.retrieve_focus(focus, 15)
-        memory = "\n- " + "\n- ".join([n.describe for n in nodes])
         chat_nodes = agent.associate.retrieve_chats(other.name)
         pass_context = ""
         for n in chat_nodes:
@@ -661,24 +736,32 @@ class Scratch:
             f"{agent.name} {agent.get_event().get_describe(False)} 时，看到 {other.name} {other.get_event().get_describe(False)}。"
         )
 
-        conversation = "\n".join(["{}: {}".format(n, u) for n, u in chats])
-        conversation = (
-            conversation or "[对话尚未开始]"
-        )
+        def _memory(nodes):
+            return "\n- " + "\n- ".join([n.describe for n in nodes])
+
+        def _conversation(chats):
+            conversation = "\n".join(["{}: {}".format(n, u) for n, u in chats])
+            return conversation or "[对话尚未开始]"
+
+        data = {
+            "agent": agent.name,
+            "base_desc": self._base_desc(),
+            "address": f"{address[-2]}，{address[-1]}",
+            "current_time": utils.get_timer().get_date("%H:%M"),
+            "previous_context": prev_context,
+            "current_context": curr_context,
+            "another": other.name,
+        }
+        # 超出预算时，减少相关记忆并保留最近的对话
+        sections = {
+            "memory": (nodes, _memory, "head"),
+            "conversation": (chats, _conversation, "tail"),
+        }
+        return data, sections
 
-        prompt = self.build_prompt(
-            "generate_chat",
-            {
-                "agent": agent.name,
-                "base_desc": self._base_desc(),
-                "memory": memory,
-                "address": f"{address[-2]}，{address[-1]}",
-                "current_time": utils.get_timer().get_date("%H:%M"),
-                "previous_context": prev_context,
-                "current_context": curr_context,
-                "another": other.name,
-                "conversation": conversation,
-            }
+    def prompt_generate_chat(self, agent, other, relation, chats):
+        prompt, _ = self.build_budget_prompt(
+            "generate_chat", *self._chat_context(agent, other, relation, chats)
         )
 
         def _callback(response):
@@ -695,6 +778,30 @@ class Scratch:
             "failsafe": "嗯",
         }
 
+    def prompt_generate_chat_turn(self, agent, other, relation, chats):
+        prompt, _ = self.build_budget_prompt(
+            "generate_chat_turn", *self._chat_context(agent, other, relation, chats)
+        )
+
+        def _flag(value):
+            if isinstance(value, bool):
+                return value
+            # 只接受“是”或“否”，其他回答（如“不是”）视为解析失败
+            value = str(value).strip(" \n\"'“”‘’。.")
+            assert value in ("是", "否"), "unexpected flag " + value
+            return value == "是"
+
+        def _callback(response):
+            assert "{" in response and "}" in response
+            json_content = utils.load_dict(
+                "{" + response.split("{")[1].split("}")[0] + "}"
+            )
+            text = json_content[agent.name].replace("\n\n", "\n").strip(" \n\"'“”‘’")
+            return text, _flag(json_content["重复"]), _flag(json_content["结束"])
+
+        # 解析失败时返回None，由调用方退回到逐个调用generate_chat、generate_chat_check_repeat及decide_chat_terminate
+        return {"prompt": prompt, "callback": _callback, "failsafe": None, "retry": 2}
+
     def prompt_generate_chat_check_repeat(self, agent, chats, content):
         conversation = "\n".join(["{}: {}".format(n, u) for n, u in chats])
         conversation = (
@@ -715,7 +822,7 @@ class Scratch:
                 return False
             return True
 
-        return {"prompt": prompt, "callback": _callback, "failsafe": False}
+        return {"prompt": prompt, "callback": _callback, "failsafe": False, "stop_pattern": _yes_no}
 
     def prompt_summarize_chats(self, chats):
         conversation = "\n".join(["{}: {}".format(n, u) for n, u in chats])
@@ -742,12 +849,10 @@ class Scratch:
         }
 
     def prompt_reflect_focus(self, nodes, topk):
-        prompt = self.build_prompt(
+        prompt, _ = self.build_budget_prompt(
             "reflect_focus",
-            {
-                "reference": "\n".join(["{}. {}".format(idx, n.describe) for idx, n in enumerate(nodes)]),
-                "number": topk,
-            }
+            {"number": topk},
+            {"reference": (nodes, _numbered, "head")},
         )
 
         def _callback(response):
@@ -765,13 +870,13 @@ class Scratch:
         }
 
     def prompt_reflect_insights(self, nodes, topk):
-        prompt = self.build_prompt(
+        prompt, kept = self.build_budget_prompt(
             "reflect_insights",
-            {
-                "reference": "\n".join(["{}. {}".format(idx, n.describe) for idx, n in enumerate(nodes)]),
-                "number": topk,
-            }
+            {"number": topk},
+            {"reference": (nodes, _numbered, "head")},
         )
+        # 序号对应于保留下来的记忆
+        nodes = kept["reference"]
 
         def _callback(response):
             patterns = [
@@ -805,14 +910,10 @@ class Scratch:
         }
 
     def prompt_reflect_chat_planing(self, chats):
-        all_chats = "\n".join(["{}: {}".format(n, c) for n, c in chats])
-
-        prompt = self.build_prompt(
+        prompt, _ = self.build_budget_prompt(
             "reflect_chat_planing",
-            {
-                "conversation": all_chats,
-                "agent": self.name,
-            }
+            {"agent": self.name},
+            {"conversation": (chats, _chat_lines, "tail")},
         )
 
         def _callback(response):
@@ -825,14 +926,10 @@ class Scratch:
         }
 
     def prompt_reflect_chat_memory(self, chats):
-        all_chats = "\n".join(["{}: {}".format(n, c) for n, c in chats])
-
-        prompt = self.build_prompt(
+        prompt, _ = self.build_budget_prompt(
             "reflect_chat_memory",
-            {
-                "conversation": all_chats,
-                "agent": self.name,
-            }
+            {"agent": self.name},
+            {"conversation": (chats, _chat_lines, "tail")},
         )
 
         def _callback(response):
@@ -846,17 +943,18 @@ class Scratch:
         }
 
     def prompt_retrieve_plan(self, nodes):
-        statements = [
-            n.create.strftime("%Y-%m-%d %H:%M") + ": " + n.describe for n in nodes
-        ]
+        def _statements(nodes):
+            return "\n".join(
+                [n.create.strftime("%Y-%m-%d %H:%M") + ": " + n.describe for n in nodes]
+            )
 
-        prompt = self.build_prompt(
+        prompt, _ = self.build_budget_prompt(
             "retrieve_plan",
             {
-                "description": "\n".join(statements),
                 "agent": self.name,
                 "date": utils.get_timer().get_date("%Y-%m-%d"),
-            }
+            },
+            {"description": (nodes, _statements, "head")},
         )
 
         def _callback(response):
@@ -875,16 +973,15 @@ class Scratch:
         }
 
     def prompt_retrieve_thought(self, nodes):
-        statements = [
-            n.create.strftime("%Y-%m-%d %H:%M") + "：" + n.describe for n in nodes
-        ]
+        def _statements(nodes):
+            return "\n".join(
+                [n.create.strftime("%Y-%m-%d %H:%M") + "：" + n.describe for n in nodes]
+            )
 
-        prompt = self.build_prompt(
+        prompt, _ = self.build_budget_prompt(
             "retrieve_thought",
-            {
-                "description": "\n".join(statements),
-                "agent": self.name,
-            }
+            {"agent": self.name},
+            {"description": (nodes, _statements, "head")},
         )
 
         def _callback(response):
@@ -0,0 +1,71 @@
+"""generative_agents.prompt.template"""
+
+import os
+import threading
+from string import Template
+
+from modules.utils.namespace import GenerativeAgentsMap, GenerativeAgentsKey
+
+
+class TemplateRegistry:
+    """Compiled prompt templates of a folder
+
+    The templates are loaded once. With hot_reload, a template is compiled again
+    when the modified time of its file changes.
+    """
+
+    def __init__(self, root="data/prompts", hot_reload=False):
+        self._root = root
+        self._hot_reload = hot_reload
+        self._lock = threading.Lock()
+        self._templates = {}
+        for file in sorted(os.listdir(root)):
+            if file.endswith(".txt"):
+                self._load(file[: -len(".txt")])
+
+    def _path(self, name):
+        return os.path.join(self._root, name + ".txt")
+
+    def _load(self, name):
+        path = self._path(name)
+        mtime = os.path.getmtime(path)
+        with open(path, "r", encoding="utf-8") as f:
+            template = Template(f.read())
+        with self._lock:
+            self._templates[name] = (template, mtime)
+        return template
+
+    def get(self, name):
+        entry = self._templates.get(name)
+        if entry is None:
+            return self._load(name)
+        if self._hot_reload and os.path.getmtime(self._path(name)) != entry[1]:
+            return self._load(name)
+        return entry[0]
+
+    def render(self, name, data):
+        return self.get(name).substitute(data)
+
+    @property
+    def config(self):
+        return {"root": self._root, "hot_reload": self._hot_reload}
+
+
+_registry_lock = threading.Lock()
+
+
+def set_template_registry(registry):
+    GenerativeAgentsMap.set(GenerativeAgentsKey.TEMPLATES, registry)
+    return registry
+
+
+def get_template_registry():
+    """Get the template registry of the process, load data/prompts at the first call"""
+
+    registry = GenerativeAgentsMap.get(GenerativeAgentsKey.TEMPLATES)
+    if registry:
+        return registry
+    with _registry_lock:
+        if not GenerativeAgentsMap.get(GenerativeAgentsKey.TEMPLATES):
+            set_template_registry(TemplateRegistry())
+        return GenerativeAgentsMap.get(GenerativeAgentsKey.TEMPLATES)
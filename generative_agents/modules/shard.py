@@ -0,0 +1,330 @@
+"""generative_agents.shard"""
+
+import os
+import copy
+import traceback
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.utils import GenerativeAgentsMap, GenerativeAgentsKey
+from modules import memory, utils
+from modules.model import Cassette, get_cassette, set_cassette
+from modules.prompt import TemplateRegistry, get_template_registry, set_template_registry
+from modules.storage.batcher import flush_embedding_batchers
+from .maze import Maze
+from .agent import Agent, AgentView, agent_state, run_chats
+from .game import create_game
+
+
+class AgentRef:
+    """Reference of an agent in the messages between processes"""
+
+    def __init__(self, name):
+        self.name = name
+
+
+class AgentProxy(AgentView):
+    """Read-only copy of an agent living in another shard"""
+
+    def place(self):
+        self.maze.put_event(self.coord, self.get_event(), owner=self.name)
+        if self.get_event(False):
+            self.maze.update_obj(self.coord, self.get_event(False), owner=self.name)
+
+
+class ShardWorker:
+    """Worker process owning a part of the agents and a replica of the maze"""
+
+    def __init__(self, conn, name, static_root, config, logger, parallel=1):
+        self._conn = conn
+        self.game = create_game(name, static_root, config, {}, logger=logger)
+        self.game.reset_game()
+        self.local = list(self.game.agents.keys())
+        self._pool = ThreadPoolExecutor(max_workers=parallel) if parallel > 1 else None
+        self._views, self._plans = {}, {}
+
+    def run(self):
+        self._conn.send(("ok", {n: agent_state(self.game.agents[n]) for n in self.local}))
+        while True:
+            cmd, args = self._conn.recv()
+            if cmd == "stop":
+                break
+            try:
+                result = getattr(self, "on_" + cmd)(*args)
+                self._conn.send(("ok", result))
+            except Exception:  # pylint: disable=broad-except
+                self._conn.send(("error", traceback.format_exc()))
+        # 关闭本地Agent的后台预取线程
+        for name in self.local:
+            self.game.agents[name].close()
+        if self._pool:
+            self._pool.shutdown()
+
+    def on_init(self, states):
+        for name, state in states.items():
+            if name in self.local:
+                continue
+            proxy = AgentProxy(name, self.game.maze)
+            proxy.update(state)
+            proxy.place()
+            self.game.agents[name] = proxy
+
+    def on_sync(self, states):
+        for name, state in states.items():
+            if name not in self.local:
+                self.game.agents[name].update(state)
+
+    def on_think(self, date, status, states):
+        utils.set_timer(start=date)
+        if get_cassette():
+            get_cassette().seed_random(date)
+        self.on_sync(states)
+        self._views = self.game.begin_step()
+        if self._pool:
+            futures = {n: self._pool.submit(self.game.agent_think, n, s, self._views) for n, s in status.items()}
+            plans = {n: f.result() for n, f in futures.items()}
+        else:
+            plans = {n: self.game.agent_think(n, s, self._views) for n, s in status.items()}
+        flush_embedding_batchers()
+        self._plans = plans
+        conversation = dict(self.game.conversation)
+        self.game.conversation.clear()
+        return {
+            "pending": self.game.maze.pending(),
+            "requests": self.game.pop_chat_requests(self._views),
+            "conversation": conversation,
+            "states": {n: agent_state(self.game.agents[n]) for n in status},
+        }
+
+    def on_call(self, name, method, args):
+        def _resolve(arg):
+            if isinstance(arg, AgentRef):
+                return self.game.agents[arg.name]
+            return arg
+
+        agent = self.game.agents[name]
+        return getattr(agent, method)(*[_resolve(a) for a in args])
+
+    def on_trace(self):
+        tracer = utils.get_tracer()
+        return tracer.events() if tracer else []
+
+    def on_commit(self, pending, chatted):
+        for name, plan in self._plans.items():
+            if plan is None:
+                self._plans[name] = self.game.agent_resume(name, self._views, name in chatted)
+            elif name in chatted:
+                self._plans[name] = self.game.agents[name].replan(self._views)
+        self.game.maze.commit(pending)
+        results = {
+            n: {
+                "result": self.game.agent_result(n, p),
+                "info": self.game.agents[n].to_dict(),
+                "state": agent_state(self.game.agents[n]),
+            }
+            for n, p in self._plans.items()
+        }
+        self._views, self._plans = {}, {}
+        return results
+
+
+def run_shard(
+    conn, name, static_root, config, verbose="info", log_file="", parallel=1, trace=False, cassette=None, templates=None
+):
+    """Entry of the shard process"""
+
+    if trace:
+        utils.set_tracer(utils.Tracer("shard-" + "|".join(config["agents"].keys())))
+    if cassette:
+        set_cassette(Cassette(**cassette))
+    if templates:
+        set_template_registry(TemplateRegistry(**templates))
+    if log_file:
+        logger = utils.create_file_logger(log_file, verbose)
+    else:
+        logger = utils.create_io_logger(verbose)
+    ShardWorker(conn, name, static_root, config, logger, parallel).run()
+
+
+class Shard:
+    """Handle of a shard process in the coordinator"""
+
+    def __init__(
+        self,
+        idx,
+        name,
+        static_root,
+        config,
+        verbose="info",
+        log_file="",
+        parallel=1,
+        trace=False,
+        cassette=None,
+        templates=None,
+    ):
+        self.idx = idx
+        self.names = list(config["agents"].keys())
+        context = multiprocessing.get_context("spawn")
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(
+            target=run_shard,
+            args=(child_conn, name, static_root, config, verbose, log_file, parallel, trace, cassette, templates),
+            daemon=True,
+        )
+        self._process.start()
+
+    def send(self, cmd, *args):
+        self._conn.send((cmd, args))
+
+    def recv(self):
+        status, result = self._conn.recv()
+        if status == "error":
+            raise Exception("Shard[{}] failed:\n{}".format(self.idx, result))
+        return result
+
+    def call(self, cmd, *args):
+        self.send(cmd, *args)
+        return self.recv()
+
+    def close(self):
+        self.send("stop")
+        self._process.join()
+
+
+class ShardAgent:
+    """Agent in the coordinator, forwarding the calls to its shard"""
+
+    def __init__(self, name, shard, state):
+        self.name = name
+        self.shard = shard
+        self.info = {}
+        self.update(state)
+
+    def update(self, state):
+        self.state = state
+        self.coord = state["coord"]
+        self.think_config = state["think_config"]
+        self.percept_config = state["percept_config"]
+        self.chat_iter = state["chat_iter"]
+        self.action = memory.Action.from_dict(copy.deepcopy(state["action"]))
+        self.schedule = memory.Schedule(**state["schedule"])
+
+    def _call(self, method, *args):
+        args = [AgentRef(a.name) if isinstance(a, ShardAgent) else a for a in args]
+        return self.shard.call("call", self.name, method, args)
+
+    def completion(self, func_hint, *args):
+        return self._call("completion", func_hint, *args)
+
+    def schedule_chat(self, *args):
+        return self._call("schedule_chat", *args)
+
+    def to_dict(self):
+        return self.info
+
+    get_event = Agent.get_event
+    is_awake = Agent.is_awake
+    next_due = Agent.next_due
+    idle_until = Agent.idle_until
+    _action_due = Agent._action_due
+
+
+class ShardedGame:
+    """The Game with agents split across worker processes"""
+
+    def __init__(
+        self, name, static_root, config, conversation, shards, logger=None, verbose="info", log_file="", parallel=1
+    ):
+        trace = utils.get_tracer() is not None
+        cassette = get_cassette().config if get_cassette() else None
+        templates = get_template_registry().config
+        self.name = name
+        self.static_root = static_root
+        self.logger = logger or utils.IOLogger()
+        self.maze = Maze(utils.load_dict(os.path.join(static_root, config["maze"]["path"])), self.logger)
+        self.conversation = conversation
+        names = list(config["agents"].keys())
+        self.shards = []
+        for idx in range(min(shards, len(names))):
+            s_config = copy.deepcopy(config)
+            s_config["agents"] = {n: config["agents"][n] for n in names[idx::shards]}
+            s_log = ""
+            if log_file:
+                s_log = os.path.join(os.path.dirname(log_file), "shard{}-{}".format(idx, os.path.basename(log_file)))
+            self.shards.append(
+                Shard(idx, name, static_root, s_config, verbose, s_log, parallel, trace, cassette, templates)
+            )
+        self.agents = {}
+        for shard in self.shards:
+            for a_name, state in shard.recv().items():
+                self.agents[a_name] = ShardAgent(a_name, shard, state)
+        states = self.states()
+        for shard in self.shards:
+            shard.call("init", states)
+        for a_name, agent in self.agents.items():
+            proxy = AgentProxy(a_name, self.maze)
+            proxy.update(agent.state)
+            proxy.place()
+
+    def states(self):
+        return {n: a.state for n, a in self.agents.items()}
+
+    def get_agent(self, name):
+        return self.agents[name]
+
+    def agents_think(self, status, pool=None):
+        """Think for all agents, each shard runs its agents in its own process"""
+
+        date, states = utils.get_timer().get_date("%Y%m%d-%H:%M"), self.states()
+        shards = [s for s in self.shards if any(n in status for n in s.names)]
+        for shard in shards:
+            shard.send("think", date, {n: status[n] for n in shard.names if n in status}, states)
+        pending, requests = {}, []
+        for shard in shards:
+            output = shard.recv()
+            pending.update(output["pending"])
+            requests.extend(output["requests"])
+            for key, chats in output["conversation"].items():
+                self.conversation.setdefault(key, []).extend(chats)
+            for name, state in output["states"].items():
+                self.agents[name].update(state)
+
+        # 所有的对话（包括跨进程的对话）由协调进程依次进行，每个Agent在一个step中最多参与一次
+        chatted = set()
+        if requests:
+            states = self.states()
+            for shard in self.shards:
+                shard.call("sync", states)
+            chatted = run_chats(requests, self.agents, self.conversation, self.logger)
+
+        self.maze.commit(pending)
+        for shard in self.shards:
+            shard.send("commit", pending, [n for n in shard.names if n in chatted])
+        results = {}
+        for shard in self.shards:
+            for name, output in shard.recv().items():
+                results[name] = output["result"]
+                self.agents[name].info = output["info"]
+                self.agents[name].update(output["state"])
+        return results
+
+    def reset_game(self):
+        pass
+
+    def close(self):
+        tracer = utils.get_tracer()
+        for shard in self.shards:
+            if tracer:
+                tracer.extend(shard.call("trace"))
+            shard.close()
+
+
+def create_sharded_game(
+    name, static_root, config, conversation, shards, logger=None, verbose="info", log_file="", parallel=1
+):
+    """Create the game running on multiple processes"""
+
+    utils.set_timer(**config.get("time", {}))
+    game = ShardedGame(name, static_root, config, conversation, shards, logger, verbose, log_file, parallel)
+    GenerativeAgentsMap.set(GenerativeAgentsKey.GAME, game)
+    return game
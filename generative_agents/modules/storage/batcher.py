@@ -0,0 +1,150 @@
+"""generative_agents.storage.batcher"""
+
+import json
+import time
+import threading
+import collections
+from concurrent.futures import Future
+
+from modules import utils
+from modules.model.cassette import CassetteMiss
+from modules.model.resilience import backoff_delay
+
+
+class EmbeddingBatcher:
+    """Queue of texts embedded in batches, shared by the agents
+
+    submit() returns a Future of the embedding at once. The background thread
+    sends a batch when size texts are queued, when flush() is called at the end
+    of a step, or max_wait seconds after the first text is queued (0 to disable).
+    wait() embeds the queued texts of the given futures in the calling thread,
+    so an agent reading its memory does not send the texts of other agents.
+
+    A failed batch is retried with backoff, then its texts are embedded one by
+    one, and the futures of the texts still failing get the error.
+    """
+
+    def __init__(self, embed_model, size=0, max_wait=0, retry=None):
+        self._embed_model = embed_model
+        self._size = size or embed_model.embed_batch_size
+        self._max_wait = max_wait
+        self._retry = dict({"attempts": 5, "backoff": 1, "max_backoff": 30}, **(retry or {}))
+        self._queue = collections.OrderedDict()
+        self._cond = threading.Condition()
+        self._flush = False
+        self._summary = {"texts": 0, "batches": 0, "failed": 0}
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, text):
+        future = Future()
+        with self._cond:
+            self._queue[future] = text
+            if len(self._queue) == 1 or len(self._queue) >= self._size:
+                self._cond.notify()
+        return future
+
+    def flush(self):
+        """Send all the queued texts without waiting for a full batch"""
+
+        with self._cond:
+            if self._queue:
+                self._flush = True
+                self._cond.notify()
+
+    def wait(self, futures):
+        """Wait for the futures, the texts still queued are embedded in the calling thread"""
+
+        with self._cond:
+            batch = [(self._queue.pop(f), f) for f in futures if f in self._queue]
+        for i in range(0, len(batch), self._size):
+            self._embed(batch[i : i + self._size])
+        for future in futures:
+            future.exception()
+
+    def get_summary(self):
+        batches = self._summary["batches"]
+        return {
+            "texts": self._summary["texts"],
+            "batches": batches,
+            "batch_size": round(self._summary["texts"] / batches, 1) if batches else 0,
+            "failed": self._summary["failed"],
+        }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                deadline = time.time() + self._max_wait if self._max_wait > 0 else None
+                while self._queue and len(self._queue) < self._size and not self._flush:
+                    remain = deadline - time.time() if deadline else None
+                    if remain is not None and remain <= 0:
+                        break
+                    self._cond.wait(remain)
+                batch = [self._queue.popitem(last=False)[::-1] for _ in range(min(self._size, len(self._queue)))]
+                if not self._queue:
+                    self._flush = False
+            if batch:
+                self._embed(batch)
+
+    def _request(self, texts, attempts):
+        for attempt in range(attempts):
+            try:
+                with utils.trace_span("embed_batch", "embedding", texts=len(texts)):
+                    return self._embed_model.get_text_embedding_batch(texts)
+            except CassetteMiss:
+                raise
+            except Exception as e:  # pylint: disable=broad-except
+                print(f"EmbeddingBatcher._request() caused an error: {e}")
+                if attempt + 1 < attempts:
+                    time.sleep(backoff_delay(attempt, self._retry["backoff"], self._retry["max_backoff"]))
+                else:
+                    raise
+
+    def _embed(self, batch):
+        texts = [t for t, _ in batch]
+        try:
+            embeddings = self._request(texts, self._retry["attempts"])
+        except CassetteMiss as e:
+            embeddings = [e] * len(texts)
+        except Exception:  # pylint: disable=broad-except
+            # 整批失败时逐个请求，只有仍然失败的文本返回错误
+            embeddings = []
+            for text in texts:
+                try:
+                    embeddings.append(self._request([text], 1)[0])
+                except Exception as e:  # pylint: disable=broad-except
+                    embeddings.append(e)
+        self._summary["texts"] += len(texts)
+        self._summary["batches"] += 1
+        for (_, future), embedding in zip(batch, embeddings):
+            if isinstance(embedding, Exception):
+                self._summary["failed"] += 1
+                future.set_exception(embedding)
+            else:
+                future.set_result(embedding)
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def get_embedding_batcher(embedding_config, embed_model, size=0, max_wait=0, retry=None):
+    """Get the batcher of the embedding config shared in the process, so texts of all agents are batched together"""
+
+    key = json.dumps(
+        {k: v for k, v in embedding_config.items() if k not in ("cache", "batch", "retry")}, sort_keys=True
+    )
+    with _batchers_lock:
+        if key not in _batchers:
+            _batchers[key] = EmbeddingBatcher(embed_model, size, max_wait, retry)
+        return _batchers[key]
+
+
+def flush_embedding_batchers():
+    """Send the queued texts of all the batchers, called at the end of each step"""
+
+    with _batchers_lock:
+        batchers = list(_batchers.values())
+    for batcher in batchers:
+        batcher.flush()
@@ -0,0 +1,116 @@
+"""generative_agents.storage.cache"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import collections
+
+
+class SqliteCache:
+    """Persistent key-value cache backed by sqlite, evicting the least recently used entries
+
+    With memory_entries, the recently used entries are also kept in an in-memory LRU.
+    """
+
+    def __init__(self, path, max_entries=100000, memory_entries=0):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._path = path
+        self._max_entries = max_entries
+        self._memory_entries = memory_entries
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # 多个线程共用连接（由self._lock保护），多个分片进程由sqlite的文件锁保护
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, atime REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_atime ON cache (atime)")
+        self._size = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    @staticmethod
+    def make_key(*parts):
+        parts = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(parts.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Get the cached values of the keys, return a dict of the found keys"""
+
+        found, missing = {}, []
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+                else:
+                    missing.append(key)
+            # sqlite单条语句的参数数量有限，分批查询
+            for i in range(0, len(missing), 500):
+                batch = missing[i : i + 500]
+                marks = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    "SELECT key, value FROM cache WHERE key IN ({})".format(marks), batch
+                ).fetchall()
+                if not rows:
+                    continue
+                self._conn.execute(
+                    "UPDATE cache SET atime = ? WHERE key IN ({})".format(",".join("?" * len(rows))),
+                    [time.time()] + [r[0] for r in rows],
+                )
+                for key, value in rows:
+                    found[key] = json.loads(value)
+                    self._remember(key, found[key])
+        return found
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        now = time.time()
+        rows = [(k, json.dumps(v, ensure_ascii=False), now) for k, v in items.items()]
+        with self._lock:
+            for key, value in items.items():
+                self._remember(key, value)
+            before = self._conn.total_changes
+            self._conn.executemany("INSERT OR IGNORE INTO cache (key, value, atime) VALUES (?, ?, ?)", rows)
+            self._size += self._conn.total_changes - before
+            if self._size <= self._max_entries:
+                return
+            # 超出容量时一次淘汰10%，避免每次写入都触发淘汰
+            self._size = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            excess = self._size - int(self._max_entries * 0.9)
+            if excess > 0:
+                self._conn.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY atime LIMIT ?)", (excess,)
+                )
+                self._size -= excess
+
+    def _remember(self, key, value):
+        if self._memory_entries <= 0:
+            return
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._memory_entries:
+            self._memory.popitem(last=False)
+
+    def __len__(self):
+        return self._size
+
+
+_caches, _caches_lock = {}, threading.Lock()
+
+
+def get_sqlite_cache(path, max_entries=100000, memory_entries=0):
+    """Get the cache of the path shared in the process"""
+
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = SqliteCache(path, max_entries, memory_entries)
+        return _caches[path]
@@ -4,50 +4,216 @@ import os
 import time
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
-from llama_index.core.schema import TextNode
+from llama_index.core.schema import TextNode, MetadataMode
 from llama_index import core as index_core
 from llama_index.embeddings.ollama import OllamaEmbedding
 from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.core import Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
 
 from modules import utils
+from modules.model.cassette import CassetteMiss, get_cassette
+from modules.model.pool import get_endpoint_pool
+from .batcher import get_embedding_batcher
+from .cache import get_sqlite_cache
+from .vector_store import NumpyVectorStore
+
+
+class CassetteEmbedding(BaseEmbedding):
+    """Embedding model recorded to / replayed from the cassette"""
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _cassette: object = PrivateAttr()
+
+    def __init__(self, embed_model, cassette):
+        super().__init__(model_name=embed_model.model_name, embed_batch_size=embed_model.embed_batch_size)
+        self._embed_model = embed_model
+        self._cassette = cassette
+
+    def _play(self, kind, text, request):
+        params = {"model": self.model_name, "text": text}
+        return self._cassette.play(kind, params, lambda: request(text))
+
+    def _get_query_embedding(self, query):
+        return self._play("query_embedding", query, self._embed_model.get_query_embedding)
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text):
+        return self._play("text_embedding", text, self._embed_model.get_text_embedding)
+
+    def _get_text_embeddings(self, texts):
+        return [self._get_text_embedding(t) for t in texts]
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Embedding model with the embeddings cached by (model, text), shared by the agents and the runs"""
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _cache: object = PrivateAttr()
+    _summary: dict = PrivateAttr()
+
+    def __init__(self, embed_model, cache):
+        super().__init__(model_name=embed_model.model_name, embed_batch_size=embed_model.embed_batch_size)
+        self._embed_model = embed_model
+        self._cache = cache
+        self._summary = {"hit": 0, "miss": 0}
+
+    def _lookup(self, kind, texts, request):
+        keys = [self._cache.make_key(kind, self.model_name, t) for t in texts]
+        found = self._cache.get_many(keys)
+        # 未命中的文本去重后一次请求
+        missing = {k: t for k, t in zip(keys, texts) if k not in found}
+        self._summary["hit"] += len(keys) - len(missing)
+        self._summary["miss"] += len(missing)
+        if missing:
+            embeddings = dict(zip(missing, request(list(missing.values()))))
+            self._cache.set_many(embeddings)
+            found.update(embeddings)
+        return [found[k] for k in keys]
+
+    def get_query_embedding_batch(self, queries):
+        """Get the query embeddings, the cache is looked up in one batch"""
+
+        return self._lookup(
+            "query_embedding", queries, lambda qs: [self._embed_model.get_query_embedding(q) for q in qs]
+        )
+
+    def get_summary(self):
+        total = sum(self._summary.values())
+        return {
+            "hit": "{}/{}".format(self._summary["hit"], total),
+            "hit_rate": round(self._summary["hit"] / total, 3) if total else 0,
+        }
+
+    def _get_query_embedding(self, query):
+        return self._lookup(
+            "query_embedding", [query], lambda ts: [self._embed_model.get_query_embedding(ts[0])]
+        )[0]
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        return self._lookup("text_embedding", texts, self._embed_model.get_text_embedding_batch)
+
+
+class PooledEmbedding(BaseEmbedding):
+    """Embedding model sending each call to one endpoint of the pool"""
+
+    _embed_models: dict = PrivateAttr()
+    _pool: object = PrivateAttr()
+
+    def __init__(self, embed_models, pool):
+        embed_model = next(iter(embed_models.values()))
+        super().__init__(model_name=embed_model.model_name, embed_batch_size=embed_model.embed_batch_size)
+        self._embed_models = embed_models
+        self._pool = pool
+
+    def _get_query_embedding(self, query):
+        with self._pool.use() as base_url:
+            return self._embed_models[base_url].get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query):
+        with self._pool.use() as base_url:
+            return await self._embed_models[base_url].aget_query_embedding(query)
+
+    def _get_text_embedding(self, text):
+        with self._pool.use() as base_url:
+            return self._embed_models[base_url].get_text_embedding(text)
+
+    def _get_text_embeddings(self, texts):
+        with self._pool.use() as base_url:
+            return self._embed_models[base_url].get_text_embedding_batch(texts)
+
+
+def create_embedding(embedding_config, base_url=None):
+    """Create the embedding model of the endpoint"""
+
+    if embedding_config["provider"] == "hugging_face":
+        return HuggingFaceEmbedding(model_name=embedding_config["model"])
+    if embedding_config["provider"] == "ollama":
+        return OllamaEmbedding(
+            model_name=embedding_config["model"],
+            base_url=base_url,
+            ollama_additional_kwargs={"mirostat": 0},
+        )
+    if embedding_config["provider"] == "openai":
+        return OpenAIEmbedding(
+            model_name=embedding_config["model"],
+            api_base=base_url,
+            api_key=embedding_config["api_key"],
+        )
+    raise NotImplementedError(
+        "embedding provider {} is not supported".format(embedding_config["provider"])
+    )
 
 
 class LlamaIndex:
     def __init__(self, embedding_config, path=None):
         self._config = {"max_nodes": 0}
+        self._retry = dict({"attempts": 5, "backoff": 1, "max_backoff": 30}, **embedding_config.get("retry", {}))
         if embedding_config["provider"] == "hugging_face":
-            embed_model = HuggingFaceEmbedding(model_name=embedding_config["model"])
-        elif embedding_config["provider"] == "ollama":
-            embed_model = OllamaEmbedding(
-                model_name=embedding_config["model"],
-                base_url=embedding_config["base_url"],
-                ollama_additional_kwargs={"mirostat": 0},
-            )
-        elif embedding_config["provider"] == "openai":
-            embed_model = OpenAIEmbedding(
-                model_name=embedding_config["model"],
-                api_base=embedding_config["base_url"],
-                api_key=embedding_config["api_key"],
-            )
+            embed_model = create_embedding(embedding_config)
         else:
-            raise NotImplementedError(
-                "embedding provider {} is not supported".format(embedding_config["provider"])
+            # 配置了多个endpoints时，请求分配到多个服务
+            pool = get_endpoint_pool(embedding_config)
+            embed_models = {u: create_embedding(embedding_config, u) for u in pool.base_urls}
+            if len(embed_models) > 1:
+                embed_model = PooledEmbedding(embed_models, pool)
+            else:
+                embed_model = next(iter(embed_models.values()))
+
+        # 相同文本的embedding只请求一次，缓存由所有agent及之后的运行共用
+        cache = embedding_config.get("cache", {})
+        self._cached_model = None
+        cassette = get_cassette()
+        # 使用cassette时不使用缓存，所有调用都经过cassette录制或回放
+        if cache.get("path") and not cassette:
+            embed_model = self._cached_model = CachedEmbedding(
+                embed_model,
+                get_sqlite_cache(
+                    cache["path"], cache.get("max_entries", 200000), cache.get("memory_entries", 0)
+                ),
             )
 
+        if cassette:
+            embed_model = CassetteEmbedding(embed_model, cassette)
+
         Settings.embed_model = embed_model
+        self._embed_model = embed_model
+        # 新节点的embedding由所有agent共用的队列分批计算，读取索引前再插入本agent等待中的节点
+        batch = embedding_config.get("batch", {})
+        self._batcher, self._pending = None, []
+        if batch.get("enable", False):
+            self._batcher = get_embedding_batcher(
+                embedding_config, embed_model, batch.get("size", 0), batch.get("max_wait", 0), self._retry
+            )
+
         Settings.node_parser = SentenceSplitter(chunk_size=512, chunk_overlap=64)
         Settings.num_output = 1024
         Settings.context_window = 4096
+        # 向量保存在NumpyVectorStore的矩阵中，检索时一次矩阵乘法计算相似度
         if path and os.path.exists(path):
             self._index = index_core.load_index_from_storage(
-                index_core.StorageContext.from_defaults(persist_dir=path),
+                index_core.StorageContext.from_defaults(
+                    persist_dir=path, vector_store=NumpyVectorStore.from_persist_dir(path)
+                ),
                 show_progress=True,
             )
             self._config = utils.load_dict(os.path.join(path, "index_config.json"))
         else:
-            self._index = index_core.VectorStoreIndex([], show_progress=True)
+            self._index = index_core.VectorStoreIndex(
+                [],
+                storage_context=index_core.StorageContext.from_defaults(vector_store=NumpyVectorStore()),
+                show_progress=True,
+            )
         self._path = path
 
     def add_node(
@@ -58,31 +224,65 @@ class LlamaIndex:
         exclude_embedding_keys=None,
         id=None,
     ):
+        node = self._create_node(text, metadata, exclude_llm_keys, exclude_embedding_keys, id)
+        if self._batcher:
+            future = self._batcher.submit(node.get_content(metadata_mode=MetadataMode.EMBED))
+            self._pending.append((node, future))
+            return node
         while True:
             try:
-                metadata = metadata or {}
-                exclude_llm_keys = exclude_llm_keys or list(metadata.keys())
-                exclude_embedding_keys = exclude_embedding_keys or list(metadata.keys())
-                id = id or "node_" + str(self._config["max_nodes"])
-                self._config["max_nodes"] += 1
-                node = TextNode(
-                    text=text,
-                    id_=id,
-                    metadata=metadata,
-                    excluded_llm_metadata_keys=exclude_llm_keys,
-                    excluded_embed_metadata_keys=exclude_embedding_keys,
-                )
-                self._index.insert_nodes([node])
+                with utils.trace_span("add_node", "embedding"):
+                    self._index.insert_nodes([node])
                 return node
+            except CassetteMiss:
+                raise
             except Exception as e:
                 print(f"LlamaIndex.add_node() caused an error: {e}")
                 time.sleep(5)
 
+    def _create_node(self, text, metadata, exclude_llm_keys, exclude_embedding_keys, id):
+        metadata = metadata or {}
+        id = id or "node_" + str(self._config["max_nodes"])
+        self._config["max_nodes"] += 1
+        return TextNode(
+            text=text,
+            id_=id,
+            metadata=metadata,
+            excluded_llm_metadata_keys=exclude_llm_keys or list(metadata.keys()),
+            excluded_embed_metadata_keys=exclude_embedding_keys or list(metadata.keys()),
+        )
+
+    def _insert_pending(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        self._batcher.wait([f for _, f in pending])
+        nodes = []
+        for node, future in pending:
+            if isinstance(future.exception(), CassetteMiss):
+                raise future.exception()
+            if future.exception():
+                # embedding失败的节点只保存到docstore，不参与相似度检索
+                print(f"LlamaIndex.add_node() failed to embed {node.node_id}: {future.exception()}")
+                self._index.index_struct.add_node(node, text_id=node.node_id)
+                self._index.docstore.add_documents([node], allow_update=True)
+            else:
+                node.embedding = future.result()
+                nodes.append(node)
+        with utils.trace_span("add_node", "embedding", nodes=len(nodes)):
+            self._index.insert_nodes(nodes)
+
+    def embed(self, text):
+        with utils.trace_span("embed", "embedding"):
+            return self._embed_model.get_text_embedding(text)
+
     def has_node(self, node_id):
+        self._insert_pending()
         return node_id in self._index.docstore.docs
 
     def find_node(self, node_id):
-        return self._index.docstore.docs[node_id]
+        self._insert_pending()
+        return self._index.docstore.get_node(node_id)
 
     def get_nodes(self, filter=None):
         def _check(node):
@@ -90,18 +290,30 @@ class LlamaIndex:
                 return True
             return filter(node)
 
+        self._insert_pending()
         return [n for n in self._index.docstore.docs.values() if _check(n)]
 
     def remove_nodes(self, node_ids, delete_from_docstore=True):
+        # 等待中的节点直接丢弃，不必等待embedding
+        pending_ids = {n.node_id for n, _ in self._pending}
+        self._pending = [(n, f) for n, f in self._pending if n.node_id not in node_ids]
+        node_ids = [i for i in node_ids if i not in pending_ids]
         self._index.delete_nodes(node_ids, delete_from_docstore=delete_from_docstore)
 
-    def cleanup(self):
-        now, remove_ids = utils.get_timer().get_date(), []
+    def expired_ids(self):
+        """Ids of the nodes out of their lifetime at the current time"""
+
+        self._insert_pending()
+        now, expired_ids = utils.get_timer().get_date(), []
         for node_id, node in self._index.docstore.docs.items():
             create = utils.to_date(node.metadata["create"])
             expire = utils.to_date(node.metadata["expire"])
             if create > now or expire < now:
-                remove_ids.append(node_id)
+                expired_ids.append(node_id)
+        return expired_ids
+
+    def cleanup(self):
+        remove_ids = self.expired_ids()
         self.remove_nodes(remove_ids)
         return remove_ids
 
@@ -113,18 +325,47 @@ class LlamaIndex:
         node_ids=None,
         retriever_creator=None,
     ):
+        self._insert_pending()
         try:
             retriever_creator = retriever_creator or VectorIndexRetriever
-            return retriever_creator(
-                self._index,
-                similarity_top_k=similarity_top_k,
-                filters=filters,
-                node_ids=node_ids,
-            ).retrieve(text)
+            with utils.trace_span("retrieve", "embedding"):
+                return retriever_creator(
+                    self._index,
+                    similarity_top_k=similarity_top_k,
+                    filters=filters,
+                    node_ids=node_ids,
+                ).retrieve(text)
+        except CassetteMiss:
+            raise
         except Exception as e:
             # print(f"LlamaIndex.retrieve() caused an error: {e}")
             return []
 
+    def similarities(self, texts, node_ids=None, filters=None):
+        """Similarities between the texts and the nodes, the texts are embedded as queries
+
+        A failed call is retried once at once, nothing is found when the retry fails.
+        """
+
+        self._insert_pending()
+        # 检索在Agent思考的路径上，不等待退避；持续的服务故障由embedding模型及批处理的重试处理
+        for _ in range(2):
+            try:
+                with utils.trace_span("similarities", "embedding", texts=len(texts)):
+                    embeddings = self._query_embeddings(texts)
+                    return self._index.vector_store.similarities(embeddings, node_ids, filters)
+            except CassetteMiss:
+                raise
+            except Exception as e:
+                print(f"LlamaIndex.similarities() caused an error: {e}")
+        return [], None, []
+
+    def _query_embeddings(self, texts):
+        # 与VectorIndexRetriever一致使用query embedding（部分模型对query添加指令前缀）
+        if hasattr(self._embed_model, "get_query_embedding_batch"):
+            return self._embed_model.get_query_embedding_batch(texts)
+        return [self._embed_model.get_query_embedding(t) for t in texts]
+
     def query(
         self,
         text,
@@ -140,6 +381,7 @@ class LlamaIndex:
             "refine_template": refine_template,
             "filters": filters,
         }
+        self._insert_pending()
         while True:
             try:
                 if query_creator:
@@ -147,15 +389,30 @@ class LlamaIndex:
                 else:
                     query_engine = self._index.as_query_engine(**kwargs)
                 return query_engine.query(text)
+            except CassetteMiss:
+                raise
             except Exception as e:
                 print(f"LlamaIndex.query() caused an error: {e}")
                 time.sleep(5)
 
     def save(self, path=None):
         path = path or self._path
+        self._insert_pending()
         self._index.storage_context.persist(path)
         utils.save_dict(self._config, os.path.join(path, "index_config.json"))
 
     @property
     def nodes_num(self):
-        return len(self._index.docstore.docs)
+        return len(self._index.docstore.docs) + len(self._pending)
+
+    @property
+    def embedding_summary(self):
+        if self._cached_model:
+            return self._cached_model.get_summary()
+        return None
+
+    @property
+    def batch_summary(self):
+        if self._batcher:
+            return self._batcher.get_summary()
+        return None
@@ -0,0 +1,222 @@
+"""generative_agents.storage.vector_store"""
+
+import os
+import json
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    FilterCondition,
+    FilterOperator,
+    MetadataFilter,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+from llama_index.core.vector_stores.utils import node_to_metadata_dict, build_metadata_filter_fn
+
+DEFAULT_PERSIST_FNAME = "default__vector_store.json"
+
+
+class NumpyVectorStore(BasePydanticVectorStore):
+    """In-process vector store keeping the embeddings in one float32 matrix
+
+    The matrix keeps a normalized copy of the embeddings, so the cosine
+    similarities of a query are one matrix-vector product. The top k rows are
+    selected with argpartition. The raw embeddings are kept as they are added,
+    and persisted in the format of SimpleVectorStore.
+    """
+
+    stores_text: bool = False
+
+    _matrix: np.ndarray = PrivateAttr()
+    _embeddings: list = PrivateAttr()
+    _ids: list = PrivateAttr()
+    _rows: dict = PrivateAttr()
+    _ref_doc_ids: list = PrivateAttr()
+    _metadata: list = PrivateAttr()
+    _columns: dict = PrivateAttr()
+
+    def __init__(self, embedding_dict=None, text_id_to_ref_doc_id=None, metadata_dict=None, **kwargs):
+        super().__init__(**kwargs)
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+        self._ids, self._rows, self._ref_doc_ids, self._metadata = [], {}, [], []
+        self._embeddings, self._columns = [], {}
+        text_id_to_ref_doc_id = text_id_to_ref_doc_id or {}
+        metadata_dict = metadata_dict or {}
+        for node_id, embedding in (embedding_dict or {}).items():
+            self._append(
+                node_id, embedding, text_id_to_ref_doc_id.get(node_id, "None"), metadata_dict.get(node_id, {})
+            )
+
+    @classmethod
+    def class_name(cls):
+        return "NumpyVectorStore"
+
+    @property
+    def client(self):
+        return None
+
+    def _append(self, node_id, embedding, ref_doc_id, metadata):
+        if node_id in self._rows:
+            self._remove(node_id)
+        # 原始的embedding用于get及保存，归一化的副本只保存在内存中的矩阵里
+        self._embeddings.append(list(embedding))
+        embedding = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        if norm > 0:
+            embedding = embedding / norm
+        size = len(self._ids)
+        if self._matrix.shape[1] != embedding.shape[0]:
+            assert size == 0, "Embedding dim {} mismatches {}".format(embedding.shape[0], self._matrix.shape[1])
+            self._matrix = np.zeros((16, embedding.shape[0]), dtype=np.float32)
+        elif size == self._matrix.shape[0]:
+            # 容量不足时倍增，避免每次添加都复制矩阵
+            matrix = np.zeros((size * 2, self._matrix.shape[1]), dtype=np.float32)
+            matrix[:size] = self._matrix
+            self._matrix = matrix
+        self._matrix[size] = embedding
+        self._rows[node_id] = size
+        self._ids.append(node_id)
+        self._ref_doc_ids.append(ref_doc_id)
+        self._metadata.append(metadata)
+        self._columns = {}
+
+    def _remove(self, node_id):
+        # 用最后一行填补被删除的行
+        row, last = self._rows.pop(node_id), len(self._ids) - 1
+        if row != last:
+            self._matrix[row] = self._matrix[last]
+            self._embeddings[row] = self._embeddings[last]
+            self._ids[row] = self._ids[last]
+            self._ref_doc_ids[row] = self._ref_doc_ids[last]
+            self._metadata[row] = self._metadata[last]
+            self._rows[self._ids[row]] = row
+        self._ids.pop()
+        self._embeddings.pop()
+        self._ref_doc_ids.pop()
+        self._metadata.pop()
+        self._columns = {}
+
+    def get(self, text_id):
+        return list(self._embeddings[self._rows[text_id]])
+
+    def add(self, nodes, **add_kwargs):
+        for node in nodes:
+            metadata = node_to_metadata_dict(node, remove_text=True, flat_metadata=False)
+            metadata.pop("_node_content", None)
+            self._append(node.node_id, node.get_embedding(), node.ref_doc_id or "None", metadata)
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id, **delete_kwargs):
+        for node_id in [i for i, r in zip(self._ids, self._ref_doc_ids) if r == ref_doc_id]:
+            self._remove(node_id)
+
+    def delete_nodes(self, node_ids=None, filters=None, **delete_kwargs):
+        mask = self._mask(node_ids, filters)
+        for node_id in [self._ids[r] for r in np.flatnonzero(mask)]:
+            self._remove(node_id)
+
+    def clear(self):
+        for node_id in list(self._ids):
+            self._remove(node_id)
+
+    def _column(self, key):
+        if key not in self._columns:
+            self._columns[key] = np.array([m.get(key) for m in self._metadata], dtype=object)
+        return self._columns[key]
+
+    def _filter_mask(self, filters):
+        size = len(self._ids)
+        masks = []
+        for f in filters.filters:
+            if isinstance(f, MetadataFilter) and f.operator == FilterOperator.EQ:
+                masks.append(self._column(f.key) == f.value)
+            else:
+                # 其他条件逐行判断
+                check = build_metadata_filter_fn(
+                    lambda row: self._metadata[row], type(filters)(filters=[f])
+                )
+                masks.append(np.array([check(r) for r in range(size)], dtype=bool))
+        if not masks:
+            return np.ones(size, dtype=bool)
+        if filters.condition == FilterCondition.OR:
+            return np.logical_or.reduce(masks)
+        if filters.condition == FilterCondition.NOT:
+            return ~np.logical_or.reduce(masks)
+        return np.logical_and.reduce(masks)
+
+    def _mask(self, node_ids=None, filters=None):
+        size = len(self._ids)
+        if node_ids is not None:
+            mask = np.zeros(size, dtype=bool)
+            mask[[self._rows[i] for i in node_ids if i in self._rows]] = True
+        else:
+            mask = np.ones(size, dtype=bool)
+        if filters is not None:
+            mask &= self._filter_mask(filters)
+        return mask
+
+    def query(self, query: VectorStoreQuery, **kwargs):
+        if not self._ids or query.query_embedding is None:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+        if query.node_ids is None and query.filters is None:
+            rows = None
+            matrix = self._matrix[: len(self._ids)]
+        else:
+            rows = np.flatnonzero(self._mask(query.node_ids, query.filters))
+            matrix = self._matrix[rows]
+        if matrix.shape[0] == 0:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+        embedding = np.asarray(query.query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        if norm > 0:
+            embedding = embedding / norm
+        scores = matrix @ embedding
+        top_k = min(query.similarity_top_k, scores.shape[0])
+        if top_k < scores.shape[0]:
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            top = np.arange(scores.shape[0])
+        top = top[np.argsort(-scores[top], kind="stable")]
+        if rows is not None:
+            ids = [self._ids[r] for r in rows[top]]
+        else:
+            ids = [self._ids[r] for r in top]
+        return VectorStoreQueryResult(similarities=scores[top].tolist(), ids=ids)
+
+    def similarities(self, embeddings, node_ids=None, filters=None):
+        """Cosine similarities of several embeddings in one matrix product
+
+        Return the ids of the nodes, the similarities in shape of (nodes, embeddings)
+        and the metadata of the nodes.
+        """
+
+        rows = np.flatnonzero(self._mask(node_ids, filters))
+        if len(rows) == 0 or not len(embeddings):
+            return [], np.zeros((len(rows), len(embeddings)), dtype=np.float32), []
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings / np.where(norms > 0, norms, 1)
+        scores = self._matrix[rows] @ embeddings.T
+        return [self._ids[r] for r in rows], scores, [self._metadata[r] for r in rows]
+
+    def to_dict(self):
+        return {
+            "embedding_dict": {i: self._embeddings[r] for i, r in self._rows.items()},
+            "text_id_to_ref_doc_id": {i: self._ref_doc_ids[r] for i, r in self._rows.items()},
+            "metadata_dict": {i: self._metadata[r] for i, r in self._rows.items()},
+        }
+
+    def persist(self, persist_path, fs=None):
+        os.makedirs(os.path.dirname(persist_path) or ".", exist_ok=True)
+        with open(persist_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir):
+        path = os.path.join(persist_dir, DEFAULT_PERSIST_FNAME)
+        if not os.path.exists(path):
+            return cls()
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(**json.load(f))
@@ -4,3 +4,4 @@ from .arguments import *
 from .log import *
 from .namespace import *
 from .timer import *
+from .trace import *
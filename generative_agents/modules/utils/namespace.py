@@ -42,3 +42,6 @@ class GenerativeAgentsKey:
     GAME = "game"
     TIMER = "timer"
     MODELS = "models"
+    TRACER = "tracer"
+    CASSETTE = "cassette"
+    TEMPLATES = "templates"
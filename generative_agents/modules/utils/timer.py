@@ -1,6 +1,8 @@
 """generative_agents.utils.timer"""
 
 import datetime
+import threading
+import contextlib
 
 from .namespace import GenerativeAgentsMap, GenerativeAgentsKey
 
@@ -94,7 +96,25 @@ def set_timer(start=None):
     return GenerativeAgentsMap.get(GenerativeAgentsKey.TIMER)
 
 
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def use_timer(timer):
+    """Use the timer in the current thread, e.g. to prepare the plans of a coming time"""
+
+    previous = getattr(_local, "timer", None)
+    _local.timer = timer
+    try:
+        yield timer
+    finally:
+        _local.timer = previous
+
+
 def get_timer():
+    timer = getattr(_local, "timer", None)
+    if timer:
+        return timer
     if not GenerativeAgentsMap.get(GenerativeAgentsKey.TIMER):
         set_timer()
     return GenerativeAgentsMap.get(GenerativeAgentsKey.TIMER)
@@ -0,0 +1,98 @@
+"""generative_agents.utils.trace"""
+
+import os
+import json
+import time
+import functools
+import threading
+import contextlib
+
+from .namespace import GenerativeAgentsMap, GenerativeAgentsKey
+
+
+class Tracer:
+    """Tracer collecting spans as Chrome trace events"""
+
+    def __init__(self, process_name="main"):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._events = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": self._pid,
+                "args": {"name": process_name},
+            }
+        ]
+
+    @contextlib.contextmanager
+    def span(self, name, cat="step", **args):
+        # 时间戳使用墙上时间，保证多个进程的事件可以合并到同一时间轴
+        ts, start = time.time_ns() // 1000, time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            event = {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": ts,
+                "dur": (time.perf_counter_ns() - start) // 1000,
+                "pid": self._pid,
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+            with self._lock:
+                self._events.append(event)
+
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def extend(self, events):
+        with self._lock:
+            self._events.extend(events)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": self.events(), "displayTimeUnit": "ms"}, f)
+        return path
+
+
+_null_span = contextlib.nullcontext()
+
+
+def set_tracer(tracer):
+    GenerativeAgentsMap.set(GenerativeAgentsKey.TRACER, tracer)
+    return tracer
+
+
+def get_tracer():
+    return GenerativeAgentsMap.get(GenerativeAgentsKey.TRACER)
+
+
+def trace_span(name, cat="step", **args):
+    tracer = GenerativeAgentsMap.get(GenerativeAgentsKey.TRACER)
+    if tracer is None:
+        return _null_span
+    return tracer.span(name, cat, **args)
+
+
+def traced(name=None, cat="step"):
+    """Decorator tracing each call of the function as a span"""
+
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = GenerativeAgentsMap.get(GenerativeAgentsKey.TRACER)
+            if tracer is None:
+                return func(*args, **kwargs)
+            with tracer.span(span_name, cat):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -44,11 +44,14 @@ def index():
         if step >= len(params["all_movement"]):
             step = len(params["all_movement"])-1
 
-        # 重新设置Agent的初始位置
+        # 重新设置Agent的初始位置（快进跳过的step中没有位置数据，需向前查找）
         for agent in params["persona_init_pos"].keys():
             persona_init_pos = params["persona_init_pos"]
-            persona_step_pos = params["all_movement"][f"{step}"]
-            persona_init_pos[agent] = persona_step_pos[agent]["movement"]
+            for s in range(step, 0, -1):
+                persona_step_pos = params["all_movement"][f"{s}"]
+                if agent in persona_step_pos:
+                    persona_init_pos[agent] = persona_step_pos[agent]["movement"]
+                    break
 
     if speed < 0:
         speed = 0
@@ -1,12 +1,17 @@
 import os
 import copy
 import json
+import math
 import argparse
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv, find_dotenv
 
 from modules.game import create_game, get_game
+from modules.shard import create_sharded_game
+from modules.model import Cassette, set_cassette
+from modules.prompt import TemplateRegistry, set_template_registry
 from modules import utils
 
 personas = [
@@ -22,7 +27,7 @@ personas = [
 
 
 class SimulateServer:
-    def __init__(self, name, static_root, checkpoints_folder, config, start_step=0, verbose="info", log_file=""):
+    def __init__(self, name, static_root, checkpoints_folder, config, start_step=0, verbose="info", log_file="", parallel=1, shards=1):
         self.name = name
         self.static_root = static_root
         self.checkpoints_folder = checkpoints_folder
@@ -45,8 +50,15 @@ class SimulateServer:
         else:
             self.logger = utils.create_io_logger(verbose)
 
-        # 创建游戏
-        game = create_game(name, static_root, config, conversation, logger=self.logger)
+        # 创建游戏（shards大于1时，Agent分布在多个进程中运行）
+        if shards > 1:
+            log_path = f"{checkpoints_folder}/{log_file}" if len(log_file) > 0 else ""
+            game = create_sharded_game(
+                name, static_root, config, conversation, shards,
+                logger=self.logger, verbose=verbose, log_file=log_path, parallel=parallel,
+            )
+        else:
+            game = create_game(name, static_root, config, conversation, logger=self.logger)
         game.reset_game()
 
         self.game = get_game()
@@ -67,14 +79,41 @@ class SimulateServer:
             a.think_config["interval"] for a in self.game.agents.values()
         )
         self.start_step = start_step
+        # 并行模式下同时思考的Agent数量
+        self.parallel = parallel
+        self.shards = shards
 
-    def simulate(self, step, stride=0):
+    def simulate(self, step, stride=0, fast_forward=False, max_stride=0):
         timer = utils.get_timer()
-        for i in range(self.start_step, self.start_step + step):
-            title = "Simulate Step[{}/{}, time: {}]".format(i+1, self.start_step + step, timer.get_date())
+        pool = ThreadPoolExecutor(max_workers=self.parallel) if self.parallel > 1 and self.shards < 2 else None
+        i, end_step = self.start_step, self.start_step + step
+        while i < end_step:
+            # 跳过正在睡觉且没有待处理事项的Agent
+            agent_status = self.agent_status
+            if fast_forward and stride > 0:
+                agent_status = {
+                    n: s for n, s in self.agent_status.items() if not self.game.get_agent(n).next_due()
+                }
+                if not agent_status:
+                    # 所有Agent都在睡觉：直接跳到最早需要处理的时间，期间不保存存档
+                    due = min(self.game.get_agent(n).next_due() for n in self.agent_status)
+                    skip = math.ceil((due - timer.get_date()).total_seconds() / 60 / stride)
+                    skip = min(max(skip, 1), end_step - i)
+                    self.logger.info("All agents are sleeping, fast forward {} steps".format(skip))
+                    timer.forward(stride * skip)
+                    i += skip
+                    continue
+
+            title = "Simulate Step[{}/{}, time: {}]".format(i+1, end_step, timer.get_date())
             self.logger.info("\n" + utils.split_line(title, "="))
-            for name, status in self.agent_status.items():
-                plan = self.game.agent_think(name, status)["plan"]
+            with utils.trace_span("step", step=i + 1, time=timer.get_date("%Y%m%d-%H:%M")):
+                results = self.game.agents_think(agent_status, pool)
+            step_stride = stride
+            if max_stride > stride > 0:
+                # 加大的步长不超过剩余的step数
+                step_stride = min(self.adapt_stride(stride, max_stride, results), (end_step - i) * stride)
+            for name, status in agent_status.items():
+                plan = results[name]["plan"]
                 agent = self.game.get_agent(name)
                 if name not in self.config["agents"]:
                     self.config["agents"][name] = {}
@@ -91,21 +130,43 @@ class SimulateServer:
                 {
                     "time": sim_time,
                     "step": i + 1,
+                    "step_stride": step_stride,
                 }
             )
-            # 保存Agent活动数据
-            with open(f"{self.checkpoints_folder}/simulate-{sim_time.replace(':', '')}.json", "w", encoding="utf-8") as f:
-                f.write(json.dumps(self.config, indent=2, ensure_ascii=False))
-            # 保存对话数据
-            with open(f"{self.checkpoints_folder}/conversation.json", "w", encoding="utf-8") as f:
-                f.write(json.dumps(self.game.conversation, indent=2, ensure_ascii=False))
+            with utils.trace_span("checkpoint", "io"):
+                # 保存Agent活动数据
+                with open(f"{self.checkpoints_folder}/simulate-{sim_time.replace(':', '')}.json", "w", encoding="utf-8") as f:
+                    f.write(json.dumps(self.config, indent=2, ensure_ascii=False))
+                # 保存对话数据
+                with open(f"{self.checkpoints_folder}/conversation.json", "w", encoding="utf-8") as f:
+                    f.write(json.dumps(self.game.conversation, indent=2, ensure_ascii=False))
 
             if stride > 0:
-                timer.forward(stride)
+                timer.forward(step_stride)
+                i += step_stride // stride
+            else:
+                i += 1
+        if pool:
+            pool.shutdown()
+
+    # 根据Agent的活跃程度调整步长：没有Agent需要处理时加大步长，可能发生对话或反应时使用基础步长
+    def adapt_stride(self, stride, max_stride, results):
+        if any(r["plan"].get("path") for r in results.values()):
+            return stride
+        timer = utils.get_timer()
+        dues = [a.idle_until(self.game.agents) for a in self.game.agents.values()]
+        if not all(dues):
+            return stride
+        idle = int((min(dues) - timer.get_date()).total_seconds() // 60)
+        # 步长为基础步长的整数倍，保证回放时间轴的连续
+        return min(max(idle // stride, 1), max_stride // stride) * stride
 
     def load_static(self, path):
         return utils.load_dict(os.path.join(self.static_root, path))
 
+    def close(self):
+        self.game.close()
+
 
 # 从存档数据中载入配置，用于断点恢复
 def get_config_from_log(checkpoints_folder):
@@ -125,7 +186,9 @@ def get_config_from_log(checkpoints_folder):
     assets_root = os.path.join("assets", "village")
 
     start_time = datetime.datetime.strptime(config["time"], "%Y%m%d-%H:%M")
-    start_time += datetime.timedelta(minutes=config["stride"])
+    step_stride = config.get("step_stride", config["stride"])
+    start_time += datetime.timedelta(minutes=step_stride)
+    config["step"] += step_stride // config["stride"] - 1
     config["time"] = {"start": start_time.strftime("%Y%m%d-%H:%M")}
     agents = config["agents"]
     for a in agents:
@@ -167,6 +230,16 @@ parser.add_argument("--step", type=int, default=10, help="The simulate step")
 parser.add_argument("--stride", type=int, default=10, help="The step stride in minute")
 parser.add_argument("--verbose", type=str, default="debug", help="The verbose level")
 parser.add_argument("--log", type=str, default="", help="Name of the log file")
+parser.add_argument("--parallel", type=int, default=1, help="The number of agents thinking concurrently in each step")
+parser.add_argument("--shards", type=int, default=1, help="The number of processes the agents are split across")
+parser.add_argument("--max_stride", type=int, default=0, help="The max step stride in minute when the agents are idle, 0 to disable the adaptive stride")
+parser.add_argument("--trace", action="store_true", help="Export the spans of each step as Chrome trace events")
+parser.add_argument("--cassette", type=str, default="", help="The file recording the llm and embedding calls")
+parser.add_argument("--cassette_mode", type=str, default="record", choices=["record", "replay"], help="Record the calls to the cassette, or replay the recorded calls")
+parser.add_argument("--cassette_latency", type=float, default=0, help="The simulated latency in second of each replayed call")
+parser.add_argument("--cassette_seed", type=int, default=0, help="The seed of random in the cassette runs, the same seed must be used to replay")
+parser.add_argument("--reload_prompts", action="store_true", help="Reload the prompt templates when their files are modified")
+parser.add_argument("--fast_forward", action="store_true", help="Skip the sleeping agents and fast forward when all agents are sleeping")
 args = parser.parse_args()
 
 
@@ -200,5 +273,17 @@ if __name__ == "__main__":
 
     static_root = "frontend/static"
 
-    server = SimulateServer(name, static_root, checkpoints_folder, sim_config, start_step, args.verbose, args.log)
-    server.simulate(args.step, args.stride)
+    if args.trace:
+        utils.set_tracer(utils.Tracer())
+    if args.cassette:
+        set_cassette(Cassette(args.cassette, args.cassette_mode, args.cassette_latency, args.cassette_seed))
+    if args.reload_prompts:
+        set_template_registry(TemplateRegistry(hot_reload=True))
+
+    server = SimulateServer(name, static_root, checkpoints_folder, sim_config, start_step, args.verbose, args.log, args.parallel, args.shards)
+    server.simulate(args.step, args.stride, args.fast_forward, args.max_stride)
+    server.close()
+
+    if args.trace:
+        trace_file = datetime.datetime.now().strftime(f"results/traces/{name}/trace-%Y%m%d-%H%M%S.json")
+        print("Trace saved to " + utils.get_tracer().save(trace_file))
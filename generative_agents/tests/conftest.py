@@ -0,0 +1,74 @@
+"""Shared fixtures of the tests, run with `python -m pytest tests` in generative_agents"""
+
+import os
+import sys
+import hashlib
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+
+from modules import utils
+from modules.maze import Maze
+
+
+class HashEmbedding(BaseEmbedding):
+    """Deterministic embedding derived from the hash of the text"""
+
+    def _vector(self, text):
+        seed = int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+        return np.random.RandomState(seed).randn(32).tolist()
+
+    def _get_query_embedding(self, query):
+        return self._vector(query)
+
+    async def _aget_query_embedding(self, query):
+        return self._vector(query)
+
+    def _get_text_embedding(self, text):
+        return self._vector(text)
+
+
+@pytest.fixture
+def timer():
+    return utils.set_timer("20240213-09:30")
+
+
+def _create_maze():
+    config = {
+        "size": [4, 4],
+        "tile_size": 32,
+        "world": "the Ville",
+        "tile_address_keys": ["world", "sector", "arena", "game_object"],
+        "tiles": [
+            {"coord": [1, 1], "address": ["房子", "卧室", "床"]},
+            {"coord": [2, 1], "address": ["房子", "卧室", "床"]},
+            {"coord": [2, 2], "address": ["房子", "厨房"]},
+        ],
+    }
+    return Maze(config, utils.IOLogger())
+
+
+@pytest.fixture
+def create_maze():
+    """Factory of a small maze with a bed on two tiles and a kitchen"""
+
+    return _create_maze
+
+
+@pytest.fixture
+def maze():
+    return _create_maze()
+
+
+@pytest.fixture
+def hash_embedding(monkeypatch):
+    """Replace the embedding models created by LlamaIndex with HashEmbedding"""
+
+    from modules.storage import index
+
+    monkeypatch.setattr(index, "create_embedding", lambda config, base_url=None: HashEmbedding(model_name="hash"))
+    return {"provider": "hash", "model": "hash", "base_url": "http://127.0.0.1:1"}
@@ -0,0 +1,94 @@
+import time
+import random
+import datetime
+
+import pytest
+
+from modules import memory, utils
+from modules.memory.associate import Associate
+
+
+def _baseline_normalize(data, factor=1, t_min=0, t_max=1):
+    min_val, max_val = min(data), max(data)
+    diff = max_val - min_val
+    if diff == 0:
+        return [(t_max - t_min) * factor / 2 for _ in data]
+    return [(d - min_val) * (t_max - t_min) * factor / diff + t_min for d in data]
+
+
+def _baseline_retrieve_focus(associate, focus, retrieve_max=30, reduce_all=True):
+    """retrieve_focus of the baseline: one retriever per focus, the nodes ranked in python"""
+
+    config = associate._retrieve_config
+    node_ids = associate.memory["event"] + associate.memory["thought"]
+    retrieved = {}
+    for text in focus:
+        nodes = associate.index.retrieve(text, similarity_top_k=len(node_ids), node_ids=node_ids)
+        nodes = sorted(nodes, key=lambda n: utils.to_date(n.metadata["access"]), reverse=True)
+        recency = _baseline_normalize(
+            [config["recency_decay"] ** i for i in range(1, len(nodes) + 1)], config["recency_weight"]
+        )
+        relevance = _baseline_normalize([n.score for n in nodes], config["relevance_weight"])
+        importance = _baseline_normalize([n.metadata["poignancy"] for n in nodes], config["importance_weight"])
+        scores = {n.id_: r1 + r2 + i for n, r1, r2, i in zip(nodes, recency, relevance, importance)}
+        nodes = sorted(nodes, key=lambda n: scores[n.id_], reverse=True)[:retrieve_max]
+        if reduce_all:
+            retrieved.update({n.id_: n for n in nodes})
+        else:
+            retrieved[text] = nodes
+    if reduce_all:
+        return [n.id_ for n in retrieved.values()]
+    return {text: [n.id_ for n in nodes] for text, nodes in retrieved.items()}
+
+
+def _create_associates(embedding, num=120):
+    associates = [Associate(None, embedding), Associate(None, embedding)]
+    now = utils.get_timer().get_date()
+    state = random.Random(0)
+    for i in range(num):
+        node_type = state.choice(["event", "thought", "chat"])
+        event = memory.Event("梅", "此时", "事件{}".format(i), describe="梅 做了 事件{}".format(i), address=["房子"])
+        create = now - datetime.timedelta(minutes=state.randint(0, 600))
+        poignancy = state.randint(1, 10)
+        for associate in associates:
+            associate.add_node(node_type, event, poignancy, create=create)
+    return associates
+
+
+def test_retrieve_focus_matches_baseline(timer, hash_embedding):
+    associate, baseline = _create_associates(hash_embedding)
+    focus = ["梅 的计划", "最近发生的重要事件", "约翰"]
+
+    retrieved = associate.retrieve_focus(focus)
+    assert [c.node_id for c in retrieved] == _baseline_retrieve_focus(baseline, focus)
+
+    retrieved = associate.retrieve_focus(focus, 15, reduce_all=False)
+    expected = _baseline_retrieve_focus(baseline, focus, 15, reduce_all=False)
+    assert {t: [c.node_id for c in nodes] for t, nodes in retrieved.items()} == expected
+    assert all(len(nodes) == 15 for nodes in expected.values())
+
+
+def test_retrieve_focus_without_nodes(timer, hash_embedding):
+    associate = Associate(None, hash_embedding)
+    assert associate.retrieve_focus(["梅 的计划"]) == []
+    assert associate.retrieve_focus(["梅 的计划", "约翰"], reduce_all=False) == {"梅 的计划": [], "约翰": []}
+
+
+def test_similarities_retry_once(timer, hash_embedding, monkeypatch):
+    associate = _create_associates(hash_embedding, num=10)[0]
+    index, calls = associate.index, []
+    query_embeddings = index._query_embeddings
+
+    def _flaky(texts):
+        calls.append(texts)
+        if len(calls) % 3:
+            raise ConnectionError("refused")
+        return query_embeddings(texts)
+
+    monkeypatch.setattr(index, "_query_embeddings", _flaky)
+    monkeypatch.setattr(time, "sleep", lambda seconds: pytest.fail("slept in retrieval"))
+    # 失败后只立即重试一次
+    assert index.similarities(["梅 的计划"]) == ([], None, [])
+    assert len(calls) == 2
+    ids, scores, _ = index.similarities(["梅 的计划"])
+    assert len(calls) == 3 and len(ids) == 10 and scores.shape == (10, 1)
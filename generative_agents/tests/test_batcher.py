@@ -0,0 +1,84 @@
+import threading
+
+import pytest
+
+from modules.model.cassette import CassetteMiss
+from modules.storage.batcher import EmbeddingBatcher
+
+RETRY = {"attempts": 2, "backoff": 0.001, "max_backoff": 0.001}
+
+
+class BatchModel:
+    """Embedding model recording the batches, a batch containing a bad text fails"""
+
+    embed_batch_size = 10
+
+    def __init__(self, error=ValueError):
+        self.batches, self.threads = [], []
+        self.error = error
+
+    def get_text_embedding_batch(self, texts):
+        self.batches.append(list(texts))
+        self.threads.append(threading.current_thread())
+        if any(t.startswith("bad") for t in texts):
+            raise self.error("bad text")
+        return [[float(len(t))] for t in texts]
+
+
+def test_batch_on_flush():
+    model = BatchModel()
+    batcher = EmbeddingBatcher(model, size=4, retry=RETRY)
+    futures = [batcher.submit("t" * i) for i in range(1, 4)]
+    # 未凑满一批时等待flush
+    assert not any(f.done() for f in futures)
+    batcher.flush()
+    assert [f.result(5) for f in futures] == [[1.0], [2.0], [3.0]]
+    assert model.batches == [["t", "tt", "ttt"]]
+
+
+def test_batch_when_full():
+    model = BatchModel()
+    batcher = EmbeddingBatcher(model, size=2, retry=RETRY)
+    futures = [batcher.submit(t) for t in ["a", "bb", "ccc"]]
+    assert [f.result(5) for f in futures[:2]] == [[1.0], [2.0]]
+    assert not futures[2].done()
+    batcher.flush()
+    assert futures[2].result(5) == [3.0]
+    assert batcher.get_summary() == {"texts": 3, "batches": 2, "batch_size": 1.5, "failed": 0}
+
+
+def test_wait_in_calling_thread():
+    model = BatchModel()
+    batcher = EmbeddingBatcher(model, size=10, retry=RETRY)
+    other = batcher.submit("其他")
+    futures = [batcher.submit(t) for t in ["a", "bb"]]
+    batcher.wait(futures)
+    # 只计算等待的文本，其他Agent的文本仍在队列中
+    assert [f.result() for f in futures] == [[1.0], [2.0]]
+    assert model.batches == [["a", "bb"]] and model.threads == [threading.current_thread()]
+    assert not other.done()
+    batcher.flush()
+    assert other.result(5) == [2.0]
+
+
+def test_failed_text():
+    model = BatchModel()
+    batcher = EmbeddingBatcher(model, size=3, retry=RETRY)
+    futures = [batcher.submit(t) for t in ["a", "bad", "ccc"]]
+    batcher.wait(futures)
+    # 整批重试后逐个请求，只有失败的文本返回错误
+    assert model.batches == [["a", "bad", "ccc"]] * 2 + [["a"], ["bad"], ["ccc"]]
+    assert futures[0].result() == [1.0] and futures[2].result() == [3.0]
+    with pytest.raises(ValueError):
+        futures[1].result()
+    assert batcher.get_summary()["failed"] == 1
+
+
+def test_cassette_miss():
+    model = BatchModel(error=CassetteMiss)
+    batcher = EmbeddingBatcher(model, size=2, retry=RETRY)
+    futures = [batcher.submit(t) for t in ["a", "bad"]]
+    batcher.wait(futures)
+    # 回放缺少记录时不重试
+    assert len(model.batches) == 1
+    assert all(isinstance(f.exception(), CassetteMiss) for f in futures)
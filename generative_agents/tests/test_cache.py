@@ -0,0 +1,68 @@
+import itertools
+
+from modules.storage import cache
+from modules.model.llm_model import LLMModel
+from modules.storage.cache import SqliteCache
+
+
+def test_evict_least_recently_used(tmp_path, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(cache.time, "time", lambda: next(clock))
+    db = SqliteCache(str(tmp_path / "cache.db"), max_entries=10)
+    for i in range(10):
+        db.set("k{}".format(i), i)
+    assert len(db) == 10
+    # 读取会更新访问时间
+    assert db.get("k0") == 0
+    db.set("k10", 10)
+    # 超出容量时淘汰到90%，最久未访问的k1、k2被淘汰
+    assert len(db) == 9
+    found = db.get_many(["k{}".format(i) for i in range(11)])
+    assert sorted(found) == sorted(["k0"] + ["k{}".format(i) for i in range(3, 11)])
+
+    reopened = SqliteCache(str(tmp_path / "cache.db"), max_entries=10)
+    assert len(reopened) == 9 and reopened.get("k1") is None and reopened.get("k10") == 10
+
+
+def test_memory_entries(tmp_path):
+    db = SqliteCache(str(tmp_path / "cache.db"), memory_entries=2)
+    db.set_many({"a": [1.0], "b": [2.0], "c": [3.0]})
+    assert list(db._memory) == ["b", "c"]
+    assert db.get("a") == [1.0]
+    assert list(db._memory) == ["c", "a"]
+    assert db.get_many(["c", "d"]) == {"c": [3.0]}
+    assert list(db._memory) == ["a", "c"]
+
+
+class CountingModel(LLMModel):
+    """Model answering the number of the requests"""
+
+    def setup(self, config):
+        self.requests = 0
+
+    def _completion(self, prompt, base_url, **kwargs):
+        self.requests += 1
+        return str(self.requests)
+
+
+def _create_model(path):
+    config = {"api_key": "", "model": "counting", "base_url": "http://127.0.0.1:1/v1", "cache": {"path": path}}
+    return CountingModel(config)
+
+
+def test_llm_cache(tmp_path):
+    model = _create_model(str(tmp_path / "llm.db"))
+    assert model.completion("你好", caller="test") == "1"
+    assert model.completion("你好", caller="test") == "1"
+    assert model.completion("再见", caller="test") == "2"
+    assert model.requests == 2
+
+    # 解析失败的缓存结果不使用
+    assert model.completion("你好", callback=int, caller="test") == 1
+    assert model.completion("你好", callback=lambda r: r if r == "3" else None, caller="test") == "3"
+
+
+def test_llm_cache_disabled():
+    model = _create_model("")
+    assert model.completion("你好") == "1"
+    assert model.completion("你好") == "2"
@@ -0,0 +1,50 @@
+import random
+
+import pytest
+
+from modules.model.cassette import Cassette, CassetteMiss
+
+
+def test_record_replay_round_trip(tmp_path):
+    path = str(tmp_path / "calls.jsonl")
+    calls = []
+
+    def _request(response):
+        def _call():
+            calls.append(response)
+            return response
+
+        return _call
+
+    recorder = Cassette(path, "record")
+    recorder.seed_random("20240213-09:30")
+    draws = [random.random() for _ in range(3)]
+    assert recorder.play("llm", {"prompt": "你好"}, _request("第一次")) == "第一次"
+    assert recorder.play("llm", {"prompt": "你好"}, _request("第二次")) == "第二次"
+    assert recorder.play("embedding", {"text": "你好"}, _request([0.1, 0.2])) == [0.1, 0.2]
+    assert len(calls) == 3
+
+    player = Cassette(path, "replay")
+    player.seed_random("20240213-09:30")
+    assert [random.random() for _ in range(3)] == draws
+    # 相同的请求按录制的顺序返回，回放时不会发出请求
+    assert player.play("llm", {"prompt": "你好"}, _request("未录制")) == "第一次"
+    assert player.play("llm", {"prompt": "你好"}, _request("未录制")) == "第二次"
+    assert player.play("embedding", {"text": "你好"}, _request(None)) == [0.1, 0.2]
+    assert len(calls) == 3
+    with pytest.raises(CassetteMiss):
+        player.play("llm", {"prompt": "再见"}, _request("未录制"))
+
+
+def test_seed_changes_draws(tmp_path):
+    path = str(tmp_path / "calls.jsonl")
+    draws = []
+    for seed in (0, 0, 1):
+        Cassette(path, "record", seed=seed).seed_random("20240213-09:30")
+        draws.append(random.random())
+    assert draws[0] == draws[1] != draws[2]
+
+
+def test_replay_requires_file(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        Cassette(str(tmp_path / "missing.jsonl"), "replay")
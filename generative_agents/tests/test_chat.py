@@ -0,0 +1,89 @@
+from modules import agent as agent_module
+from modules.agent import Agent, run_chats
+
+
+class FakeAgent:
+    """Agent with the steps of think replaced by records of the calls"""
+
+    def __init__(self, name, chat_with=None, wait=False):
+        self.name = name
+        self.calls = []
+        self._chat_with, self._wait = chat_with, wait
+        self._chat_request = None
+
+    def move(self, coord, path=None):
+        return {}
+
+    def make_schedule(self):
+        return {"describe": "工作"}, None
+
+    def is_awake(self):
+        return True
+
+    def percept(self):
+        self.calls.append("percept")
+
+    def make_plan(self, agents):
+        self.calls.append("make_plan")
+        if self._chat_with:
+            self._chat_request = {"other": agents[self._chat_with], "focus": {}}
+
+    def reflect(self):
+        self.calls.append("reflect")
+
+    def _wait_other(self, other, focus):
+        self.calls.append("wait " + other.name)
+        return self._wait
+
+    def _plan_action(self):
+        self.calls.append("plan_action")
+
+    def _update_plan(self, events, agents):
+        return {"name": self.name}
+
+
+def _think(agent, agents):
+    return Agent.think(agent, {"coord": [1, 1]}, agents)
+
+
+def test_reflect_after_chat():
+    other = FakeAgent("约翰")
+    agent = FakeAgent("梅", chat_with="约翰")
+    assert _think(agent, {"约翰": other}) is None
+    assert agent.calls == ["percept", "make_plan"]
+
+    assert Agent.resume_think(agent, {"约翰": other}, True) == {"name": "梅"}
+    assert agent.calls == ["percept", "make_plan", "reflect"]
+    assert agent._chat_request is None
+
+
+def test_dropped_request_falls_back():
+    agents = {"约翰": FakeAgent("约翰")}
+    waiting = FakeAgent("梅", chat_with="约翰", wait=True)
+    _think(waiting, agents)
+    Agent.resume_think(waiting, agents, False)
+    assert waiting.calls[2:] == ["wait 约翰", "reflect"]
+
+    planning = FakeAgent("埃迪", chat_with="约翰")
+    _think(planning, agents)
+    Agent.resume_think(planning, agents, False)
+    assert planning.calls[2:] == ["wait 约翰", "plan_action", "reflect"]
+
+
+def test_think_without_chat():
+    agent = FakeAgent("梅")
+    assert _think(agent, {}) == {"name": "梅"}
+    assert agent.calls == ["percept", "make_plan", "reflect"]
+
+
+def test_run_chats_once_per_agent(monkeypatch):
+    chats = []
+    monkeypatch.setattr(
+        agent_module, "run_chat", lambda a, o, chat_iter, conversation, logger: chats.append((a, o, chat_iter))
+    )
+    agents = {n: n for n in ["梅", "约翰", "埃迪", "简"]}
+    requests = [("约翰", "梅", 3), ("埃迪", "约翰", 2), ("梅", "约翰", 4), ("简", "梅", 1)]
+    chatted = run_chats(requests, agents, {}, None)
+    # 按发起者排序依次进行，约翰已经参与对话，梅发起的请求被放弃
+    assert chats == [("埃迪", "约翰", 2), ("简", "梅", 1)]
+    assert chatted == {"埃迪", "约翰", "简", "梅"}
@@ -0,0 +1,76 @@
+import httpx
+import pytest
+
+from modules.memory.decision import DecisionCache
+from modules.model.cassette import CassetteMiss
+
+
+class Spatial:
+    def __init__(self, addresses):
+        self.addresses = addresses
+
+    def has_address(self, address):
+        return address in self.addresses
+
+
+def _embed(text):
+    # 睡觉相关的活动embedding相近
+    return [1.0, 0.1] if "睡" in text else [0.1, 1.0]
+
+
+def _raise(error):
+    def _embed(text):
+        raise error
+
+    return _embed
+
+
+def test_lookup_embedding_errors():
+    cache = DecisionCache(enable=True)
+    cache.add(["睡觉"], ["房子", "卧室", "床"])
+    spatial = Spatial([["房子", "卧室", "床"]])
+    # embedding服务出错时视为未命中
+    assert cache.lookup(["午睡"], spatial, _raise(httpx.ConnectError("refused"))) == []
+    assert cache.lookup(["休息"], spatial, lambda text: [1.0, 0.0] if text == "睡觉" else [1.0]) == []
+    with pytest.raises(CassetteMiss):
+        cache.lookup(["小睡"], spatial, _raise(CassetteMiss("embedding")))
+    with pytest.raises(TypeError):
+        cache.lookup(["打盹"], spatial, _raise(TypeError("bug")))
+
+
+def test_lookup_exact_and_nearest():
+    cache = DecisionCache(enable=True, min_similarity=0.9)
+    spatial = Spatial([["房子", "卧室", "床"], ["房子", "厨房"]])
+    cache.add(["睡觉", "准备睡觉"], ["房子", "卧室", "床"])
+    cache.add(["做饭"], ["房子", "厨房"])
+    # 重复的描述只保留一次
+    assert DecisionCache.make_key(["睡觉", "睡觉"]) == "睡觉"
+    assert cache.lookup(["睡觉", "准备睡觉"], spatial) == ["房子", "卧室", "床"]
+    assert cache.lookup(["午睡"], spatial) == []
+    assert cache.lookup(["午睡"], spatial, _embed) == ["房子", "卧室", "床"]
+    assert cache.lookup(["洗碗"], spatial, _embed) == ["房子", "厨房"]
+    assert cache.lookup(["弹吉他"], spatial, lambda text: [0.7, 0.7] if text == "弹吉他" else _embed(text)) == []
+    assert cache.abstract()["hit"] == "E:1,N:2/5"
+
+
+def test_lookup_drops_unknown_addresses():
+    cache = DecisionCache(enable=True)
+    cache.add(["做饭"], ["房子", "厨房"])
+    assert cache.lookup(["做饭"], Spatial([["房子", "卧室", "床"]])) == []
+    assert cache.decisions == {}
+
+
+def test_max_entries_and_disabled():
+    cache = DecisionCache(enable=True, max_entries=2)
+    for describe in ["睡觉", "做饭", "看书"]:
+        cache.add([describe], ["房子", describe])
+    assert list(cache.decisions) == ["做饭", "看书"]
+    # 再次决定的活动移到最后
+    cache.add(["做饭"], ["房子", "厨房"])
+    cache.add(["睡觉"], ["房子", "卧室"])
+    assert list(cache.decisions) == ["做饭", "睡觉"]
+
+    disabled = DecisionCache(decisions={"做饭": ["房子", "厨房"]})
+    assert disabled.lookup(["做饭"], Spatial([["房子", "厨房"]])) == []
+    disabled.add(["看书"], ["房子"])
+    assert list(disabled.decisions) == ["做饭"]
@@ -0,0 +1,92 @@
+import asyncio
+import threading
+
+import pytest
+
+from modules.model import governor
+from modules.model.governor import Governor
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(governor.time, "time", lambda: now[0])
+    return now
+
+
+def _release(gov, latency, caller=None, error=False):
+    gov.acquire()
+    gov.release(latency, error=error, caller=caller)
+
+
+def test_additive_increase(clock):
+    gov = Governor(initial=2, max_limit=3)
+    # 每个成功的请求limit增加1/limit
+    for _ in range(3):
+        _release(gov, 1.0)
+    assert gov.get_summary()["limit"] == 3
+    for _ in range(10):
+        _release(gov, 1.0)
+    assert gov.get_summary()["limit"] == 3
+
+
+def test_multiplicative_decrease(clock):
+    gov = Governor(initial=8, min_limit=2)
+    _release(gov, 1.0)
+    _release(gov, 1.0, error=True)
+    assert gov.get_summary()["limit"] == 4
+    # 一个平均延迟之内最多减小一次
+    _release(gov, 1.0, error=True)
+    assert gov.get_summary()["limit"] == 4
+    clock[0] += 2
+    _release(gov, 1.0, error=True)
+    clock[0] += 2
+    _release(gov, 1.0, error=True)
+    assert gov.get_summary()["limit"] == 2
+
+
+def test_latency_per_caller(clock):
+    gov = Governor(initial=8)
+    _release(gov, 1.0, caller="poignancy")
+    _release(gov, 20.0, caller="schedule_daily")
+    # 长生成的延迟只与同类请求比较
+    _release(gov, 10.0, caller="schedule_daily")
+    assert gov._limit > 8
+    _release(gov, 5.0, caller="poignancy")
+    assert gov.get_summary()["limit"] == 4
+    assert set(gov.get_summary()["latency"]) == {"poignancy", "schedule_daily"}
+
+
+def test_slot_limits_concurrency():
+    gov = Governor(initial=1, max_limit=1)
+    gov.acquire()
+    acquired = threading.Event()
+
+    def _wait():
+        with gov.slot():
+            acquired.set()
+
+    thread = threading.Thread(target=_wait)
+    thread.start()
+    assert not acquired.wait(0.1) and gov.get_summary()["queue"] == 1
+    gov.release()
+    thread.join(5)
+    assert acquired.is_set() and gov.get_summary()["inflight"] == 0
+
+
+def test_aslot_waits_for_release():
+    gov = Governor(initial=1, max_limit=1)
+    order = []
+
+    async def _request(name):
+        async with gov.aslot():
+            order.append(name + " start")
+            await asyncio.sleep(0.01)
+            order.append(name + " end")
+
+    async def _main():
+        await asyncio.gather(_request("a"), _request("b"))
+
+    asyncio.run(_main())
+    assert order == ["a start", "a end", "b start", "b end"]
+    assert gov.get_summary()["inflight"] == 0 and not gov._async_waiters
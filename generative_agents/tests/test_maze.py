@@ -0,0 +1,80 @@
+import types
+
+from modules import memory
+from modules.agent import AgentView
+
+
+def _subjects(maze, coord):
+    return sorted(e.subject for e in maze.tile_at(coord).get_events())
+
+
+def test_updates_apply_at_once_without_step(maze):
+    maze.put_event((2, 2), memory.Event("梅", "正在", "做饭"), owner="梅")
+    assert _subjects(maze, (2, 2)) == ["梅"]
+
+
+def test_buffered_updates_apply_on_commit(maze):
+    maze.begin_step()
+    maze.put_event((2, 2), memory.Event("梅", "正在", "做饭"), owner="梅")
+    maze.update_obj((1, 1), memory.Event("床", "被占用", "梅", address=["the Ville", "房子", "卧室", "床"]), owner="梅")
+    assert _subjects(maze, (2, 2)) == []
+    assert all(e.predicate == "此时" for e in maze.tile_at((1, 1)).get_events())
+    assert list(maze.pending()) == ["梅"]
+
+    maze.commit()
+    assert _subjects(maze, (2, 2)) == ["梅"]
+    # 物体事件更新到该物体所有的Tile
+    for coord in [(1, 1), (2, 1)]:
+        assert [e.predicate for e in maze.tile_at(coord).get_events()] == ["被占用"]
+    maze.put_event((1, 2), memory.Event("约翰"), owner="约翰")
+    assert _subjects(maze, (1, 2)) == ["约翰"]
+
+
+def test_commit_in_owner_order(create_maze):
+    results = []
+    for owners in (["约翰", "梅"], ["梅", "约翰"]):
+        maze = create_maze()
+        maze.begin_step()
+        for owner in owners:
+            maze.remove_events((1, 1), "床", owner=owner)
+            maze.put_event((1, 1), memory.Event("床", "被占用", owner), owner=owner)
+        maze.commit()
+        results.append([str(e) for e in maze.tile_at((1, 1)).get_events()])
+    # 与记录的顺序无关，按owner排序后依次生效
+    assert results[0] == results[1] == ["床 被占用 约翰"]
+
+
+def test_commit_given_pending(maze, create_maze):
+    replica = create_maze()
+    maze.begin_step()
+    maze.put_event((2, 2), memory.Event("梅", "正在", "做饭"), owner="梅")
+    replica.commit(maze.pending())
+    assert _subjects(replica, (2, 2)) == ["梅"]
+
+
+def test_agent_view_is_frozen(timer, maze):
+    action = memory.Action(memory.Event("梅", "正在", "做饭", address=["the Ville", "房子", "厨房"]), duration=30)
+    agent = types.SimpleNamespace(
+        name="梅",
+        maze=maze,
+        coord=[2, 2],
+        path=[[2, 1]],
+        action=action,
+        schedule=memory.Schedule(daily_schedule=[{"idx": 0, "describe": "做饭", "start": 0, "duration": 60}]),
+        think_config={"interval": 10},
+        percept_config={"vision_r": 3},
+        chat_iter=4,
+    )
+    view = AgentView.snapshot(agent)
+    agent.coord, agent.path = [1, 1], []
+    agent.action = memory.Action(memory.Event("梅", "正在", "睡觉", address=["the Ville", "房子", "卧室", "床"]))
+    agent.schedule.daily_schedule.clear()
+
+    assert view.coord == [2, 2] and view.path == [[2, 1]]
+    assert view.get_event().object == "做饭"
+    assert len(view.schedule.daily_schedule) == 1
+    assert view.get_tile().get_address() == ["the Ville", "房子", "厨房"]
+
+    other = types.SimpleNamespace(name="约翰", chat_iter=3)
+    view.request_chat(other)
+    assert view.requests == [("约翰", "梅", 3)]
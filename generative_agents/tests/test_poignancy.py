@@ -0,0 +1,94 @@
+import types
+
+from modules import memory
+from modules.agent import Agent
+from modules.memory.associate import PoignancyEstimator
+
+
+class Scorer:
+    """Agent scoring the events with the responses of the prompts"""
+
+    def __init__(self, batch, estimates=None):
+        self.think_config = {"poignancy_batch": batch}
+        self.estimates = estimates or {}
+        self.calls, self.observed = [], []
+        self.associate = types.SimpleNamespace(
+            estimate_poignancy=lambda e_type, describe: self.estimates.get(describe, (None, "miss")),
+            observe_poignancy=lambda estimate, kind, score: self.observed.append((kind, score)),
+        )
+
+    def llm_available(self):
+        return True
+
+    def completion(self, func_hint, *args):
+        self.calls.append(func_hint)
+        if func_hint == "poignancy_batch":
+            return [7] * len(args[0])
+        return 2 if func_hint == "poignancy_chat" else 3
+
+
+def _events():
+    return [
+        ("event", memory.Event("约翰", "正在", "做饭")),
+        ("chat", memory.Event("梅", "对话", "约翰", describe="梅和约翰聊起了考试")),
+        ("event", memory.Event("埃迪", "正在", "弹吉他")),
+    ]
+
+
+def test_score_one_by_one():
+    agent = Scorer(False)
+    assert Agent._score_poignancy(agent, _events()) == [3, 2, 3]
+    assert agent.calls == ["poignancy_event", "poignancy_chat", "poignancy_event"]
+
+
+def test_score_in_batch():
+    agent = Scorer(True, estimates={"约翰 正在 做饭": (4, "hit")})
+    # 本地估计的事件不需要LLM评分
+    assert Agent._score_poignancy(agent, _events()) == [4, 7, 7]
+    assert agent.calls == ["poignancy_batch"]
+    assert agent.observed == [("miss", 7), ("miss", 7)]
+
+    agent = Scorer(True)
+    assert Agent._score_poignancy(agent, _events()[:1]) == [3]
+    assert agent.calls == ["poignancy_event"]
+
+
+class FailedBatch(Scorer):
+    def completion(self, func_hint, *args):
+        if func_hint == "poignancy_batch":
+            self.calls.append(func_hint)
+            return None
+        return super().completion(func_hint, *args)
+
+
+def test_score_batch_fallback():
+    agent = FailedBatch(True)
+    assert Agent._score_poignancy(agent, _events()) == [3, 2, 3]
+    assert agent.calls == ["poignancy_batch", "poignancy_event", "poignancy_chat", "poignancy_event"]
+
+
+def _nodes(*pairs):
+    return [types.SimpleNamespace(score=score, metadata={"poignancy": p}) for score, p in pairs]
+
+
+def test_estimate():
+    estimator = PoignancyEstimator(min_similarity=0.9, min_neighbors=2, max_spread=2, audit=0)
+    # 相似度加权平均，相似度不足的节点不参与估计
+    assert estimator.estimate(_nodes((0.95, 4), (0.92, 6), (0.5, 10))) == (5, "hit")
+    assert estimator.estimate(_nodes((0.95, 4), (0.5, 6))) == (4, "novel")
+    assert estimator.estimate(_nodes((0.95, 2), (0.95, 8))) == (5, "novel")
+    assert estimator.estimate(_nodes((0.5, 2), (None, 8))) == (None, "novel")
+    assert estimator.estimate([]) == (None, "novel")
+    assert estimator.get_summary()["hit"] == "1/5"
+
+
+def test_audit_and_errors():
+    estimator = PoignancyEstimator(audit=1)
+    estimate, kind = estimator.estimate(_nodes((0.95, 4), (0.95, 4)))
+    assert (estimate, kind) == (4, "audit")
+    estimator.observe(estimate, kind, 6)
+    estimator.observe(5, "novel", 4)
+    estimator.observe(None, "novel", 4)
+    estimator.observe(3, "hit", 9)
+    summary = estimator.get_summary()
+    assert summary["audit_error"] == 2 and summary["novel_error"] == 1 and summary["hit_rate"] == 0
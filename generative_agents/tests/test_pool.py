@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+
+from modules.model.pool import EndpointPool, get_endpoint_pool, get_endpoints
+
+
+def _create_pool(**kwargs):
+    endpoints = [{"base_url": "http://a", "weight": 2}, {"base_url": "http://b", "weight": 1}]
+    return EndpointPool(endpoints, **kwargs)
+
+
+def test_least_outstanding_by_weight():
+    pool = _create_pool()
+    # 按权重分配：a的权重为2，承担2/3的请求
+    urls = [pool.acquire().base_url for _ in range(6)]
+    assert urls.count("http://a") == 4 and urls.count("http://b") == 2
+    assert pool.get_summary() == {"http://a": "ok:4", "http://b": "ok:2"}
+
+
+def test_eject_and_admit(monkeypatch):
+    pool = _create_pool(eject_after=2, check_interval=0.01)
+    healthy = threading.Event()
+    monkeypatch.setattr(pool, "health_check", lambda base_url: healthy.is_set())
+    endpoint = pool._endpoints[0]
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            with pool.use():
+                pool._endpoints[1].outstanding += 10
+                raise ValueError("error")
+    # 连续出错后被移除，请求都分配到其他服务
+    assert endpoint.ejected is not None
+    assert all(pool.acquire().base_url == "http://b" for _ in range(3))
+
+    healthy.set()
+    pool._checker.join(5)
+    assert endpoint.ejected is None and endpoint.failures == 0
+    assert pool.acquire().base_url == "http://a"
+
+
+def test_success_resets_failures():
+    pool = _create_pool(eject_after=2)
+    endpoint = pool._endpoints[0]
+    pool.release(pool.acquire(), False)
+    with pool.use() as base_url:
+        assert base_url == "http://a"
+    pool.release(pool.acquire(), False)
+    assert endpoint.failures == 1 and endpoint.ejected is None
+
+
+def test_single_endpoint_is_never_ejected():
+    pool = EndpointPool([{"base_url": "http://a"}], eject_after=1)
+    for _ in range(3):
+        pool.release(pool.acquire(), False)
+    assert pool.get_summary() == {"http://a": "ok:0"}
+
+
+def test_shared_pool():
+    config = {"base_url": "http://pool-test"}
+    assert get_endpoints(config) == [{"base_url": "http://pool-test", "weight": 1}]
+    assert get_endpoint_pool(config) is get_endpoint_pool(dict(config, model="other"))
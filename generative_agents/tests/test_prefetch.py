@@ -0,0 +1,85 @@
+import types
+import datetime
+import threading
+
+from modules import agent as agent_module
+from modules import memory, utils
+from modules.agent import Agent
+from modules.memory.associate import Associate
+
+
+class Sleeper:
+    """Agent sleeping through the midnight, the draft waits for release"""
+
+    _prefetch_schedule = Agent._prefetch_schedule
+    close = Agent.close
+
+    def __init__(self):
+        self.name, self.logger = "梅", utils.IOLogger()
+        self.think_config = {"prefetch": {"enable": True}}
+        self.schedule = memory.Schedule(
+            create=utils.get_timer().get_date("%Y%m%d-%H:%M:%S"),
+            daily_schedule=[{"idx": 0, "describe": "睡觉", "start": 0, "duration": 24 * 60}],
+        )
+        self.associate = types.SimpleNamespace(memory={"event": ["e1"], "thought": [], "chat": []})
+        self._prefetch, self._prefetch_llm, self._prefetch_executor = None, None, None
+        self.release = threading.Event()
+        self.retrieved = []
+
+    def llm_available(self):
+        return False
+
+    def _retrieve_schedule_focus(self, read_only=False):
+        self.retrieved.append((utils.get_timer().get_date("%Y%m%d-%H:%M"), read_only))
+        return ["e1"]
+
+    def _draft_schedule(self, retrieved, llm=None):
+        self.release.wait(5)
+        return {"retrieved": retrieved, "date": utils.get_timer().get_date("%Y%m%d")}
+
+
+def test_prefetch_on_agent_executor(timer):
+    agent = Sleeper()
+    agent._prefetch_schedule()
+    # 以次日零点只读地检索记忆
+    assert agent.retrieved == [("20240214-00:00", True)]
+    midnight, snapshot, future = agent._prefetch
+    assert snapshot == {"e1"} and agent._prefetch_executor is not None
+    agent.release.set()
+    assert future.result(5) == {"retrieved": ["e1"], "date": "20240214"}
+
+    agent.close()
+    assert agent._prefetch is None and agent._prefetch_executor is None
+
+
+def test_close_stops_executor(timer):
+    agent = Sleeper()
+    agent._prefetch_schedule()
+    executor = agent._prefetch_executor
+    agent.close()
+    agent.release.set()
+    assert agent._prefetch is None and executor._shutdown
+
+
+def test_no_prefetch_with_cassette(timer, monkeypatch):
+    agent = Sleeper()
+    monkeypatch.setattr(agent_module, "get_cassette", lambda: object())
+    agent._prefetch_schedule()
+    assert agent._prefetch is None and agent.retrieved == []
+
+
+def test_read_only_retrieve(timer, hash_embedding):
+    associate = Associate(None, hash_embedding)
+    now = utils.get_timer().get_date()
+    for i in range(4):
+        event = memory.Event("梅", "此时", "事件{}".format(i), describe="梅 做了 事件{}".format(i), address=["房子"])
+        # 事件0在零点之前过期
+        expire = now + datetime.timedelta(hours=1 if i == 0 else 48)
+        associate.add_node("event", event, 5, create=now - datetime.timedelta(hours=i), expire=expire)
+    accesses = {c.node_id: c.access for c in associate.retrieve_focus(["事件"])}
+    with utils.use_timer(utils.Timer("20240214-00:00")):
+        retrieved = associate.retrieve_focus(["事件"], read_only=True)
+    assert sorted(c.describe for c in retrieved) == ["梅 做了 事件{}".format(i) for i in range(1, 4)]
+    # 不清理索引，也不更新访问时间
+    assert len(associate.memory["event"]) == 4
+    assert {c.node_id: c.access for c in associate.retrieve_focus(["事件"])} == accesses
@@ -0,0 +1,47 @@
+import random
+
+import pytest
+
+from modules.model import resilience
+from modules.model.resilience import CircuitBreaker, backoff_delay
+
+
+def test_backoff_delay():
+    random.seed(0)
+    for attempt in range(10):
+        delay = min(2 * 2**attempt, 30)
+        for _ in range(20):
+            assert delay / 2 <= backoff_delay(attempt, 2, 30) <= delay
+    assert backoff_delay(20, 1, 5) <= 5
+
+
+def test_circuit_breaker(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(resilience.time, "time", lambda: now[0])
+    breaker = CircuitBreaker(threshold=2, cooldown=60)
+    breaker.record(False)
+    assert breaker.state == "closed" and breaker.allow()
+    # 成功的请求会重置连续错误的计数
+    breaker.record(True)
+    breaker.record(False)
+    assert breaker.state == "closed"
+    breaker.record(False)
+    assert breaker.state == "open" and not breaker.allow()
+
+    # 冷却时间之后只放行一个探测请求
+    now[0] += 60
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record(True)
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_circuit_breaker_watch():
+    breaker = CircuitBreaker(threshold=1, cooldown=60)
+    with breaker.watch():
+        pass
+    assert breaker.state == "closed"
+    with pytest.raises(ConnectionError):
+        with breaker.watch():
+            raise ConnectionError("refused")
+    assert breaker.state == "open"
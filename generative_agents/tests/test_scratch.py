@@ -0,0 +1,167 @@
+import types
+
+import pytest
+
+from modules import memory
+from modules.agent import _chat_turn
+from modules.prompt.scratch import Scratch, estimate_tokens
+
+
+def _create_scratch(budget=None):
+    config = {
+        "age": 20,
+        "innate": "友好",
+        "learned": "梅是一名学生。",
+        "lifestyle": "梅每天早上7点起床。",
+        "daily_plan": "上课",
+    }
+    return Scratch("梅", "梅正在准备考试。", config, budget)
+
+
+def _create_agent(name, maze, nodes=None):
+    associate = types.SimpleNamespace(
+        retrieve_focus=lambda focus, retrieve_max: list(nodes or []), retrieve_chats=lambda name: []
+    )
+    event = memory.Event(name, "正在", "做饭", address=["the Ville", "房子", "厨房"])
+    return types.SimpleNamespace(
+        name=name, associate=associate, get_tile=lambda: maze.tile_at((2, 2)), get_event=lambda: event
+    )
+
+
+@pytest.fixture
+def chat_turn(timer, maze):
+    scratch = _create_scratch()
+    prompt = scratch.prompt_generate_chat_turn(_create_agent("梅", maze), _create_agent("约翰", maze), "朋友", [])
+    return prompt["callback"]
+
+
+def test_chat_turn_prompt(timer, maze):
+    chats = [("约翰", "你好")]
+    agent, other = _create_agent("梅", maze), _create_agent("约翰", maze)
+    prompt = _create_scratch().prompt_generate_chat_turn(agent, other, "朋友", chats)
+    assert "约翰: 你好" in prompt["prompt"] and prompt["failsafe"] is None
+
+
+def test_parse_chat_turn(chat_turn):
+    response = '好的：\n{"梅": "“你好，约翰！”\\n\\n", "重复": "否", "结束": "是。"}'
+    assert chat_turn(response) == ("你好，约翰！", False, True)
+    assert chat_turn('{"梅": "再见", "重复": true, "结束": false}') == ("再见", True, False)
+
+
+@pytest.mark.parametrize(
+    "response",
+    [
+        "你好，约翰！",
+        '{"梅": "你好", "重复": "不是", "结束": "否"}',
+        '{"梅": "你好", "重复": "否"}',
+        '{"约翰": "你好", "重复": "否", "结束": "否"}',
+    ],
+)
+def test_parse_chat_turn_failure(chat_turn, response):
+    with pytest.raises(Exception):
+        chat_turn(response)
+
+
+class Speaker:
+    """Speaker answering the prompts from the given responses"""
+
+    def __init__(self, fused, responses):
+        self.name, self.think_config = "梅", {"fused_chat": fused}
+        self.responses, self.calls = responses, []
+
+    def completion(self, func_hint, *args):
+        self.calls.append(func_hint)
+        return self.responses[func_hint]
+
+
+def test_fused_chat_turn():
+    responses = {"generate_chat_turn": ("你好", True, True)}
+    speaker = Speaker(True, responses)
+    assert _chat_turn(speaker, None, "", [], True, True) == ("你好", True, True)
+    # 不检查的标记被忽略
+    assert _chat_turn(speaker, None, "", [], False, False) == ("你好", False, False)
+    assert speaker.calls == ["generate_chat_turn"] * 2
+
+
+def test_fused_chat_turn_fallback():
+    responses = {
+        "generate_chat_turn": None,
+        "generate_chat": "你好",
+        "generate_chat_check_repeat": False,
+        "decide_chat_terminate": True,
+    }
+    speaker = Speaker(True, responses)
+    assert _chat_turn(speaker, None, "", [], True, True) == ("你好", False, True)
+    assert speaker.calls == ["generate_chat_turn", "generate_chat", "generate_chat_check_repeat", "decide_chat_terminate"]
+
+    speaker = Speaker(False, responses)
+    assert _chat_turn(speaker, None, "", [], True, True) == ("你好", False, True)
+    assert "generate_chat_turn" not in speaker.calls
+
+
+def _events():
+    return [
+        ("event", memory.Event("约翰", "正在", "做饭")),
+        ("chat", memory.Event("梅", "对话", "约翰", describe="梅和约翰聊起了考试")),
+        ("event", memory.Event("埃迪", "正在", "弹吉他")),
+    ]
+
+
+def test_poignancy_batch_prompt(timer):
+    prompt = _create_scratch().prompt_poignancy_batch(_events())
+    assert "1. [事件] 约翰 正在 做饭" in prompt["prompt"] and "2. [对话] 梅和约翰聊起了考试" in prompt["prompt"]
+    callback = prompt["callback"]
+    assert callback("1. 评分：3\n2、 约翰的事 评分: 12\n3: 1\n1. 9") == [3, 10, 1]
+    with pytest.raises(AssertionError):
+        callback("1. 3\n3. 5")
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("你好，世界。") == 6
+    assert estimate_tokens("hello world!") == 3
+    # 非中文字符约4个1个token，向上取整
+    assert estimate_tokens("梅 says hi") == 1 + 2
+
+
+def _budget_sections(scratch, template):
+    nodes = [types.SimpleNamespace(describe="记忆{}".format(i) * 20) for i in range(10)]
+    chats = [("梅" if i % 2 else "约翰", "对话{}".format(i) * 10) for i in range(10)]
+    data = {
+        "agent": "梅",
+        "base_desc": "",
+        "address": "房子，厨房",
+        "current_time": "09:30",
+        "previous_context": "",
+        "current_context": "",
+        "another": "约翰",
+    }
+    sections = {
+        "memory": (nodes, lambda ns: "\n".join(n.describe for n in ns), "head"),
+        "conversation": (chats, lambda cs: "\n".join("{}: {}".format(n, t) for n, t in cs), "tail"),
+    }
+    return scratch.build_budget_prompt(template, data, sections)
+
+
+def test_build_budget_prompt(timer):
+    prompt, kept = _budget_sections(_create_scratch(), "generate_chat")
+    full = estimate_tokens(prompt)
+    assert len(kept["memory"]) == len(kept["conversation"]) == 10
+
+    scratch = _create_scratch({"default": 0, "generate_chat": full - 200})
+    prompt, kept = _budget_sections(scratch, "generate_chat")
+    assert estimate_tokens(prompt) <= full - 200
+    # 保留排序靠前的记忆及最近的对话
+    assert [n.describe[:3] for n in kept["memory"]] == ["记忆{}".format(i) for i in range(len(kept["memory"]))]
+    assert kept["conversation"][-1][1].startswith("对话9")
+    assert 0 < len(kept["memory"]) + len(kept["conversation"]) < 20
+
+    # 未指定的调用使用default
+    prompt, kept = _budget_sections(scratch, "generate_chat_turn")
+    assert len(kept["memory"]) == 10
+
+
+def test_build_budget_prompt_too_small(timer):
+    prompt, kept = _budget_sections(_create_scratch({"generate_chat": 1}), "generate_chat")
+    assert kept == {"memory": [], "conversation": []}
+    assert "记忆0" not in prompt and "对话9" not in prompt
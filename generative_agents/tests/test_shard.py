@@ -0,0 +1,159 @@
+import threading
+import multiprocessing
+
+from modules import memory
+from modules.agent import agent_state
+from modules.game import Game
+from modules.shard import AgentProxy, AgentRef, ShardAgent, ShardWorker
+
+
+def _action(name, describe, address):
+    return memory.Action(memory.Event(name, "正在", describe, address=address), duration=30)
+
+
+class LocalAgent:
+    """Agent owned by the shard, think moves to the kitchen and requests a chat"""
+
+    def __init__(self, name, maze, chat_with=None):
+        self.name, self.maze = name, maze
+        self.coord, self.path = [1, 1], []
+        self.action = _action(name, "睡觉", ["the Ville", "房子", "卧室", "床"])
+        self.schedule = memory.Schedule()
+        self.think_config, self.percept_config, self.chat_iter = {"interval": 10}, {"vision_r": 3}, 4
+        self._chat_with = chat_with
+        self.calls = []
+
+    def think(self, status, agents):
+        self.coord = status["coord"]
+        self.action = _action(self.name, "做饭", ["the Ville", "房子", "厨房"])
+        self.maze.put_event(self.coord, self.action.event, owner=self.name)
+        if self._chat_with:
+            agents[self._chat_with].request_chat(self)
+            self.calls.append("seen {}".format(agents[self._chat_with].coord))
+            return None
+        return {"name": self.name}
+
+    def resume_think(self, agents, chatted):
+        self.calls.append("resume {}".format(chatted))
+        return {"name": self.name, "resumed": True}
+
+    def replan(self, agents):
+        self.calls.append("replan")
+        return {"name": self.name, "replan": True}
+
+    def close(self):
+        self.calls.append("close")
+
+    def greet(self, other):
+        return "{} -> {}".format(self.name, other.name)
+
+    def to_dict(self):
+        return {"name": self.name}
+
+
+class FakeGame:
+    begin_step = Game.begin_step
+    pop_chat_requests = Game.pop_chat_requests
+    agent_think = Game.agent_think
+    agent_resume = Game.agent_resume
+    get_agent = Game.get_agent
+
+    def __init__(self, maze, agents):
+        self.maze, self.agents, self.conversation = maze, agents, {}
+
+    def agent_result(self, name, plan):
+        return {"plan": plan}
+
+
+def _create_worker(maze, local):
+    worker = ShardWorker.__new__(ShardWorker)
+    worker.game = FakeGame(maze, {a.name: a for a in local})
+    worker.local = [a.name for a in local]
+    worker._pool = None
+    worker._views, worker._plans = {}, {}
+    return worker
+
+
+def _state(name, maze, coord):
+    other = LocalAgent(name, maze)
+    other.coord = coord
+    return agent_state(other)
+
+
+def test_proxy_is_a_copy(timer, maze):
+    state = _state("约翰", maze, [2, 1])
+    proxy = AgentProxy("约翰", maze)
+    proxy.update(state)
+    state["coord"][0] = 3
+    assert proxy.coord == [2, 1] and proxy.get_event().object == "睡觉"
+    proxy.place()
+    assert "约翰" in [e.subject for e in maze.tile_at((2, 1)).get_events()]
+
+
+def test_think_and_commit(timer, maze):
+    agent = LocalAgent("梅", maze, chat_with="约翰")
+    worker = _create_worker(maze, [agent])
+    worker.on_init({"梅": agent_state(agent), "约翰": _state("约翰", maze, [2, 1])})
+    assert isinstance(worker.game.agents["约翰"], AgentProxy)
+
+    output = worker.on_think("20240213-09:40", {"梅": {"coord": [2, 2]}}, {"约翰": _state("约翰", maze, [1, 2])})
+    # 远端的Agent先同步状态，本地Agent的事件在commit之前不生效
+    assert agent.calls == ["seen [1, 2]"]
+    assert output["requests"] == [("梅", "约翰", 4)]
+    assert list(output["pending"]) == ["梅"]
+    assert output["states"]["梅"]["coord"] == [2, 2]
+    assert "梅" not in [e.subject for e in maze.tile_at((2, 2)).get_events()]
+
+    results = worker.on_commit(output["pending"], ["梅"])
+    assert agent.calls[-1] == "resume True"
+    assert results["梅"]["result"] == {"plan": {"name": "梅", "resumed": True}}
+    assert "梅" in [e.subject for e in maze.tile_at((2, 2)).get_events()]
+
+
+def test_replan_chatted_agent(timer, maze):
+    agent = LocalAgent("梅", maze)
+    worker = _create_worker(maze, [agent])
+    output = worker.on_think("20240213-09:40", {"梅": {"coord": [2, 2]}}, {})
+    assert output["requests"] == []
+    results = worker.on_commit(output["pending"], ["梅"])
+    assert agent.calls == ["replan"] and results["梅"]["result"]["plan"]["replan"]
+
+
+def test_run_commands(timer, maze):
+    parent, child = multiprocessing.Pipe()
+    worker = _create_worker(maze, [LocalAgent("梅", maze), LocalAgent("约翰", maze)])
+    worker._conn = child
+    thread = threading.Thread(target=worker.run)
+    thread.start()
+    status, states = parent.recv()
+    assert status == "ok" and sorted(states) == ["梅", "约翰"]
+
+    parent.send(("call", ("梅", "greet", [AgentRef("约翰")])))
+    assert parent.recv() == ("ok", "梅 -> 约翰")
+    parent.send(("call", ("梅", "unknown", [])))
+    status, error = parent.recv()
+    assert status == "error" and "AttributeError" in error
+    parent.send(("stop", ()))
+    thread.join(5)
+    assert not thread.is_alive()
+    assert all(a.calls[-1] == "close" for a in worker.game.agents.values())
+
+
+def test_shard_agent_forwards_calls(timer, maze):
+    class FakeShard:
+        def __init__(self):
+            self.calls = []
+
+        def call(self, cmd, *args):
+            self.calls.append((cmd,) + args)
+            return "ok"
+
+    shard = FakeShard()
+    agent = ShardAgent("梅", shard, _state("梅", maze, [1, 1]))
+    other = ShardAgent("约翰", shard, _state("约翰", maze, [2, 1]))
+    assert agent.completion("decide_chat", agent, other) == "ok"
+    cmd, name, method, args = shard.calls[0]
+    assert (cmd, name, method) == ("call", "梅", "completion")
+    assert args[0] == "decide_chat" and [a.name for a in args[1:]] == ["梅", "约翰"]
+    assert all(isinstance(a, AgentRef) for a in args[1:])
+    assert agent.get_event().object == "睡觉"
@@ -0,0 +1,115 @@
+import sys
+import datetime
+import importlib
+
+import pytest
+
+from modules import utils
+
+
+class IdleAgent:
+    """Agent sleeping until due, or idle until idle"""
+
+    def __init__(self, due=None, idle=None):
+        self.due, self.idle = due, idle
+
+    def next_due(self):
+        if self.due and self.due > utils.get_timer().get_date():
+            return self.due
+        return None
+
+    def idle_until(self, agents):
+        return self.idle
+
+    def to_dict(self):
+        return {}
+
+
+class FakeGame:
+    def __init__(self, agents, path=None):
+        self.agents, self.conversation = agents, {}
+        self.path = path or []
+        self.thinks = []
+
+    def get_agent(self, name):
+        return self.agents[name]
+
+    def agents_think(self, status, pool=None):
+        self.thinks.append((utils.get_timer().get_date("%H:%M"), sorted(status)))
+        return {n: {"plan": {"path": self.path}} for n in status}
+
+
+@pytest.fixture
+def start(monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["start.py"])
+    return importlib.import_module("start")
+
+
+def _create_server(start, game, tmp_path):
+    server = start.SimulateServer.__new__(start.SimulateServer)
+    server.game, server.config = game, {"agents": {}}
+    server.checkpoints_folder = str(tmp_path)
+    server.logger = utils.IOLogger()
+    server.agent_status = {n: {"coord": [1, 1], "path": []} for n in game.agents}
+    server.start_step = 0
+    server.parallel, server.shards = 1, 1
+    return server
+
+
+def _after(minutes):
+    return utils.get_timer().get_date() + datetime.timedelta(minutes=minutes)
+
+
+def test_fast_forward_sleeping_agents(timer, start, tmp_path):
+    game = FakeGame({"梅": IdleAgent(due=_after(95)), "约翰": IdleAgent(due=_after(95))})
+    _create_server(start, game, tmp_path).simulate(12, 10, fast_forward=True)
+    # 所有Agent都在睡觉时直接跳到醒来的step（95分钟向上取整为10个step）
+    assert game.thinks == [("11:10", ["梅", "约翰"]), ("11:20", ["梅", "约翰"])]
+    assert utils.get_timer().get_date("%H:%M") == "11:30"
+
+
+def test_fast_forward_within_steps(timer, start, tmp_path):
+    game = FakeGame({"梅": IdleAgent(due=_after(600))})
+    _create_server(start, game, tmp_path).simulate(3, 10, fast_forward=True)
+    assert game.thinks == []
+    assert utils.get_timer().get_date("%H:%M") == "10:00"
+
+
+def test_skip_sleeping_agents(timer, start, tmp_path):
+    game = FakeGame({"梅": IdleAgent(due=_after(25)), "约翰": IdleAgent()})
+    _create_server(start, game, tmp_path).simulate(4, 10, fast_forward=True)
+    assert game.thinks == [
+        ("09:30", ["约翰"]),
+        ("09:40", ["约翰"]),
+        ("09:50", ["约翰"]),
+        ("10:00", ["梅", "约翰"]),
+    ]
+
+
+def test_adapt_stride(timer, start, tmp_path):
+    game = FakeGame({"梅": IdleAgent(idle=_after(45)), "约翰": IdleAgent(idle=_after(120))})
+    server = _create_server(start, game, tmp_path)
+    idle = {"梅": {"plan": {"path": []}}}
+    # 步长为基础步长的整数倍，不超过最早可能发生事件的时间及max_stride
+    assert server.adapt_stride(10, 60, idle) == 40
+    assert server.adapt_stride(10, 30, idle) == 30
+    assert server.adapt_stride(10, 60, {"梅": {"plan": {"path": [[1, 2]]}}}) == 10
+    game.agents["约翰"].idle = None
+    assert server.adapt_stride(10, 60, idle) == 10
+
+
+def test_adaptive_stride_within_steps(timer, start, tmp_path):
+    game = FakeGame({"梅": IdleAgent(idle=_after(600))})
+    server = _create_server(start, game, tmp_path)
+    server.simulate(3, 10, max_stride=60)
+    # 剩余3个step时步长不超过30分钟
+    assert game.thinks == [("09:30", ["梅"])]
+    assert server.config["step_stride"] == 30
+    assert utils.get_timer().get_date("%H:%M") == "10:00"
+
+    game.thinks.clear()
+    game.agents["梅"].idle = _after(30)
+    server.start_step = 0
+    server.simulate(4, 10, max_stride=60)
+    assert game.thinks == [("10:00", ["梅"]), ("10:30", ["梅"])]
+    assert utils.get_timer().get_date("%H:%M") == "10:40"
@@ -0,0 +1,87 @@
+import json
+import asyncio
+
+import httpx
+import pytest
+
+from modules.model import llm_model
+from modules.model.llm_model import OllamaLLMModel
+
+
+def _sse(texts):
+    lines = ["data: " + json.dumps({"choices": [{"delta": {"content": t}}]}) for t in texts]
+    return "\n\n".join(lines + ["data: [DONE]"]) + "\n\n"
+
+
+class StreamServer:
+    """Mock server streaming the texts, recording how many were read"""
+
+    def __init__(self, texts, status=200):
+        self.texts, self.status = texts, status
+        self.sent, self.requests = 0, []
+
+    def _chunks(self):
+        for line in _sse(self.texts).split("\n\n"):
+            self.sent += 1
+            yield (line + "\n\n").encode("utf-8")
+
+    async def _achunks(self):
+        for chunk in self._chunks():
+            yield chunk
+
+    def handle(self, request):
+        self.requests.append(json.loads(request.content))
+        if self.status != 200:
+            return httpx.Response(self.status, text="overloaded")
+        return httpx.Response(200, content=self._chunks())
+
+    async def ahandle(self, request):
+        self.requests.append(json.loads(request.content))
+        if self.status != 200:
+            return httpx.Response(self.status, text="overloaded")
+        return httpx.Response(200, content=self._achunks())
+
+
+@pytest.fixture
+def create_model(monkeypatch):
+    def _create(server):
+        client = httpx.Client(transport=httpx.MockTransport(server.handle))
+        monkeypatch.setattr(llm_model, "get_http_client", lambda timeout: client)
+
+        async def _aget_client(timeout):
+            return httpx.AsyncClient(transport=httpx.MockTransport(server.ahandle))
+
+        monkeypatch.setattr(llm_model, "aget_http_client", _aget_client)
+        config = {"api_key": "", "model": "stream", "base_url": "http://127.0.0.1:2/v1"}
+        return OllamaLLMModel(config)
+
+    return _create
+
+
+def test_stream_until_pattern(create_model):
+    server = StreamServer(["<think>", "[1]", "</think>", "结果", "[2]", "之后", "不需要的内容"])
+    model = create_model(server)
+    text = model._completion("prompt", "http://127.0.0.1:2/v1", stop_pattern=r"\[\d\]")
+    # <think>中的文字不参与匹配，匹配后不再读取后续内容
+    assert text == "结果[2]"
+    assert server.requests[0]["stream"] and server.sent < 7
+
+
+def test_astream_until_pattern(create_model):
+    server = StreamServer(["结果", "[2]", "之后", "不需要的内容"])
+    model = create_model(server)
+    text = asyncio.run(model._acompletion("prompt", "http://127.0.0.1:2/v1", stop_pattern=r"\[\d\]"))
+    assert text == "结果[2]"
+
+
+def test_stream_without_match(create_model):
+    model = create_model(StreamServer(["结果", "没有", "编号"]))
+    assert model._completion("prompt", "http://127.0.0.1:2/v1", stop_pattern=r"\[\d\]") == "结果没有编号"
+
+
+def test_stream_error_status(create_model):
+    model = create_model(StreamServer(["结果"], status=503))
+    with pytest.raises(httpx.HTTPStatusError):
+        model._completion("prompt", "http://127.0.0.1:2/v1", stop_pattern=r"\[\d\]")
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(model._acompletion("prompt", "http://127.0.0.1:2/v1", stop_pattern=r"\[\d\]"))
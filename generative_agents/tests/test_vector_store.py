@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores import SimpleVectorStore
+from llama_index.core.vector_stores.types import (
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+)
+
+from modules.storage.vector_store import DEFAULT_PERSIST_FNAME, NumpyVectorStore
+
+
+def _nodes(num=60, dim=16):
+    state = np.random.RandomState(0)
+    return [
+        TextNode(
+            id_="node_{}".format(i),
+            text="text {}".format(i),
+            embedding=state.randn(dim).tolist(),
+            metadata={"node_type": ["event", "thought", "chat"][i % 3], "poignancy": i % 10},
+        )
+        for i in range(num)
+    ]
+
+
+def _queries(dim=16):
+    state = np.random.RandomState(1)
+    filters = [
+        None,
+        MetadataFilters(filters=[MetadataFilter(key="node_type", value="event")]),
+        MetadataFilters(
+            filters=[
+                MetadataFilter(key="node_type", value="thought"),
+                MetadataFilter(key="poignancy", value=5, operator=FilterOperator.GTE),
+            ]
+        ),
+    ]
+    node_ids = [None, ["node_{}".format(i) for i in range(0, 60, 2)]]
+    for f in filters:
+        for ids in node_ids:
+            yield VectorStoreQuery(
+                query_embedding=state.randn(dim).tolist(), similarity_top_k=7, filters=f, node_ids=ids
+            )
+
+
+def _assert_same(store, baseline):
+    for query in _queries():
+        result, expected = store.query(query), baseline.query(query)
+        assert result.ids == expected.ids
+        assert result.similarities == pytest.approx(expected.similarities, abs=1e-5)
+
+
+def test_query_parity():
+    store, baseline = NumpyVectorStore(), SimpleVectorStore()
+    nodes = _nodes()
+    store.add(nodes)
+    baseline.add(nodes)
+    _assert_same(store, baseline)
+
+    removed = ["node_{}".format(i) for i in range(0, 60, 7)]
+    store.delete_nodes(removed)
+    baseline.delete_nodes(removed)
+    _assert_same(store, baseline)
+
+
+def test_similarities():
+    store = NumpyVectorStore()
+    store.add(_nodes())
+    embeddings = np.random.RandomState(2).randn(3, 16)
+    node_ids = ["node_{}".format(i) for i in range(10)]
+    ids, scores, metadata = store.similarities(embeddings, node_ids)
+    assert ids == node_ids and scores.shape == (10, 3)
+    assert [m["poignancy"] for m in metadata] == list(range(10))
+    for col, embedding in enumerate(embeddings):
+        result = store.query(VectorStoreQuery(query_embedding=embedding.tolist(), similarity_top_k=10, node_ids=node_ids))
+        assert dict(zip(ids, scores[:, col].tolist())) == pytest.approx(dict(zip(result.ids, result.similarities)))
+
+
+def test_persist_parity(tmp_path):
+    nodes = _nodes()
+    store, baseline = NumpyVectorStore(), SimpleVectorStore()
+    store.add(nodes)
+    baseline.add(nodes)
+
+    # NumpyVectorStore保存的文件可以由SimpleVectorStore读取，反之亦然
+    store.persist(str(tmp_path / "numpy" / DEFAULT_PERSIST_FNAME))
+    _assert_same(SimpleVectorStore.from_persist_dir(str(tmp_path / "numpy")), baseline)
+    baseline.persist(str(tmp_path / "simple" / DEFAULT_PERSIST_FNAME))
+    _assert_same(NumpyVectorStore.from_persist_dir(str(tmp_path / "simple")), baseline)
+    _assert_same(NumpyVectorStore.from_persist_dir(str(tmp_path / "numpy")), baseline)
+    assert isinstance(NumpyVectorStore.from_persist_dir(str(tmp_path / "missing")), NumpyVectorStore)
+
+
+def test_raw_embeddings(tmp_path):
+    nodes = _nodes(num=10)
+    store = NumpyVectorStore()
+    store.add(nodes)
+    store.delete_nodes(["node_3"])
+    # 保存及读取的是原始的embedding，而不是归一化的向量
+    assert store.get("node_9") == nodes[9].embedding
+    assert store.to_dict()["embedding_dict"]["node_5"] == nodes[5].embedding
+    store.persist(str(tmp_path / DEFAULT_PERSIST_FNAME))
+    loaded = NumpyVectorStore.from_persist_dir(str(tmp_path))
+    assert loaded.to_dict() == store.to_dict()
+    assert all(loaded.get(n.node_id) == n.embedding for n in nodes if n.node_id != "node_3")